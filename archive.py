@@ -0,0 +1,172 @@
+"""
+weather_hour 的列式归档, 按 area/year 分区的 parquet 数据集
+
+archive/weather_hour/area=长沙/year=2023/<uuid>-0.parquet
+archive/weather_hour/area=长沙/_SUCCESS                       # 整个地区写入完成的标记, 断点续跑时据此跳过
+
+按地区整体写入的(wu_convert, import_csv)先写到临时目录, 成功后再移入并加标记,
+中途失败不会留下看似完成的部分数据
+"""
+import contextlib
+import datetime
+import os
+import shutil
+import uuid
+from typing import Iterable, List, Optional, Set, Tuple
+from urllib.parse import quote, unquote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+CUR_DIR = os.path.dirname(__file__)
+ARCHIVE_DIR = os.path.join(CUR_DIR, 'archive', 'weather_hour')
+
+COLUMNS = ['area', 'code', 'obs_time', 'temperature', 'feels_like', 'dewpoint', 'humidity', 'wind', 'wind_dir',
+           'wind_speed', 'pressure', 'precip', 'weather', 'source']
+
+SCHEMA = pa.schema([
+    ('code', pa.dictionary(pa.int8(), pa.string())),
+    ('obs_time', pa.timestamp('s')),
+    ('temperature', pa.int8()),
+    ('feels_like', pa.int8()),
+    ('dewpoint', pa.int8()),
+    ('humidity', pa.int8()),
+    ('wind', pa.dictionary(pa.int8(), pa.string())),
+    ('wind_dir', pa.int16()),
+    ('wind_speed', pa.int16()),
+    ('pressure', pa.float32()),
+    ('precip', pa.float32()),
+    ('weather', pa.dictionary(pa.int16(), pa.string())),
+    ('source', pa.dictionary(pa.int8(), pa.string())),
+])
+
+# 读出时整数列用可空类型, 避免有空值时变成 float64
+PANDAS_TYPES = {pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype()}
+
+# 以 _ 开头, pyarrow 读取数据集时忽略
+DONE_MARKER = '_SUCCESS'
+
+PARTITIONING = ds.partitioning(pa.schema([('area', pa.string()), ('year', pa.int16())]), flavor='hive')
+
+
+def _partition_dir(root: str, area: str, year: Optional[int] = None) -> str:
+    # 与 pyarrow 写分区目录时的转义一致
+    path = os.path.join(root, f'area={quote(area, safe="")}')
+    return path if year is None else os.path.join(path, f'year={year}')
+
+
+def to_table(df: pd.DataFrame) -> pa.Table:
+    """
+    转成紧凑类型, 温度/湿度 int8, 风向/天气等低基数列用字典编码, 兼容旧 csv 的 temprature 列名,
+    超出类型范围的值直接报错而不是截断
+    """
+    df = df.rename(columns={'temprature': 'temperature'})
+    obs_time = pd.to_datetime(df['obs_time'])
+    arrays = []
+    for f in SCHEMA:
+        col = obs_time if f.name == 'obs_time' else df[f.name]
+        if pa.types.is_dictionary(f.type):
+            arr = pa.array(col.astype('string'), pa.string(), from_pandas=True).dictionary_encode().cast(f.type)
+        else:
+            arr = pa.array(col, from_pandas=True).cast(f.type)
+        arrays.append(arr)
+    arrays.append(pa.array(df['area'].astype(str), pa.string()))
+    arrays.append(pa.array(obs_time.dt.year, pa.int16()))
+    return pa.Table.from_arrays(arrays, schema=SCHEMA.append(pa.field('area', pa.string()))
+                                .append(pa.field('year', pa.int16())))
+
+
+def write(df: pd.DataFrame, root: str = ARCHIVE_DIR):
+    """
+    追加写入, 每次写入生成新的文件, 不覆盖已有文件
+    """
+    if df.shape[0] == 0:
+        return
+    ds.write_dataset(to_table(df), root, format='parquet', partitioning=PARTITIONING,
+                     basename_template=f'{uuid.uuid4().hex}-{{i}}.parquet',
+                     existing_data_behavior='overwrite_or_ignore')
+
+
+def has_partition(area: str, year: Optional[int] = None, root: str = ARCHIVE_DIR) -> bool:
+    return os.path.isdir(_partition_dir(root, area, year))
+
+
+def is_done(area: str, root: str = ARCHIVE_DIR) -> bool:
+    return os.path.exists(os.path.join(_partition_dir(root, area), DONE_MARKER))
+
+
+def done_areas(root: str = ARCHIVE_DIR) -> Set[str]:
+    return set(area for area in areas(root) if is_done(area, root))
+
+
+@contextlib.contextmanager
+def staging(root: str = ARCHIVE_DIR):
+    """
+    返回 root 旁边的临时目录, 正常退出时把其中的文件移入 root, 并给写入的地区加完成标记, 出错时丢弃临时目录
+    """
+    tmp = f'{root}.tmp-{uuid.uuid4().hex}'
+    try:
+        yield tmp
+        if not os.path.isdir(tmp):
+            return
+        for area_dir in os.listdir(tmp):
+            for dirpath, _, files in os.walk(os.path.join(tmp, area_dir)):
+                target = os.path.join(root, os.path.relpath(dirpath, tmp))
+                os.makedirs(target, exist_ok=True)
+                for name in files:
+                    os.replace(os.path.join(dirpath, name), os.path.join(target, name))
+            open(os.path.join(root, area_dir, DONE_MARKER), 'w').close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def partitions(root: str = ARCHIVE_DIR) -> List[Tuple[str, int]]:
+    ret = []
+    if not os.path.isdir(root):
+        return ret
+    for area_dir in os.listdir(root):
+        if not area_dir.startswith('area='):
+            continue
+        for year_dir in os.listdir(os.path.join(root, area_dir)):
+            if year_dir.startswith('year='):
+                ret.append((unquote(area_dir[5:]), int(year_dir[5:])))
+    return ret
+
+
+def areas(root: str = ARCHIVE_DIR) -> Set[str]:
+    return set(area for area, _ in partitions(root))
+
+
+def read(areas: Optional[Iterable[str]] = None, start: Optional[datetime.datetime] = None,
+         end: Optional[datetime.datetime] = None, columns: Optional[List[str]] = None,
+         root: str = ARCHIVE_DIR) -> pd.DataFrame:
+    """
+    按地区和时间范围 [start, end) 读取, area/year 条件用于跳过不相关的分区目录
+    """
+    if not os.path.isdir(root):
+        return pd.DataFrame(columns=columns or COLUMNS)
+    dataset = ds.dataset(root, format='parquet', partitioning=PARTITIONING)
+    expr = None
+
+    def conj(e):
+        return e if expr is None else expr & e
+
+    if areas is not None:
+        expr = conj(ds.field('area').isin(list(areas)))
+    if start is not None:
+        expr = conj((ds.field('year') >= start.year) & (ds.field('obs_time') >= pa.scalar(start, pa.timestamp('s'))))
+    if end is not None:
+        expr = conj((ds.field('year') <= end.year) & (ds.field('obs_time') < pa.scalar(end, pa.timestamp('s'))))
+    df = dataset.to_table(columns=columns or COLUMNS, filter=expr).to_pandas(types_mapper=PANDAS_TYPES.get)
+    return df.sort_values(['area', 'obs_time'], ignore_index=True) if 'obs_time' in df and 'area' in df else df
+
+
+def import_csv(path: str, root: str = ARCHIVE_DIR, chunksize: int = 500000):
+    """
+    把 csv/weather_hour.csv 分块导入归档, 已完成的地区跳过. 所有块写完才移入归档, 中途失败下次重新导入
+    """
+    done = done_areas(root)
+    with staging(root) as tmp:
+        for chunk in pd.read_csv(path, chunksize=chunksize, dtype={'code': str, 'source': str}):
+            write(chunk[~chunk['area'].isin(done)], tmp)
@@ -0,0 +1,141 @@
+import json
+import os
+from collections import deque
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from models import Area
+
+AREA_JSON = os.path.join(os.path.dirname(__file__), 'area_code_2022.json')
+
+
+class AreaEntry(NamedTuple):
+    code: str
+    name: str
+    level: int
+    pcode: str
+
+
+class _AhoCorasick:
+    """
+    多模式匹配, 一次扫描找出文本中出现的所有模式串
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[List[int]] = [[]]
+        for i, pattern in enumerate(patterns):
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append(i)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def search(self, text: str) -> set:
+        found, node = set(), 0
+        for ch in text:
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            found.update(self.out[node])
+        return found
+
+
+class AreaIndex:
+    """
+    地区名 -> 行政区划的索引, 匹配规则与原 find_area 相同: 地区名包含 src 或 src 包含地区名,
+    匹配到多个时抛出 ValueError. 地区名出现在 src 中用 Aho-Corasick 自动机, src 出现在地区名中(精确/前缀/后缀/中间)
+    用预先展开的子串表, 查询结果按名称缓存
+
+    index = AreaIndex.from_json()
+    index.find('长沙').code
+    """
+
+    def __init__(self, areas: Iterable):
+        self.areas = list(areas)
+        self._substrings: Dict[str, List[int]] = {}
+        for i, a in enumerate(self.areas):
+            name = a.name
+            seen = set()
+            for start in range(len(name)):
+                for end in range(start + 1, len(name) + 1):
+                    sub = name[start:end]
+                    if sub not in seen:
+                        seen.add(sub)
+                        self._substrings.setdefault(sub, []).append(i)
+        self._automaton = _AhoCorasick(a.name for a in self.areas)
+        self._memo: Dict[str, object] = {}
+
+    @classmethod
+    def from_json(cls, path: str = AREA_JSON, level: Optional[int] = 2) -> 'AreaIndex':
+        areas = []
+
+        def handle(s: list):
+            for a in s:
+                if level is None or a['level'] == level:
+                    areas.append(AreaEntry(str(a['code']), a['name'], a['level'], str(a['pcode'])))
+                if a.get('children') is not None:
+                    handle(a['children'])
+
+        handle(json.loads(Path(path).read_text(encoding='utf-8')))
+        return cls(areas)
+
+    @classmethod
+    def from_session(cls, sess: Session, level: Optional[int] = 2) -> 'AreaIndex':
+        stmt = select(Area).order_by(Area.id)
+        if level is not None:
+            stmt = stmt.where(Area.level == level)
+        return cls(sess.scalars(stmt))
+
+    def containing(self, src: str) -> list:
+        """
+        名称中包含 src 的地区
+        """
+        return [self.areas[i] for i in self._substrings.get(src, [])]
+
+    def contained(self, src: str) -> list:
+        """
+        名称出现在 src 中的地区
+        """
+        return [self.areas[i] for i in sorted(self._automaton.search(src))]
+
+    def candidates(self, src: str) -> list:
+        ids = set(self._substrings.get(src, [])) | self._automaton.search(src)
+        return [self.areas[i] for i in sorted(ids)]
+
+    def find(self, src: str):
+        ret = self._memo.get(src)
+        if ret is None:
+            ret = self._memo[src] = self._find(src)
+        if isinstance(ret, ValueError):
+            raise ret
+        return ret
+
+    def _find(self, src: str):
+        candidates = self.candidates(src)
+        if len(candidates) == 0:
+            return ValueError(src)
+        if len(candidates) > 1:
+            return ValueError(src + " " + candidates[0].name + ' ' + candidates[1].name)
+        return candidates[0]
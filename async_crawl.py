@@ -0,0 +1,150 @@
+import asyncio
+import contextlib
+import json as _json
+import time
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import metrics
+from http_cache import CacheEntry, HttpCache, cache_key
+from throttle import AdaptiveThrottle
+
+USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+              'Chrome/112.0.0.0 Safari/537.36')
+
+
+class TokenBucket:
+    """
+    令牌桶, rate 为每秒补充的令牌数, capacity 为允许的突发请求数
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        if rate <= 0:
+            raise ValueError(f'rate must be positive: {rate}')
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class AsyncFetcher:
+    """
+    共享连接池的异步抓取器, 全局并发由 concurrency 限制, 每个 host 各自一个令牌桶限速,
+    传入 throttle 时改用自适应限速(按响应状态和延迟调整速率/并发, 被封时退避和熔断)
+
+    async with AsyncFetcher(concurrency=8, rate=0.5) as fetcher:
+        text = await fetcher.get(url)
+    """
+
+    def __init__(self, concurrency: int = 8, rate: float = 0.5, burst: float = 1,
+                 host_rates: Optional[Dict[str, float]] = None, headers: Optional[dict] = None,
+                 timeout: float = 30, cache: Optional[HttpCache] = None,
+                 throttle: Optional[AdaptiveThrottle] = None):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.host_rates = host_rates or {}
+        self.headers = {'User-Agent': USER_AGENT}
+        if headers is not None:
+            self.headers.update(headers)
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.cache = cache
+        self.throttle = throttle
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(headers=self.headers, connector=connector, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+        self.session = None
+
+    def bucket(self, host: str) -> TokenBucket:
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = TokenBucket(self.host_rates.get(host, self.rate), self.burst)
+            self._buckets[host] = bucket
+        return bucket
+
+    async def get(self, url: str, params: Optional[dict] = None, json: bool = False, **kwargs):
+        """
+        返回响应文本, json=True 时返回解析后的 json, 非 2xx 响应抛出 aiohttp.ClientResponseError,
+        配置了 cache 且 url 命中缓存规则时先查缓存
+        """
+        ttl = None if self.cache is None else self.cache.ttl(url)
+        if ttl is None:
+            async with self._request(url, params=params, **kwargs) as response:
+                response.raise_for_status()
+                if json:
+                    return await response.json(content_type=None)
+                return await response.text()
+
+        key = cache_key(url, params)
+        entry = self.cache.lookup(key)
+        if entry is None or not entry.fresh:
+            entry = await self._revalidate(key, entry, ttl, **kwargs)
+        else:
+            metrics.inc('http_cache_hits_total')
+        text = entry.body.decode(entry.charset(), errors='replace')
+        return _json.loads(text) if json else text
+
+    async def _revalidate(self, key: str, entry: Optional[CacheEntry], ttl: float, **kwargs) -> CacheEntry:
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry is not None:
+            headers.update(entry.conditional_headers())
+        async with self._request(key, headers=headers, **kwargs) as response:
+            if response.status == 304 and entry is not None:
+                return self.cache.refresh(key, entry, ttl)
+            response.raise_for_status()
+            body = await response.read()
+            return self.cache.store(key, response.status, dict(response.headers), body, ttl)
+
+    @contextlib.asynccontextmanager
+    async def _request(self, url: str, **kwargs):
+        host = urlsplit(url).hostname
+        with metrics.timer('http_throttle_wait_seconds', host=host):
+            if self.throttle is None:
+                await self.bucket(host).acquire()
+            else:
+                await self.throttle.acquire(host)
+        status, retry_after, start = None, None, time.monotonic()
+        cancelled = False
+        try:
+            async with self._semaphore:
+                async with self.session.get(url, **kwargs) as response:
+                    status, retry_after = response.status, response.headers.get('Retry-After')
+                    yield response
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            if cancelled and status is None:
+                # 取消不是 host 的问题, 不能按连接失败退避
+                metrics.inc('http_requests_total', host=host, status='cancelled')
+                if self.throttle is not None:
+                    await self.throttle.cancel(host)
+            else:
+                metrics.inc('http_requests_total', host=host, status='error' if status is None else status)
+                if self.throttle is not None:
+                    await self.throttle.release(host, status, time.monotonic() - start, retry_after)
@@ -0,0 +1,59 @@
+"""
+lishi.tianqi.com 月份页面解析的基准测试与一致性校验
+
+python bench_parse.py [page.html ...]
+
+默认使用 error.html 和按线上页面结构生成的月份页面, 先校验 parse_month_page 与
+parse_month_page_selector 结果逐条相同, 再分别计时
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+from lishi_parse import parse_month_page, parse_month_page_selector
+from stubs import month_page
+
+CUR_DIR = os.path.dirname(__file__)
+
+
+def load_pages(paths):
+    pages = [(p, Path(p).read_text(encoding='utf-8')) for p in paths]
+    if len(pages) == 0:
+        pages.append(('error.html', Path(CUR_DIR, 'error.html').read_text(encoding='utf-8')))
+        for i, (year, month) in enumerate(((2011, 1), (2016, 2), (2020, 2), (2023, 7))):
+            pages.append((f'{year}{month:02d}.html', month_page(year, month, i)))
+    return pages
+
+
+def check(pages):
+    for name, text in pages:
+        expected = parse_month_page_selector(text, '长沙')
+        actual = parse_month_page(text, '长沙')
+        if expected != actual:
+            raise AssertionError(f'{name}: {expected} != {actual}')
+        print(f'{name}: {len(actual)} records identical')
+
+
+def bench(func, pages, repeat):
+    rows = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _, text in pages:
+            rows += len(func(text, '长沙'))
+    elapsed = time.perf_counter() - start
+    return elapsed, rows
+
+
+def main():
+    pages = load_pages(sys.argv[1:])
+    check(pages)
+    repeat = 200
+    for func in (parse_month_page_selector, parse_month_page):
+        elapsed, rows = bench(func, pages, repeat)
+        print('%-26s %8.2f ms/page %10.0f rows/s' % (
+            func.__name__, elapsed * 1000 / (repeat * len(pages)), rows / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+"""
+抓取流程的离线基准测试, 上游站点由 stubs.py 的本地桩服务回放, 数据库用 sqlite, 不访问外网
+
+python bench_pipeline.py [--only history,wunderground,qweather,gd] [--latency 0.01] [--error-rate 0.02]
+                         [--areas 5] [--months 12] [--out result.json] [--baseline result.json]
+
+响应按线上结构用固定种子生成(lishi 月份页面与 bench_parse.py 相同), 每次运行内容一致.
+每个抓取器输出端到端吞吐(单元/s, 行/s)和各阶段耗时(见 metrics.py), --baseline 与之前 --out 的结果比较,
+吞吐下降超过 --tolerance 时以非 0 退出
+"""
+import argparse
+import contextlib
+import datetime
+import importlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from loguru import logger
+from redis import StrictRedis
+from sqlalchemy import create_engine, func, select
+
+import metrics
+from http_cache import CachedSession, HttpCache
+from models import Base, Station, WeatherRecord, WeatherRecordHour
+from planner import iter_months
+from stubs import StubProxy, StubServer, month_page
+from throttle import AdaptiveThrottle
+
+CRAWLERS = ['history', 'wunderground', 'qweather', 'gd']
+START = datetime.date(2021, 1, 1)
+WU_API_KEY = 'e1f10a1e78da46f5b10a1e78da96f525'
+WU_STATION = 'ZGHA'
+WX_PHRASES = ['Fair', 'Partly Cloudy', 'Mostly Cloudy', 'Cloudy', 'Light Rain', 'Rain', 'Fog', 'Haze']
+CARDINALS = ['N', 'NNE', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW', 'CALM', 'VAR']
+
+
+def fast_throttle() -> AdaptiveThrottle:
+    """
+    桩服务不需要限速, 但请求仍经过 throttle, 被注入的错误触发的退避也缩短
+    """
+    return AdaptiveThrottle(rate=1000, max_rate=1000, max_concurrency=8, backoff_base=0.01, max_backoff=0.2,
+                            cooldown=0.2, max_cooldown=1)
+
+
+def sqlite_engine(tmp_dir: str, name: str):
+    engine = create_engine('sqlite:///' + os.path.join(tmp_dir, name + '.sqlite'))
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def count_rows(engine, model) -> int:
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(model)).scalar()
+
+
+def load_areas(count: int):
+    with open(os.path.join(os.path.dirname(__file__), 'sds.json'), encoding='utf-8') as f:
+        return dict(list(json.load(f).items())[:count])
+
+
+# ---------- lishi.tianqi.com
+
+def city_list_page(areas: dict) -> bytes:
+    links = ''.join(f'<li><a href="/{pinyin}/index.html">{area}</a></li>' for area, pinyin in areas.items())
+    return ('<!DOCTYPE html><html><head><meta charset="utf-8"></head><body><div class="tablebox"><table><tr><td>'
+            f'<ul>{links}</ul></td></tr></table></div></body></html>').encode('utf-8')
+
+
+def bench_history(args, tmp_dir):
+    from weather_history import WeatherHistory
+
+    areas = load_areas(args.areas)
+    end = START + datetime.timedelta(days=31 * (args.months - 1))
+    routes = {'/': city_list_page(areas)}
+    for i, pinyin in enumerate(areas.values()):
+        for month in iter_months(START, end):
+            page = month_page(month.year, month.month, i)
+            routes[f'/{pinyin}/{month.strftime("%Y%m")}.html'] = page.encode('utf-8')
+    engine = sqlite_engine(tmp_dir, 'history')
+    with StubServer(routes, latency=args.latency, error_rate=args.error_rate, seed=1) as upstream:
+        # cache 只在全量抓取时用到, 不会建立连接
+        spider = WeatherHistory(engine=engine, cache=StrictRedis(), error_dir=tmp_dir, session=CachedSession(
+            HttpCache(os.path.join(tmp_dir, 'history_cache.sqlite')), throttle=fast_throttle()))
+        spider.base_url = upstream.url + '/'
+        spider.areas = set(areas)
+        start = time.perf_counter()
+        try:
+            spider._run(START, end)
+        except RuntimeError as e:
+            print(e)
+        elapsed = time.perf_counter() - start
+    return elapsed, count_rows(engine, WeatherRecord)
+
+
+# ---------- wunderground
+
+def wu_city_page(pinyin: str) -> bytes:
+    return (f'<html><body><h1>{pinyin} Weather History</h1><span class="station-id">({WU_STATION})</span>'
+            f'<script src="https://api.weather.com/v3/wx?apiKey={WU_API_KEY}&language=en-US"></script>'
+            '</body></html>').encode('utf-8')
+
+
+def wu_observation(rnd: random.Random, ts: int) -> dict:
+    temp = rnd.randint(40, 95)
+    return {'key': WU_STATION, 'class': 'observation', 'expire_time_gmt': ts + 7200, 'obs_id': WU_STATION,
+            'obs_name': 'Changsha', 'valid_time_gmt': ts, 'day_ind': 'D', 'temp': temp, 'wx_icon': 26,
+            'icon_extd': 2600, 'wx_phrase': rnd.choice(WX_PHRASES), 'pressure_tend': None, 'pressure_desc': None,
+            'dewPt': temp - rnd.randint(0, 20), 'heat_index': temp, 'rh': rnd.randint(30, 100),
+            'pressure': round(rnd.uniform(990, 1030), 2), 'vis': 6.21, 'wc': temp,
+            'wdir': rnd.choice([None, rnd.randint(0, 359)]), 'wdir_cardinal': rnd.choice(CARDINALS),
+            'gust': None, 'wspd': rnd.randint(0, 20), 'max_temp': None, 'min_temp': None, 'precip_total': None,
+            'precip_hrly': None, 'snow_hrly': None, 'uv_desc': 'Low', 'feels_like': temp, 'uv_index': 0,
+            'qualifier': None, 'qualifier_svrty': None, 'blunt_phrase': None, 'terse_phrase': None, 'clds': 'FEW',
+            'water_temp': None, 'primary_wave_period': None, 'primary_wave_height': None,
+            'primary_swell_period': None, 'primary_swell_height': None, 'primary_swell_direction': None,
+            'secondary_swell_period': None, 'secondary_swell_height': None, 'secondary_swell_direction': None}
+
+
+def wu_historical(path: str):
+    query = parse_qs(urlsplit(path).query)
+    if query.get('apiKey') != [WU_API_KEY]:
+        return 401, b'{"errors": [{"error": {"code": "CDN-0001", "message": "Invalid apiKey."}}]}'
+    start = datetime.datetime.strptime(query['startDate'][0], '%Y%m%d')
+    end = datetime.datetime.strptime(query['endDate'][0], '%Y%m%d') + datetime.timedelta(days=1)
+    rnd = random.Random(query['startDate'][0])
+    obss = [wu_observation(rnd, int(start.timestamp()) + i * 1800)
+            for i in range(int((end - start).total_seconds()) // 1800)]
+    return json.dumps({'metadata': {'language': 'en-US', 'transaction_id': '1', 'version': '1',
+                                    'location_id': WU_STATION + ':9:CN', 'units': 'e', 'expire_time_gmt': 0,
+                                    'status_code': 200}, 'observations': obss}).encode('utf-8')
+
+
+def bench_wunderground(args, tmp_dir):
+    import wunderground
+    from proxy_pool import ProxyPool
+    from raw_store import RawStore
+
+    areas = load_areas(args.areas)
+    routes = {f'/history/daily/cn/{pinyin}': wu_city_page(pinyin) for pinyin in areas.values()}
+    routes[f'/v1/location/{WU_STATION}:9:CN/observations/historical.json'] = wu_historical
+    end = START + datetime.timedelta(days=31 * (args.months - 1))
+    wunderground.START_YEAR, wunderground.END_YEAR = START.year, end.year
+    with StubServer(routes, latency=args.latency, error_rate=args.error_rate, seed=2) as upstream, \
+            StubProxy() as proxy:
+        spider = wunderground.WunderGroundWeather(
+            proxy_pool=ProxyPool([proxy.url]), store=RawStore(os.path.join(tmp_dir, 'raw')),
+            locations=wunderground.LocationCache(os.path.join(tmp_dir, 'wu_locations.sqlite')),
+            session=CachedSession(HttpCache(os.path.join(tmp_dir, 'wu_cache.sqlite')), throttle=fast_throttle()))
+        spider.location_map = areas
+        spider.base_url = upstream.url + '/history/daily/cn/%s'
+        spider.historical_url = upstream.url + '/v1/location/%s/observations/historical.json'
+        start = time.perf_counter()
+        spider.run()
+        elapsed = time.perf_counter() - start
+    rows = metrics.summary()['histograms'].get('crawl_rows{crawler="wunderground"}', {}).get('sum', 0)
+    return elapsed, int(rows)
+
+
+# ---------- qweather
+
+def qweather_now(polls: dict):
+    def route(path: str):
+        location = parse_qs(urlsplit(path).query)['location'][0]
+        n = polls[location] = polls.get(location, 0) + 1
+        rnd = random.Random(f'{location}-{n}')
+        obs_time = datetime.datetime(2023, 5, 1, 12) + datetime.timedelta(hours=n)
+        temp = rnd.randint(10, 35)
+        now = {'obsTime': obs_time.strftime('%Y-%m-%dT%H:%M+08:00'), 'temp': str(temp),
+               'feelsLike': str(temp + rnd.randint(-2, 3)), 'icon': '101', 'text': rnd.choice(WX_PHRASES),
+               'wind360': str(rnd.randint(0, 359)), 'windDir': 'E', 'windScale': '2',
+               'windSpeed': str(rnd.randint(0, 30)), 'humidity': str(rnd.randint(30, 100)),
+               'precip': f'{rnd.choice([0, 0, 0, 0.2, 1.5]):.1f}', 'pressure': '1005', 'vis': '16', 'cloud': '91',
+               'dew': str(temp - rnd.randint(0, 10))}
+        return json.dumps({'code': '200', 'updateTime': now['obsTime'], 'fxLink': '', 'now': now,
+                           'refer': {'sources': ['QWeather'], 'license': ['QWeather Developers License']}}).encode()
+
+    return route
+
+
+def bench_qweather(args, tmp_dir):
+    from qweather import QWeather
+
+    engine = sqlite_engine(tmp_dir, 'qweather')
+    polls = {}
+    with StubServer({'/v7/weather/now': qweather_now(polls)}, latency=args.latency, error_rate=args.error_rate,
+                    seed=3) as upstream:
+        q_weather = QWeather(concurrency=8, rate=1000, engine=engine)
+        q_weather.url = upstream.url + '/v7/weather/now'
+        start = time.perf_counter()
+        for _ in range(args.months):
+            q_weather.real_time_weather()
+        elapsed = time.perf_counter() - start
+    return elapsed, count_rows(engine, WeatherRecordHour)
+
+
+# ---------- 高德 place/text
+
+def amap_place(path: str):
+    query = parse_qs(urlsplit(path).query)
+    keyword, region = query['keywords'][0], query['region'][0]
+    rnd = random.Random(keyword)
+    if rnd.random() < 0.1:
+        return json.dumps({'status': '1', 'info': 'OK', 'infocode': '10000', 'count': '0', 'pois': []}).encode()
+    poi = {'name': keyword, 'id': f'B0FFF{rnd.randint(10000, 99999)}', 'type': '交通设施服务;火车站;火车站',
+           'typecode': '150200', 'pname': '湖南省', 'cityname': region + '市', 'adname': '芙蓉区',
+           'address': f'{region}车站路{rnd.randint(1, 300)}号', 'pcode': '430000', 'adcode': '430102',
+           'citycode': '0731', 'location': f'{rnd.uniform(108, 118):.6f},{rnd.uniform(18, 30):.6f}'}
+    return json.dumps({'status': '1', 'info': 'OK', 'infocode': '10000', 'count': '1', 'pois': [poi]},
+                      ensure_ascii=False).encode('utf-8')
+
+
+def bench_gd(args, tmp_dir):
+    import gd
+
+    engine = sqlite_engine(tmp_dir, 'gd')
+    stations = os.path.join(tmp_dir, 'stations.csv')
+    with open(gd.STATION_CSV, encoding='utf-8') as src, open(stations, 'w', encoding='utf-8') as dst:
+        for i, line in enumerate(src):
+            if i > args.areas * args.months:
+                break
+            dst.write(line)
+    gd.STATION_CSV, gd.PASSED_PATH = stations, os.path.join(tmp_dir, 'passed_sts.txt')
+    # 同步版 GdApi 把任何失败都当成 key 不可用, 这里不注入错误
+    with StubServer({'/v5/place/text': amap_place}, latency=args.latency, seed=4) as upstream:
+        gd.PLACE_URL = upstream.url + '/v5/place/text'
+        start = time.perf_counter()
+        # place_station 会打印每个响应
+        with contextlib.redirect_stdout(io.StringIO()):
+            gd.place_station(engine)
+        elapsed = time.perf_counter() - start
+    return elapsed, count_rows(engine, Station)
+
+
+# 抓取器 -> (模块, 测试函数)
+BENCHES = {'history': ('weather_history', bench_history), 'wunderground': ('wunderground', bench_wunderground),
+           'qweather': ('qweather', bench_qweather), 'gd': ('gd', bench_gd)}
+
+
+def report(name: str, elapsed: float, rows: int) -> dict:
+    summary = metrics.summary()
+    units = sum(v for k, v in summary['counters'].items() if k.startswith('crawl_units_total'))
+    failed = sum(v for k, v in summary['counters'].items()
+                 if k.startswith('crawl_units_total') and 'status="failed"' in k)
+    retries = sum(v for k, v in summary['counters'].items() if k.startswith('crawl_retries_total'))
+    result = dict(units=units, failed=failed, retries=retries, rows=rows, seconds=round(elapsed, 3),
+                  units_per_s=round(units / elapsed, 2), rows_per_s=round(rows / elapsed, 1), stages={})
+    print(f'--- {name}: {units:.0f} units ({failed:.0f} failed, {retries:.0f} retries), {rows} rows in '
+          f'{elapsed:.2f}s, {result["units_per_s"]} units/s, {result["rows_per_s"]} rows/s')
+    print('  %-48s %7s %10s %10s %10s' % ('stage', 'count', 'total ms', 'mean ms', 'p95 ms'))
+    for key, h in summary['histograms'].items():
+        if not key.split('{')[0].endswith('_seconds'):
+            continue
+        result['stages'][key] = dict(count=h['count'], mean=h['mean'], p95=h['p95'])
+        print('  %-48s %7d %10.1f %10.3f %10.3f' % (key, h['count'], h['sum'] * 1000, h['mean'] * 1000,
+                                                   h['p95'] * 1000))
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    ok = True
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key in ('units_per_s', 'rows_per_s'):
+            if base[key] > 0 and result[key] < base[key] * (1 - tolerance):
+                print(f'REGRESSION {name} {key}: {result[key]} < {base[key]} * {1 - tolerance:.2f}')
+                ok = False
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='offline crawl pipeline benchmark')
+    parser.add_argument('--only', default=','.join(CRAWLERS), help='逗号分隔, 默认全部')
+    parser.add_argument('--latency', type=float, default=0.01, help='桩服务的平均响应延迟(秒)')
+    parser.add_argument('--error-rate', type=float, default=0.02, help='桩服务返回 503 的比例')
+    parser.add_argument('--areas', type=int, default=5)
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--out', default=None, help='结果写入 json')
+    parser.add_argument('--baseline', default=None, help='与之前 --out 的结果比较')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='允许的吞吐下降比例')
+    args = parser.parse_args(argv)
+
+    names = args.only.split(',')
+    # 抓取器模块导入时会重设 loguru, 先全部导入再调低日志级别
+    for name in names:
+        importlib.import_module(BENCHES[name][0])
+    logger.remove()
+    # 失败已计入 crawl_units_total, 不逐条输出
+    logger.add(sys.stderr, level='CRITICAL')
+
+    metrics.enable('json')
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in names:
+            metrics.REGISTRY.reset()
+            elapsed, rows = BENCHES[name][1](args, tmp_dir)
+            results[name] = report(name, elapsed, rows)
+    metrics.disable()
+
+    if args.out is not None:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline, encoding='utf-8') as f:
+            if not compare(results, json.load(f), args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
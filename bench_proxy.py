@@ -0,0 +1,91 @@
+"""
+代理池的本地测试, 用 stubs.py 起一个上游和四个代理(快, 慢, 不稳定, 失效), 不访问外网
+
+python bench_proxy.py [requests]
+
+1. 打印请求在各代理上的分布, 快代理应该分到最多, 失效代理被剔除
+2. 恢复失效代理, 等到重新检测时间后应重新加入代理池
+"""
+import collections
+import sys
+import time
+
+import requests
+
+from proxy_pool import NoProxyAvailable, ProxyPool
+from stubs import StubProxy, StubServer
+
+RETEST_AFTER = 1.0
+
+
+def fetch(pool: ProxyPool, url: str, counter: collections.Counter):
+    proxy = pool.pick()
+    counter[proxy.url] += 1
+    start = time.monotonic()
+    try:
+        response = requests.get(url, proxies=proxy.proxies, timeout=2)
+    except requests.RequestException:
+        pool.report(proxy, False, time.monotonic() - start)
+        return False
+    ok = response.status_code == 200
+    pool.report(proxy, ok, response.elapsed.total_seconds())
+    return ok
+
+
+def print_stats(pool: ProxyPool, names: dict, counter: collections.Counter):
+    for s in pool.stats():
+        latency = 'n/a' if s['latency'] is None else f'{s["latency"] * 1000:.0f}ms'
+        print('%-6s picked %4d  healthy %-5s success %.2f  latency %s' % (
+            names[s['url']], counter[s['url']], s['healthy'], s['success'], latency))
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    upstream = StubServer(routes={'/': b'ok'}, latency=0.005, seed=0).start()
+    proxies = {'fast': StubProxy(delay=0.005, seed=1), 'slow': StubProxy(delay=0.08, seed=2),
+               'flaky': StubProxy(delay=0.005, fail_rate=0.5, seed=3), 'dead': StubProxy(down=True)}
+    for proxy in proxies.values():
+        proxy.start()
+    names = {p.url: name for name, p in proxies.items()}
+
+    def checker(proxy):
+        return requests.get(upstream.url, proxies=proxy.proxies, timeout=2).status_code == 200
+
+    pool = ProxyPool(names, retest_after=RETEST_AFTER, checker=checker)
+    counter = collections.Counter()
+    start = time.perf_counter()
+    ok = sum(fetch(pool, upstream.url + '/', counter) for _ in range(total))
+    elapsed = time.perf_counter() - start
+    print(f'--- {total} requests, {ok} ok, {elapsed:.2f}s')
+    print_stats(pool, names, counter)
+    dead = pool.proxies[proxies['dead'].url]
+    assert not dead.healthy, 'dead proxy is not evicted'
+    assert counter[proxies['fast'].url] == max(counter.values()), 'fast proxy is not preferred'
+
+    # 恢复失效代理, 到期后由 pick 顺带检测
+    proxies['dead'].down = False
+    time.sleep(max(0.0, dead.evicted_until - time.monotonic()) + 0.05)
+    counter.clear()
+    for _ in range(total // 3):
+        fetch(pool, upstream.url + '/', counter)
+    print(f'--- after revive, {total // 3} requests')
+    print_stats(pool, names, counter)
+    assert dead.healthy and counter[dead.url] > 0, 'revived proxy is not restored'
+
+    # 所有代理失效时 pick 抛出 NoProxyAvailable
+    for proxy in proxies.values():
+        proxy.down = True
+    try:
+        for _ in range(50):
+            fetch(pool, upstream.url + '/', counter)
+    except NoProxyAvailable as e:
+        print(f'--- all down: {e}')
+    else:
+        raise AssertionError('pool still picks proxies after all are down')
+
+    for server in [upstream, *proxies.values()]:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+query.py 常用查询形态的基准测试, 使用生成数据的 sqlite 数据库
+
+python bench_query.py [db_path]
+
+分别计时不走缓存和命中缓存, 并打印每种查询的 sqlite 执行计划, 确认范围条件落在复合索引上
+"""
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event, insert, text
+
+import query
+from models import Base, WeatherRecord, WeatherRecordHour
+
+# 4 个省各 5 个城市, 2 年逐小时数据
+PROVINCES = {'43': ['长沙', '株洲', '湘潭', '衡阳', '邵阳'], '42': ['武汉', '黄石', '十堰', '宜昌', '襄阳'],
+             '44': ['广州', '韶关', '深圳', '珠海', '汕头'], '36': ['南昌', '景德镇', '萍乡', '九江', '新余']}
+START = datetime.datetime(2022, 1, 1)
+HOURS = 2 * 365 * 24
+WEATHERS = ['晴', '多云', '阴', '小雨', '中雨']
+WINDS = ['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW']
+
+
+def build(engine):
+    Base.metadata.create_all(engine)
+    rnd = random.Random(0)
+    with engine.begin() as conn:
+        if conn.execute(text('select count(*) from weather_hour')).scalar() != 0:
+            return
+        for prefix, cities in PROVINCES.items():
+            for i, city in enumerate(cities):
+                code = f'{prefix}{i + 1:02d}00000000'
+                rows = []
+                for h in range(HOURS):
+                    rows.append(dict(area=city, code=code, obs_time=START + datetime.timedelta(hours=h),
+                                     temperature=rnd.randint(-5, 38), feels_like=rnd.randint(-8, 42),
+                                     dewpoint=rnd.randint(-10, 25), humidity=rnd.randint(20, 100),
+                                     wind=rnd.choice(WINDS), wind_dir=rnd.randint(0, 359),
+                                     wind_speed=rnd.randint(0, 40), pressure=1000 + rnd.random() * 30, precip=0,
+                                     weather=rnd.choice(WEATHERS), source='0', create_time=START))
+                conn.execute(insert(WeatherRecordHour), rows)
+                days = [dict(area_name=city, wdate=(START + datetime.timedelta(days=d)).date(),
+                             max_temp=rnd.randint(15, 38), min_temp=rnd.randint(-5, 15),
+                             weather=rnd.choice(WEATHERS), wind=rnd.choice(WINDS), update_time=START)
+                        for d in range(HOURS // 24)]
+                conn.execute(insert(WeatherRecord), days)
+
+
+def shapes():
+    week = (datetime.datetime(2023, 6, 1), datetime.datetime(2023, 6, 8))
+    month = (datetime.datetime(2023, 6, 1), datetime.datetime(2023, 7, 1))
+    year = (datetime.datetime(2023, 1, 1), datetime.datetime(2024, 1, 1))
+    return [
+        ('hourly 1 area 1 week', query.hourly, (['长沙'], *week), {}),
+        ('series 1 area 1 year', query.series, ('长沙', *year), {}),
+        ('hourly 5 areas 1 month', query.hourly, (PROVINCES['43'], *month), {}),
+        ('hourly province 1 month', query.hourly_by_code, ('43', *month), {}),
+        ('monthly means province 1 year', query.aggregate, year, {'code_prefix': '43'}),
+        ('daily means all 1 year', query.aggregate, year, {'areas': sum(PROVINCES.values(), []), 'freq': 'day'}),
+        ('daily 1 area 1 year', query.daily, (['长沙'], year[0].date(), year[1].date()), {}),
+    ]
+
+
+def explain(engine, fn, args, kwargs):
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        fn(*args, engine=engine, use_cache=False, **kwargs)
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    statement, parameters = statements[-1]
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    return '; '.join(row[-1] for row in rows)
+
+
+def timeit(fn, args, kwargs, engine, use_cache, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        df = fn(*args, engine=engine, use_cache=use_cache, **kwargs)
+    return (time.perf_counter() - start) * 1000 / repeat, len(df)
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tempfile.gettempdir(), 'bench_query.sqlite')
+    engine = create_engine(f'sqlite:///{path}')
+    start = time.perf_counter()
+    build(engine)
+    print(f'db {path} ready in {time.perf_counter() - start:.1f}s')
+
+    for name, fn, args, kwargs in shapes():
+        cold, rows = timeit(fn, args, kwargs, engine, False, 5)
+        query.cache.clear()
+        fn(*args, engine=engine, **kwargs)
+        warm, _ = timeit(fn, args, kwargs, engine, True, 50)
+        print('%-32s %8d rows %10.2f ms %8.3f ms cached' % (name, rows, cold, warm))
+        print('    ' + explain(engine, fn, args, kwargs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+schema.py 迁移前后的查询计划与耗时对比, 用 sqlite 代替 mysql
+
+python bench_schema.py [cities] [years]
+
+先建不带任何二级索引的 weather_hour/weather (与迁移前的线上表一致) 并写入生成数据和少量重复行,
+对常见查询形态打印执行计划和耗时, 执行 schema.migrate 后再测一次
+"""
+import datetime
+import random
+import sys
+import time
+
+from sqlalchemy import MetaData, Table, create_engine, insert, text
+
+import schema
+from models import Base, WeatherRecord, WeatherRecordHour
+
+START = datetime.datetime(2015, 1, 1)
+
+QUERIES = [
+    ('dedupe lookup', 'SELECT id FROM weather_hour WHERE area = :area AND obs_time = :t AND source = :source'),
+    ('area 1 week', 'SELECT obs_time, temperature FROM weather_hour WHERE area = :area '
+                    'AND obs_time >= :t AND obs_time < :t_week ORDER BY obs_time'),
+    ('code prefix 1 month', 'SELECT area, obs_time, temperature FROM weather_hour WHERE code >= :prefix '
+                            'AND code < :prefix_end AND obs_time >= :t AND obs_time < :t_month'),
+    ('last obs per area', 'SELECT area, MAX(obs_time) FROM weather_hour WHERE source = :source GROUP BY area'),
+    ('weather 1 month', 'SELECT wdate, max_temp, min_temp FROM weather WHERE area_name = :area '
+                        'AND wdate >= :d AND wdate < :d_month'),
+]
+
+
+def bare_tables() -> MetaData:
+    """
+    只有主键, 没有唯一键和二级索引的旧表结构
+    """
+    metadata = MetaData()
+    for table in (WeatherRecordHour.__table__, WeatherRecord.__table__):
+        Table(table.name, metadata, *[c._copy() for c in table.columns])
+    return metadata
+
+
+def build(engine, cities: int, years: int):
+    bare_tables().create_all(engine)
+    rnd = random.Random(0)
+    hours = years * 365 * 24
+    with engine.begin() as conn:
+        for i in range(cities):
+            area, code = f'city{i:02d}', f'43{i:02d}00000000'
+            rows = [dict(area=area, code=code, obs_time=START + datetime.timedelta(hours=h),
+                         temperature=rnd.randint(-5, 38), source='0', create_time=START) for h in range(hours)]
+            # 重复抓取留下的重复行
+            rows.extend(rnd.sample(rows, 10))
+            conn.execute(insert(WeatherRecordHour), rows)
+            days = [dict(area_name=area, wdate=(START + datetime.timedelta(days=d)).date(),
+                         max_temp=rnd.randint(15, 38), min_temp=rnd.randint(-5, 15), update_time=START)
+                    for d in range(hours // 24)]
+            conn.execute(insert(WeatherRecord), days)
+
+
+def run(engine, label: str, repeat: int = 20):
+    t = START + datetime.timedelta(days=200)
+    params = dict(area='city07', source='0', t=t, t_week=t + datetime.timedelta(days=7),
+                  t_month=t + datetime.timedelta(days=30), prefix='4301', prefix_end='4302', d=t.date(),
+                  d_month=(t + datetime.timedelta(days=30)).date())
+    print(f'--- {label}')
+    with engine.connect() as conn:
+        for name, sql in QUERIES:
+            plan = '; '.join(row[-1] for row in conn.execute(text('EXPLAIN QUERY PLAN ' + sql), params))
+            start = time.perf_counter()
+            for _ in range(repeat):
+                conn.execute(text(sql), params).all()
+            print('%-22s %9.3f ms  %s' % (name, (time.perf_counter() - start) * 1000 / repeat, plan))
+
+
+def main():
+    cities = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    years = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    engine = create_engine('sqlite://')
+    start = time.perf_counter()
+    build(engine, cities, years)
+    with engine.connect() as conn:
+        count = conn.execute(text('SELECT COUNT(*) FROM weather_hour')).scalar()
+    print(f'{count} hourly rows in {time.perf_counter() - start:.1f}s')
+
+    run(engine, 'before migrate')
+    start = time.perf_counter()
+    statements = schema.migrate(engine)
+    print(f'migrate: {len(statements)} statements in {time.perf_counter() - start:.1f}s')
+    assert schema.plan(engine) == [], 'migrate is not idempotent'
+    run(engine, 'after migrate')
+    assert set(Base.metadata.tables) <= set(schema.inspect(engine).get_table_names())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+统一的命令行入口, 各子命令只在执行时才导入自己用到的模块, 定时任务不必为用不到的依赖付出启动时间
+
+python crawl.py history [--full] [--async] [--enqueue | --worker]     lishi.tianqi.com 日数据
+python crawl.py hourly [--enqueue | --worker]                         wunderground 逐小时数据
+python crawl.py realtime [--loop] [--interval 600]                   和风实时天气
+python crawl.py stations [--async]                                   高德检索气象站位置
+python crawl.py parse area|station-pos|weather-hour|map-adcode|ck-format
+python crawl.py convert [csv|parquet|archive] [--workers N]           wunderground 原始响应转换
+python crawl.py rollup [--fill | --check]                             weather_hour 日汇总
+python crawl.py gaps --start 2023-01-01 [--end] [--source 0] [--area 长沙 ...] [--archive] [--backfill]
+                                                                     weather_hour 缺口检测和补抓
+python crawl.py initdb [--partition] [--dry-run]                      建表/补索引, get_engine 不再自动建表
+
+导入子命令模块的耗时超过预算(--import-budget, 默认见 IMPORT_BUDGETS)时输出警告,
+--metrics prom|json 记录各阶段耗时/计数, 结束时写到 --metrics-out(默认 stderr)
+"""
+import argparse
+import datetime
+import importlib
+import sys
+import time
+
+import metrics
+
+# 各子命令导入模块的耗时预算, 秒
+IMPORT_BUDGETS = {'history': 1.0, 'hourly': 0.5, 'realtime': 1.0, 'stations': 1.0, 'parse': 1.0, 'convert': 1.0,
+                  'rollup': 0.8, 'initdb': 0.8, 'gaps': 1.0}
+
+PARSE_TARGETS = {'area': 'parse_area', 'station-pos': 'parse_station_pos', 'weather-hour': 'parse_weather_hour',
+                 'map-adcode': 'map_adcode', 'ck-format': 'ck_format'}
+
+
+def _date(value: str) -> datetime.date:
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def history(args, weather_history):
+    weather_history.add_log_file()
+    spider = weather_history.AsyncWeatherHistory() if args.use_async else weather_history.WeatherHistory()
+    if args.enqueue:
+        queue = weather_history.TaskQueue(spider.cache, weather_history.SOURCE)
+        spider.enqueue(queue, args.start, args.end or datetime.date.today())
+    elif args.worker:
+        spider.run_worker(weather_history.TaskQueue(spider.cache, weather_history.SOURCE))
+    elif args.full:
+        spider.run_full()
+    else:
+        spider.run_inc()
+
+
+def hourly(args, wunderground):
+    spider = wunderground.WunderGroundWeather()
+    if args.enqueue:
+        spider.enqueue(wunderground.TaskQueue(spider.cache, wunderground.SOURCE))
+    elif args.worker:
+        spider.run_worker(wunderground.TaskQueue(spider.cache, wunderground.SOURCE))
+    else:
+        spider.run()
+
+
+def realtime(args, qweather):
+    q_weather = qweather.QWeather()
+    if args.loop:
+        q_weather.run_forever(args.interval)
+    else:
+        q_weather.real_time_weather()
+
+
+def stations(args, gd):
+    if args.use_async:
+        gd.place_station_async(args.concurrency)
+    else:
+        gd.place_station()
+
+
+def parse(args, parse_module):
+    getattr(parse_module, PARSE_TARGETS[args.target])()
+
+
+def convert(args, wu_convert):
+    out_dir = wu_convert.OUT_DIR
+    if args.fmt == 'archive':
+        from archive import ARCHIVE_DIR as out_dir
+    for city, count in wu_convert.convert_all(wu_convert.load_codes(), out_dir=out_dir, fmt=args.fmt,
+                                              workers=args.workers).items():
+        print(city, count)
+
+
+def rollup(args, rollup_module):
+    if args.fill:
+        rollup_module.fill_weather()
+    elif args.check:
+        print(rollup_module.cross_check().to_string())
+    else:
+        rollup_module.rollup()
+
+
+def gaps(args, gaps_module):
+    start = datetime.datetime.combine(args.start, datetime.time())
+    end = datetime.datetime.combine(args.end or datetime.date.today(), datetime.time())
+    gaps_module.run(start, end, args.area, args.source, use_archive=args.archive, fill=args.backfill)
+
+
+def initdb(args, schema):
+    schema.migrate(partition=args.partition, dry_run=args.dry_run)
+
+
+# 子命令 -> (需要导入的模块, 执行函数)
+COMMANDS = {
+    'history': (['weather_history'], history),
+    'hourly': (['wunderground'], hourly),
+    'realtime': (['qweather'], realtime),
+    'stations': (['gd'], stations),
+    'parse': (['parse'], parse),
+    'convert': (['wu_convert'], convert),
+    'rollup': (['rollup'], rollup),
+    'initdb': (['schema'], initdb),
+    'gaps': (['gaps'], gaps),
+}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='crawl', description='weather spider')
+    parser.add_argument('--import-budget', type=float, default=None, help='导入耗时预算(秒), 超出时警告')
+    parser.add_argument('--metrics', choices=['prom', 'json'], default=None, help='记录指标, 结束时输出')
+    parser.add_argument('--metrics-out', default=None, help='指标输出文件, 默认 stderr')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('history', help='lishi.tianqi.com 历史日数据')
+    p.add_argument('--full', action='store_true', help='全量抓取, 默认只抓最近两个月')
+    p.add_argument('--async', dest='use_async', action='store_true', help='异步并发抓取')
+    mode = p.add_mutually_exclusive_group()
+    mode.add_argument('--enqueue', action='store_true', help='把 (地区, 月份) 单元写入 redis 队列')
+    mode.add_argument('--worker', action='store_true', help='从 redis 队列领取单元抓取')
+    p.add_argument('--start', type=_date, default=datetime.date(2011, 1, 1), help='--enqueue 的开始日期')
+    p.add_argument('--end', type=_date, default=None, help='--enqueue 的结束日期, 默认今天')
+
+    p = sub.add_parser('hourly', help='wunderground 逐小时数据')
+    mode = p.add_mutually_exclusive_group()
+    mode.add_argument('--enqueue', action='store_true')
+    mode.add_argument('--worker', action='store_true')
+
+    p = sub.add_parser('realtime', help='和风实时天气')
+    p.add_argument('--loop', action='store_true', help='常驻轮询')
+    p.add_argument('--interval', type=float, default=600)
+
+    p = sub.add_parser('stations', help='高德检索气象站位置')
+    p.add_argument('--async', dest='use_async', action='store_true')
+    p.add_argument('--concurrency', type=int, default=8)
+
+    p = sub.add_parser('parse', help='解析本地数据文件')
+    p.add_argument('target', choices=list(PARSE_TARGETS))
+
+    p = sub.add_parser('convert', help='wunderground 原始响应转 csv/parquet/归档')
+    p.add_argument('fmt', nargs='?', default='csv', choices=['csv', 'parquet', 'archive'])
+    p.add_argument('--workers', type=int, default=None)
+
+    p = sub.add_parser('rollup', help='weather_hour 增量日汇总')
+    mode = p.add_mutually_exclusive_group()
+    mode.add_argument('--fill', action='store_true', help='补 weather 表缺失的日期')
+    mode.add_argument('--check', action='store_true', help='与 weather 表比对')
+
+    p = sub.add_parser('gaps', help='weather_hour 缺口检测和补抓')
+    p.add_argument('--start', type=_date, required=True)
+    p.add_argument('--end', type=_date, default=None, help='不包含, 默认今天')
+    p.add_argument('--source', choices=['0', '1'], default=None, help='0 -> wunderground, 1 -> 和风')
+    p.add_argument('--area', nargs='+', default=None, help='这些地区完全没有数据时也算缺口')
+    p.add_argument('--archive', action='store_true', help='检查 parquet 归档而不是数据库')
+    p.add_argument('--backfill', action='store_true', help='补抓 wunderground 的缺口')
+
+    p = sub.add_parser('initdb', help='建表/补索引和唯一键')
+    p.add_argument('--partition', action='store_true', help='mysql 上按年分区 weather_hour')
+    p.add_argument('--dry-run', action='store_true', help='只打印 sql')
+    return parser
+
+
+def load_modules(names, budget: float):
+    """
+    导入子命令的模块并计时, 超出预算时警告
+    """
+    start = time.perf_counter()
+    modules = [importlib.import_module(name) for name in names]
+    elapsed = time.perf_counter() - start
+    # 子命令模块都依赖 loguru, 此时导入已无额外开销
+    from loguru import logger
+    if elapsed > budget:
+        logger.warning(f'importing {", ".join(names)} took {elapsed:.2f}s, over budget {budget:.2f}s')
+    else:
+        logger.info(f'importing {", ".join(names)} took {elapsed:.2f}s (budget {budget:.2f}s)')
+    return modules, elapsed
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.metrics is not None:
+        metrics.enable(args.metrics, args.metrics_out)
+    names, fn = COMMANDS[args.command]
+    budget = args.import_budget if args.import_budget is not None else IMPORT_BUDGETS[args.command]
+    modules, _ = load_modules(names, budget)
+    fn(args, *modules)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+weather_hour 的缺口检测和定向补抓
+
+每个 (地区, 来源) 的 obs_time 排序后整列求差, 相邻观测间隔超过该来源正常间隔的 TOLERANCE 倍即为缺口,
+范围开头/结尾没有观测也算. 缺口按 (来源, 地区, 月份) 归并成需要补抓的日期, 只重新请求这些日期.
+
+python gaps.py 2023-01-01 2023-07-01 [--archive] [--backfill]
+python crawl.py gaps --start 2023-01-01 [--end 2023-07-01] [--source 0] [--area 长沙 ...] [--archive] [--backfill]
+"""
+import datetime
+import sys
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.engine import Engine
+
+from models import WeatherRecordHour, get_engine
+
+# 各来源的正常观测间隔, 秒. wunderground 的站点每小时或每半小时一条,
+# 和风实时接口 obsTime 约 20 分钟更新一次, 按默认 10 分钟轮询时相邻观测不超过半小时
+CADENCE = {'0': 3600, '1': 1800}
+TOLERANCE = 1.5
+SOURCE_NAMES = {'0': 'wunderground', '1': 'qweather'}
+
+
+class Gap(NamedTuple):
+    area: str
+    source: str
+    # 第一个和最后一个缺失的观测时间, 按正常间隔推算
+    start: datetime.datetime
+    end: datetime.datetime
+    missing: int
+
+    def dates(self) -> List[datetime.date]:
+        days = (self.end.date() - self.start.date()).days
+        return [self.start.date() + datetime.timedelta(days=i) for i in range(days + 1)]
+
+
+def _seconds(values) -> np.ndarray:
+    return np.asarray(values, dtype='datetime64[s]').astype('int64')
+
+
+def _datetimes(seconds: np.ndarray) -> List[datetime.datetime]:
+    return seconds.astype('datetime64[s]').astype(datetime.datetime).tolist()
+
+
+def find_gaps(df: pd.DataFrame, start: datetime.datetime, end: datetime.datetime,
+              expected: Optional[Iterable[Tuple[str, str]]] = None,
+              cadence: Optional[Dict[str, int]] = None) -> List[Gap]:
+    """
+    df 至少包含 area, source, obs_time 三列, 不要求有序. 检查 [start, end) 范围,
+    expected 为应当有数据的 (地区, 来源), 其中完全没有观测的整段作为一个缺口
+    """
+    cadence = {**CADENCE, **(cadence or {})}
+    lo, hi = _seconds(start).item(), _seconds(end).item()
+    t = _seconds(df['obs_time'].to_numpy())
+    keep = (t >= lo) & (t < hi)
+    area_codes, area_names = pd.factorize(df['area'].to_numpy()[keep])
+    source_codes, source_names = pd.factorize(df['source'].astype(str).to_numpy()[keep])
+    t = t[keep]
+
+    order = np.lexsort((t, source_codes, area_codes))
+    a, s, t = area_codes[order], source_codes[order], t[order]
+    step = np.array([cadence[name] for name in source_names], dtype='int64')[s]
+    first = np.ones(t.shape[0], dtype=bool)
+    first[1:] = (a[1:] != a[:-1]) | (s[1:] != s[:-1])
+    last = np.ones(t.shape[0], dtype=bool)
+    last[:-1] = first[1:]
+
+    # 每条观测与前一条(组内第一条与 start 前一个间隔)之间, 以及组内最后一条与 end 之间
+    prev = np.empty_like(t)
+    prev[1:] = t[:-1]
+    prev = np.where(first, lo - step, prev)
+    inner = t - prev > step * TOLERANCE
+    tail = last & (hi - t > step * TOLERANCE)
+    idx = np.concatenate([np.flatnonzero(inner), np.flatnonzero(tail)])
+    after = np.concatenate([prev[inner], t[tail]])
+    before = np.concatenate([t[inner], np.full(np.count_nonzero(tail), hi)])
+    step, a, s = step[idx], a[idx], s[idx]
+    missing = np.maximum(np.rint((before - after) / step).astype('int64') - 1, 1)
+    gap_start = after + step
+    gap_end = np.maximum(before - step, gap_start)
+
+    gaps = [Gap(area_names[i], source_names[j], gs, ge, int(m))
+            for i, j, gs, ge, m in zip(a, s, _datetimes(gap_start), _datetimes(gap_end), missing)]
+    pairs = np.unique(area_codes.astype('int64') * len(source_names) + source_codes)
+    present = set((area_names[p // len(source_names)], source_names[p % len(source_names)]) for p in pairs)
+    for area, source in expected or ():
+        if (area, source) not in present:
+            step = cadence[source]
+            first_slot, last_slot = _datetimes(np.array([lo, hi - step]))
+            gaps.append(Gap(area, source, first_slot, last_slot, (hi - lo) // step))
+    return sorted(gaps)
+
+
+def load_times(start: datetime.datetime, end: datetime.datetime, areas: Optional[Iterable[str]] = None,
+               source: Optional[str] = None, engine: Optional[Engine] = None) -> pd.DataFrame:
+    """
+    从 weather_hour 读出 [start, end) 内的 area, source, obs_time, 按地区查询时走 (area, obs_time, source) 索引
+    """
+    table = WeatherRecordHour.__table__
+    stmt = select(table.c.area, table.c.source, table.c.obs_time).where(
+        table.c.obs_time >= start, table.c.obs_time < end)
+    if areas is not None:
+        stmt = stmt.where(table.c.area.in_(list(areas)))
+    if source is not None:
+        stmt = stmt.where(table.c.source == source)
+    with (engine or get_engine()).connect() as conn:
+        return pd.read_sql(stmt, conn, parse_dates=['obs_time'])
+
+
+def load_archive_times(start: datetime.datetime, end: datetime.datetime, areas: Optional[Iterable[str]] = None,
+                       source: Optional[str] = None) -> pd.DataFrame:
+    import archive
+
+    df = archive.read(areas, start, end, columns=['area', 'source', 'obs_time'])
+    return df if source is None else df[df['source'].astype(str) == source]
+
+
+def days_by_month(gaps: Iterable[Gap]) -> Dict[Tuple[str, str, datetime.date], List[datetime.date]]:
+    """
+    缺口归并为 (来源, 地区, 月份) -> 有缺失的日期
+    """
+    days = defaultdict(set)
+    for gap in gaps:
+        for date in gap.dates():
+            days[(gap.source, gap.area, date.replace(day=1))].add(date)
+    return {key: sorted(dates) for key, dates in sorted(days.items())}
+
+
+def _append_archive(df: pd.DataFrame, area: str) -> int:
+    # 归档只追加不去重, 跳过归档里已有的观测时间
+    import archive
+
+    start, end = df['obs_time'].min().to_pydatetime(), df['obs_time'].max().to_pydatetime()
+    known = archive.read([area], start, end + datetime.timedelta(seconds=1), columns=['obs_time', 'source'])
+    df = df[~df['obs_time'].isin(known.loc[known['source'].astype(str) == '0', 'obs_time'])]
+    archive.write(df)
+    return df.shape[0]
+
+
+def backfill(gaps: Iterable[Gap], engine: Optional[Engine] = None, spider=None, use_archive: bool = False) -> int:
+    """
+    wunderground 的缺口按月份重新请求缺失日期所在的区间, 观测合并进原始存储, 再写回检测缺口的存储:
+    use_archive 时追加到归档, 否则 upsert 进 weather_hour, 返回写入行数.
+    和风只提供实时数据, 缺口无法补抓, 只记录日志. 单个 (地区, 月份) 出错时记录后继续
+    """
+    from writer import BulkWriter
+    from wu_convert import convert_observations
+
+    rows, failed, area_index = 0, 0, None
+    writer = None if use_archive else BulkWriter(engine or get_engine(), WeatherRecordHour,
+                                                 ('area', 'obs_time', 'source'), update_columns=())
+    try:
+        for (source, area, month), dates in days_by_month(gaps).items():
+            if source != '0':
+                logger.warning(f'{SOURCE_NAMES.get(source, source)} {area} {month:%Y-%m}: '
+                               f'{len(dates)} days missing, no history api to backfill')
+                continue
+            try:
+                if spider is None:
+                    from wunderground import WunderGroundWeather
+                    spider = WunderGroundWeather()
+                obss = spider.refetch_days(area, dates[0], dates[-1])
+                if len(obss) == 0:
+                    continue
+                if area_index is None:
+                    from area_index import AreaIndex
+                    area_index = AreaIndex.from_json()
+                df = convert_observations(obss, area, area_index.find(area).code)
+                df = df.rename(columns={'temprature': 'temperature'}).drop(columns='qc')
+                if use_archive:
+                    rows += _append_archive(df, area)
+                else:
+                    writer.add_all(df.astype(object).where(df.notna(), None).to_dict('records'))
+                    rows += df.shape[0]
+            except Exception:
+                logger.exception(f'backfill {area} {month:%Y-%m} failed')
+                failed += 1
+    finally:
+        if writer is not None:
+            writer.close()
+    if failed:
+        logger.warning(f'{failed} area months failed to backfill')
+    return rows
+
+
+def run(start: datetime.datetime, end: datetime.datetime, areas: Optional[Iterable[str]] = None,
+        source: Optional[str] = None, use_archive: bool = False, fill: bool = False,
+        engine: Optional[Engine] = None) -> List[Gap]:
+    """
+    检测并打印缺口, fill 为 True 时补抓. 指定 areas 时这些地区在各来源下完全没有数据也算缺口
+    """
+    areas = None if areas is None else list(areas)
+    if use_archive:
+        df = load_archive_times(start, end, areas, source)
+    else:
+        df = load_times(start, end, areas, source, engine)
+    sources = [source] if source is not None else list(CADENCE)
+    expected = None if areas is None else [(area, s) for area in areas for s in sources]
+    gaps = find_gaps(df, start, end, expected)
+    for (src, area, month), dates in days_by_month(gaps).items():
+        print(SOURCE_NAMES.get(src, src), area, month.strftime('%Y-%m'), ','.join(str(d.day) for d in dates))
+    logger.info(f'{df.shape[0]} observations, {len(gaps)} gaps, {sum(g.missing for g in gaps)} missing')
+    if fill:
+        logger.info(f'backfilled {backfill(gaps, engine, use_archive=use_archive)} rows')
+    return gaps
+
+
+if __name__ == '__main__':
+    run(datetime.datetime.strptime(sys.argv[1], '%Y-%m-%d'), datetime.datetime.strptime(sys.argv[2], '%Y-%m-%d'),
+        use_archive='--archive' in sys.argv, fill='--backfill' in sys.argv)
@@ -1,29 +1,55 @@
+import asyncio
+import datetime
 import decimal
 import json
 import os.path
 import random
 import re
+import sqlite3
+import sys
+import time
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
-import pandas as pd
 import requests
+from loguru import logger
 from sqlalchemy import select
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
+import metrics
+from async_crawl import AsyncFetcher, TokenBucket
 from models import Station, get_engine
+from writer import BulkWriter
+
+
+CUR_DIR = os.path.dirname(__file__)
+SOURCE = 'gd'
+# 待检索的车站和已确认查不到的车站
+STATION_CSV = os.path.join(CUR_DIR, 'station_all.csv')
+PASSED_PATH = os.path.join(CUR_DIR, 'passed_sts.txt')
 
 
 def load_cache() -> List[dict]:
-    path = os.path.join(os.path.dirname(__file__), 'station_position.json')
+    path = os.path.join(CUR_DIR, 'station_position.json')
     if not os.path.exists(path):
         return []
     return json.loads(Path(path).read_text(encoding='utf-8'))
 
 
+KEYS = ['40dc93a78162adf178137595ebc3af10', 'fef325053c296db5d899b7fbf5523e87']
+PLACE_URL = 'https://restapi.amap.com/v5/place/text'
+PLACE_TYPES = '150200|150600'
+
+# https://lbs.amap.com/api/webservice/guide/tools/info
+THROTTLE_CODES = {'10004', '10014', '10015', '10019', '10020', '10021', '10029'}
+QUOTA_CODES = {'10003', '10044', '10045'}
+INVALID_KEY_CODES = {'10001', '10002', '10009', '10010', '10012'}
+
+
 class GdApi:
     def __init__(self):
-        self.__keys = dict.fromkeys(['40dc93a78162adf178137595ebc3af10', 'fef325053c296db5d899b7fbf5523e87'], True)
+        self.__keys = dict.fromkeys(KEYS, True)
 
     def __select_key(self):
         keys = list(filter(lambda k: self.__keys[k], self.__keys.keys()))
@@ -33,20 +59,22 @@ class GdApi:
             raise ValueError('no key is valid')
 
     def placev2(self, station, city):
-        url = 'https://restapi.amap.com/v5/place/text'
-        key = self.__select_key()
-        params = {
-            'types': '150200|150600',
-            'keywords': station,
-            'key': key,
-            'region': city,
-        }
-        response = requests.get(url, params=params)
-        try:
-            return response.json()['pois']
-        except KeyError:
-            self.__keys[key] = False
-            return self.placev2(station, city)
+        while True:
+            key = self.__select_key()
+            params = {
+                'types': PLACE_TYPES,
+                'keywords': station,
+                'key': key,
+                'region': city,
+            }
+            with metrics.timer('crawl_fetch_seconds', crawler=SOURCE):
+                response = requests.get(PLACE_URL, params=params)
+            metrics.observe('crawl_response_bytes', len(response.content), crawler=SOURCE)
+            try:
+                return response.json()['pois']
+            except KeyError:
+                self.__keys[key] = False
+                metrics.inc('crawl_retries_total', crawler=SOURCE)
 
     def regeo(self):
         url = 'https://restapi.amap.com/v3/geocode/regeo'
@@ -57,60 +85,250 @@ class GdApi:
         requests.get(url, params=params).json()
 
 
-def place_station():
-    gd = GdApi()
-    sess = Session(get_engine())
+class GeoCache:
+    """
+    (keyword, region) -> pois 的本地持久化缓存, 重跑时不重复请求
+    """
+
+    def __init__(self, path: str = os.path.join(CUR_DIR, 'gd_cache.sqlite')):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS place (keyword TEXT NOT NULL, region TEXT NOT NULL, '
+                          'pois TEXT NOT NULL, update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP, '
+                          'PRIMARY KEY (keyword, region))')
+
+    def get(self, keyword: str, region: str) -> Optional[list]:
+        row = self.conn.execute('SELECT pois FROM place WHERE keyword = ? AND region = ?',
+                                (keyword, region)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, keyword: str, region: str, pois: list):
+        self.conn.execute('INSERT OR REPLACE INTO place (keyword, region, pois) VALUES (?, ?, ?)',
+                          (keyword, region, json.dumps(pois, ensure_ascii=False)))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class PlaceError(ValueError):
+    """
+    单个车站检索失败, key 全部不可用时仍抛出 ValueError
+    """
+
+
+class KeyState:
+    def __init__(self, key: str, qps: float, daily_quota: int):
+        self.key = key
+        self.bucket = TokenBucket(qps, qps)
+        self.daily_quota = daily_quota
+        self.used = 0
+        self.invalid = False
+        self.paused_until = 0.0
+        self.backoff = 0.0
+
+    def usable(self) -> bool:
+        return not self.invalid and self.used < self.daily_quota
+
+
+class KeyPool:
+    """
+    多个 key 轮流使用, 每个 key 单独限制 qps 和每日配额, 被限流时按指数退避暂停该 key
+    """
+
+    def __init__(self, keys: List[str], qps: float = 3, daily_quota: int = 5000, max_backoff: float = 60):
+        self.states = [KeyState(k, qps, daily_quota) for k in keys]
+        self.max_backoff = max_backoff
+        self.day = datetime.date.today()
+
+    def _roll_day(self):
+        today = datetime.date.today()
+        if today != self.day:
+            self.day = today
+            for state in self.states:
+                state.used = 0
+
+    async def acquire(self) -> KeyState:
+        while True:
+            self._roll_day()
+            states = [s for s in self.states if s.usable()]
+            if len(states) == 0:
+                raise ValueError('no key is valid')
+            now = time.monotonic()
+            ready = [s for s in states if s.paused_until <= now]
+            if len(ready) == 0:
+                await asyncio.sleep(min(s.paused_until for s in states) - now)
+                continue
+            state = min(ready, key=lambda s: s.used)
+            state.used += 1
+            await state.bucket.acquire()
+            return state
+
+    def report(self, state: KeyState, infocode: str):
+        if infocode in THROTTLE_CODES:
+            state.backoff = min(max(state.backoff * 2, 1), self.max_backoff)
+            state.paused_until = time.monotonic() + state.backoff * (0.5 + random.random())
+        elif infocode in QUOTA_CODES:
+            state.used = state.daily_quota
+        elif infocode in INVALID_KEY_CODES:
+            state.invalid = True
+        else:
+            state.backoff = 0
+
+
+class AsyncGdApi:
+    """
+    async with AsyncGdApi() as gd:
+        pois = await gd.placev2(station, city)
+    """
+
+    def __init__(self, keys: List[str] = None, qps: float = 3, daily_quota: int = 5000, concurrency: int = 8,
+                 max_retries: int = 5, cache: Optional[GeoCache] = None):
+        keys = keys or KEYS
+        self.pool = KeyPool(keys, qps, daily_quota)
+        self.max_retries = max_retries
+        self.cache = cache or GeoCache()
+        self.fetcher = AsyncFetcher(concurrency=concurrency, rate=qps * len(keys), burst=qps * len(keys))
+
+    async def __aenter__(self):
+        await self.fetcher.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.fetcher.__aexit__(exc_type, exc_val, exc_tb)
+        self.cache.close()
+
+    async def placev2(self, station: str, city: str) -> list:
+        pois = self.cache.get(station, city)
+        if pois is not None:
+            metrics.inc('crawl_cache_hits_total', crawler=SOURCE)
+            return pois
+        data = None
+        for _ in range(self.max_retries):
+            state = await self.pool.acquire()
+            params = {
+                'types': PLACE_TYPES,
+                'keywords': station,
+                'key': state.key,
+                'region': city,
+            }
+            with metrics.timer('crawl_fetch_seconds', crawler=SOURCE):
+                text = await self.fetcher.get(PLACE_URL, params=params)
+            metrics.observe('crawl_response_bytes', len(text.encode('utf-8')), crawler=SOURCE)
+            data = json.loads(text)
+            infocode = data.get('infocode')
+            if data.get('status') == '1' and data.get('pois') is not None:
+                self.pool.report(state, infocode)
+                self.cache.set(station, city, data['pois'])
+                return data['pois']
+            self.pool.report(state, infocode)
+            if infocode not in THROTTLE_CODES and infocode not in QUOTA_CODES and infocode not in INVALID_KEY_CODES:
+                # 服务错误或这次检索本身的错误, 与 key 无关, 不重试也不停用 key
+                raise PlaceError(f'{station} {city}: {data}')
+            metrics.inc('crawl_retries_total', crawler=SOURCE)
+        raise PlaceError(f'{station} {city}: {data}')
+
+
+@metrics.timed('crawl_plan_seconds', crawler=SOURCE)
+def _load_pending(sess: Session):
     handled_sts = set(sess.scalars(select(Station.station_name)))
-    p = os.path.join(os.path.dirname(__file__), 'passed_sts.txt')
-    if os.path.exists(p):
-        passed_sts = set(Path(p).read_text(encoding='utf-8').splitlines())
+    if os.path.exists(PASSED_PATH):
+        passed_sts = set(Path(PASSED_PATH).read_text(encoding='utf-8').splitlines())
     else:
         passed_sts = set()
-    df = pd.read_csv(os.path.join(os.path.dirname(__file__), 'station_all.csv')).drop_duplicates(subset=['station_name'])
-    sts = set()
+    import pandas as pd
+
+    df = pd.read_csv(STATION_CSV).drop_duplicates(subset=['station_name'])
+    pending = []
+    for idx, row in df.iterrows():
+        station, city = row['station_name'] + '站', row['city_name']
+        if station in handled_sts or station in passed_sts:
+            continue
+        pending.append((station, city))
+    return handled_sts, passed_sts, pending
+
+
+def _handle_pois(station, poss, handled_sts, passed_sts, writer: BulkWriter):
+    metrics.inc('crawl_units_total', crawler=SOURCE, status='ok')
+    pos = None
+    for p in poss:
+        if p.get('typecode') is not None and p['typecode'].startswith('1502'):
+            pos = p
+            break
+    # 没查到, 或查到但不是火车站
+    if pos is None:
+        passed_sts.add(station)
+        metrics.observe('crawl_rows', 0, crawler=SOURCE)
+        return
+    station_name, remark = pos['name'], None
+    match = re.search(r'(\(.+?\))', station_name)
+    if match is not None:
+        remark = match.group()[1:-1]
+        station_name = station_name.replace(match.group(), '')
+    metrics.observe('crawl_rows', int(station_name not in handled_sts), crawler=SOURCE)
+    if station_name not in handled_sts:
+        writer.add(
+            Station(adcode=pos['adcode'] + '0' * 6, pname=pos['pname'], city_name=pos['cityname'],
+                    adname=pos['adname'],
+                    station_name=station_name, longitude=decimal.Decimal(pos['location'].split(',')[0]),
+                    latitude=decimal.Decimal(pos['location'].split(',')[1]), remark=remark,
+                    address=pos['address']))
+
+
+def place_station(engine: Engine = None):
+    gd = GdApi()
+    sess = Session(engine or get_engine())
+    handled_sts, passed_sts, pending = _load_pending(sess)
+    writer = BulkWriter(sess.get_bind(), Station, ('station_name',), batch_size=100)
     try:
-        for idx, row in df.iterrows():
-            station, city = row['station_name'] + '站', row['city_name']
-            if station in handled_sts or station in passed_sts:
-                continue
-            poss, pos = gd.placev2(station, city), None
+        for station, city in pending:
+            poss = gd.placev2(station, city)
             print(poss)
-            # 没查到
-            if len(poss) == 0:
-                passed_sts.add(station)
-                continue
-            for p in poss:
-                if p.get('typecode') is not None and p['typecode'].startswith('1502'):
-                    pos = p
-                    break
-            # 查到但不是火车站
-            if pos is None:
-                passed_sts.add(station)
-                continue
-            station_name, remark = pos['name'], None
-            match = re.search(r'(\(.+?\))', station_name)
-            if match is not None:
-                remark = match.group()[1:-1]
-                station_name = station_name.replace(match.group(), '')
-            if station_name not in handled_sts:
-                sts.add(
-                    Station(adcode=pos['adcode'] + '0' * 6, pname=pos['pname'], city_name=pos['cityname'],
-                            adname=pos['adname'],
-                            station_name=station_name, longitude=decimal.Decimal(pos['location'].split(',')[0]),
-                            latitude=decimal.Decimal(pos['location'].split(',')[1]), remark=remark,
-                            address=pos['address']))
-
-            if len(sts) >= 100:
-                sess.add_all(sts)
-                sess.commit()
-                sts.clear()
+            _handle_pois(station, poss, handled_sts, passed_sts, writer)
     finally:
-        if len(sts) != 0:
-            sess.add_all(sts)
-            sess.commit()
-        Path(os.path.dirname(__file__), 'passed_sts.txt').write_text('\n'.join(passed_sts), encoding='utf-8')
+        writer.close()
+        Path(PASSED_PATH).write_text('\n'.join(passed_sts), encoding='utf-8')
         sess.close()
 
 
+async def _place_station_async(concurrency: int, engine: Engine = None):
+    sess = Session(engine or get_engine())
+    handled_sts, passed_sts, pending = _load_pending(sess)
+    writer = BulkWriter(sess.get_bind(), Station, ('station_name',), batch_size=100)
+
+    async def place(station, city):
+        try:
+            return station, await gd.placev2(station, city)
+        except PlaceError as e:
+            # 只跳过这个车站, 不记入 passed, 下次运行重新检索
+            logger.error(repr(e))
+            metrics.inc('crawl_units_total', crawler=SOURCE, status='failed')
+            return station, None
+
+    try:
+        async with AsyncGdApi(concurrency=concurrency) as gd:
+            tasks = [asyncio.ensure_future(place(station, str(city))) for station, city in pending]
+            try:
+                for coro in asyncio.as_completed(tasks):
+                    station, poss = await coro
+                    if poss is None:
+                        continue
+                    _handle_pois(station, poss, handled_sts, passed_sts, writer)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        writer.close()
+        Path(PASSED_PATH).write_text('\n'.join(passed_sts), encoding='utf-8')
+        sess.close()
+
+
+def place_station_async(concurrency: int = 8, engine: Engine = None):
+    asyncio.run(_place_station_async(concurrency, engine))
+
+
 if __name__ == '__main__':
-    place_station()
+    if '--async' in sys.argv:
+        place_station_async()
+    else:
+        place_station()
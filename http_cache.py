@@ -0,0 +1,178 @@
+import json
+import os
+import re
+import sqlite3
+import time
+import zlib
+from email.utils import formatdate
+from typing import Callable, List, NamedTuple, Optional, Tuple, Union
+from urllib.parse import urlencode, urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+import metrics
+from throttle import AdaptiveThrottle
+
+CUR_DIR = os.path.dirname(__file__)
+
+DAY = 24 * 3600
+
+# ttl 为秒数, 或者 url -> 秒数 的函数, 返回 None 表示不缓存
+Rule = Tuple[str, Union[float, Callable[[str], Optional[float]]]]
+
+
+class CacheEntry(NamedTuple):
+    status: int
+    headers: dict
+    body: bytes
+    stored_at: float
+    expires_at: float
+
+    @property
+    def fresh(self) -> bool:
+        return time.time() < self.expires_at
+
+    def conditional_headers(self) -> dict:
+        headers = CaseInsensitiveDict(self.headers)
+        ret = {}
+        if headers.get('ETag') is not None:
+            ret['If-None-Match'] = headers['ETag']
+        if headers.get('Last-Modified') is not None:
+            ret['If-Modified-Since'] = headers['Last-Modified']
+        elif len(ret) == 0:
+            ret['If-Modified-Since'] = formatdate(self.stored_at, usegmt=True)
+        return ret
+
+    def charset(self) -> str:
+        content_type = CaseInsensitiveDict(self.headers).get('Content-Type', '')
+        match = re.search(r'charset=["\']?([\w-]+)', content_type, re.I)
+        return 'utf-8' if match is None else match.group(1)
+
+
+def cache_key(url: str, params: Optional[dict] = None) -> str:
+    if not params:
+        return url
+    return url + ('&' if '?' in url else '?') + urlencode(sorted(params.items()))
+
+
+class HttpCache:
+    """
+    基于 sqlite 的 GET 响应缓存, 响应体 zlib 压缩存储, 按 url 正则配置 ttl, 过期后用 ETag/Last-Modified 条件请求重新验证
+
+    cache = HttpCache(rules=[(r'^https://lishi\\.tianqi\\.com/$', DAY)])
+    """
+
+    def __init__(self, path: str = os.path.join(CUR_DIR, 'http_cache.sqlite'), rules: List[Rule] = ()):
+        self.rules = [(re.compile(pattern), ttl) for pattern, ttl in rules]
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS response (url TEXT PRIMARY KEY, status INTEGER NOT NULL, '
+                          'headers TEXT NOT NULL, body BLOB NOT NULL, stored_at REAL NOT NULL, '
+                          'expires_at REAL NOT NULL)')
+        self.conn.commit()
+
+    def ttl(self, url: str) -> Optional[float]:
+        for pattern, ttl in self.rules:
+            if pattern.search(url):
+                return ttl(url) if callable(ttl) else ttl
+        return None
+
+    def lookup(self, key: str) -> Optional[CacheEntry]:
+        row = self.conn.execute('SELECT status, headers, body, stored_at, expires_at FROM response WHERE url = ?',
+                                (key,)).fetchone()
+        if row is None:
+            return None
+        status, headers, body, stored_at, expires_at = row
+        return CacheEntry(status, json.loads(headers), zlib.decompress(body), stored_at, expires_at)
+
+    def store(self, key: str, status: int, headers: dict, body: bytes, ttl: float) -> CacheEntry:
+        now = time.time()
+        headers = {k: v for k, v in headers.items() if k.lower() not in ('content-encoding', 'content-length',
+                                                                          'transfer-encoding', 'set-cookie')}
+        self.conn.execute('INSERT OR REPLACE INTO response (url, status, headers, body, stored_at, expires_at) '
+                          'VALUES (?, ?, ?, ?, ?, ?)',
+                          (key, status, json.dumps(headers), zlib.compress(body), now, now + ttl))
+        self.conn.commit()
+        return CacheEntry(status, headers, body, now, now + ttl)
+
+    def refresh(self, key: str, entry: CacheEntry, ttl: float) -> CacheEntry:
+        """
+        304 之后只更新过期时间
+        """
+        expires_at = time.time() + ttl
+        self.conn.execute('UPDATE response SET expires_at = ? WHERE url = ?', (expires_at, key))
+        self.conn.commit()
+        return entry._replace(expires_at=expires_at)
+
+    def close(self):
+        self.conn.close()
+
+
+class CachedSession(requests.Session):
+    """
+    GET 请求先查 HttpCache, 未命中规则的请求与普通 Session 相同, 命中缓存的响应 from_cache 为 True,
+    配置了 throttle 时实际发出的请求按 host 自适应限速
+    """
+
+    def __init__(self, cache: HttpCache, throttle: Optional[AdaptiveThrottle] = None):
+        super().__init__()
+        self.cache = cache
+        self.throttle = throttle
+
+    def _send(self, method, url, params=None, **kwargs) -> requests.Response:
+        host = urlsplit(url).hostname
+        if self.throttle is None:
+            response = super().request(method, url, params=params, **kwargs)
+            metrics.inc('http_requests_total', host=host, status=response.status_code)
+            return response
+        with metrics.timer('http_throttle_wait_seconds', host=host):
+            self.throttle.wait(host)
+        start = time.monotonic()
+        try:
+            response = super().request(method, url, params=params, **kwargs)
+        except requests.RequestException:
+            self.throttle.finish(host, None, time.monotonic() - start)
+            metrics.inc('http_requests_total', host=host, status='error')
+            raise
+        self.throttle.finish(host, response.status_code, response.elapsed.total_seconds(),
+                             response.headers.get('Retry-After'))
+        metrics.inc('http_requests_total', host=host, status=response.status_code)
+        return response
+
+    def request(self, method, url, params=None, **kwargs):
+        if method.upper() != 'GET':
+            return self._send(method, url, params=params, **kwargs)
+        ttl = self.cache.ttl(url)
+        if ttl is None:
+            response = self._send(method, url, params=params, **kwargs)
+            response.from_cache = False
+            return response
+
+        key = cache_key(url, params)
+        entry = self.cache.lookup(key)
+        if entry is not None and entry.fresh:
+            metrics.inc('http_cache_hits_total')
+            return self._to_response(entry, key)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry is not None:
+            headers.update(entry.conditional_headers())
+        response = self._send(method, url, params=params, headers=headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            return self._to_response(self.cache.refresh(key, entry, ttl), key)
+        if response.status_code == 200:
+            self.cache.store(key, response.status_code, dict(response.headers), response.content, ttl)
+        response.from_cache = False
+        return response
+
+    @staticmethod
+    def _to_response(entry: CacheEntry, key: str) -> requests.Response:
+        response = requests.Response()
+        response.status_code = entry.status
+        response.headers = CaseInsensitiveDict(entry.headers)
+        response._content = entry.body
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = key
+        response.from_cache = True
+        return response
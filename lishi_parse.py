@@ -0,0 +1,138 @@
+import datetime
+from typing import List, Optional
+
+from lxml import etree, html
+
+from records import DailyRecord
+
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def _has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# 等价于 css: body > div.main.clearfix > div.main_left.inleft > div.tian_three > ul > li
+ROWS = etree.XPath(
+    'descendant-or-self::body'
+    f'/div[{_has_class("main")} and {_has_class("clearfix")}]'
+    f'/div[{_has_class("main_left")} and {_has_class("inleft")}]'
+    f'/div[{_has_class("tian_three")}]'
+    '/ul/li')
+
+_PARSER = html.HTMLParser(recover=True, encoding='utf-8')
+
+
+def _first_text(el) -> Optional[str]:
+    """
+    与 css 的 ::text 取第一个文本节点一致
+    """
+    if el.text is not None:
+        return el.text
+    for child in el:
+        if child.tail is not None:
+            return child.tail
+    return None
+
+
+def _cells(li):
+    """
+    li 的前五个子元素, 不是 div 的位置为 None, 与 div:nth-child(n) 一致
+    """
+    cells = [None] * 5
+    i = 0
+    for child in li:
+        if not isinstance(child.tag, str):
+            continue
+        if i >= 5:
+            break
+        if child.tag == 'div':
+            cells[i] = _first_text(child)
+        i += 1
+    return cells
+
+
+def parse_date(s: str) -> datetime.date:
+    """
+    固定格式 yyyy-mm-dd 直接切片, 其余情况交给 strptime
+    """
+    if len(s) == 10 and s[4] == '-' and s[7] == '-':
+        try:
+            return datetime.date(int(s[:4]), int(s[5:7]), int(s[8:]))
+        except ValueError:
+            pass
+    return datetime.datetime.strptime(s, DATE_FORMAT).date()
+
+
+def _parse_temp(s: Optional[str]) -> Optional[int]:
+    if s is None:
+        return None
+    try:
+        return int(s.strip()[:-1])
+    except ValueError:
+        return None
+
+
+def parse_month_page(text: str, area_name: str) -> List[DailyRecord]:
+    """
+    lishi.tianqi.com 月份页面, 一次遍历取出所有行, 结果与 parse_month_page_selector 相同
+    """
+    body = text.strip().replace('\x00', '')
+    if body == '':
+        return []
+    root = etree.fromstring(body.encode('utf-8'), parser=_PARSER)
+    if root is None:
+        return []
+    ls = []
+    for li in ROWS(root):
+        date, max_temp, min_temp, weather, wind = _cells(li)
+        date = date.strip()
+        if date.find(' ') != -1:
+            date = date.split()[0]
+        if weather is not None:
+            weather = weather.strip()
+        if wind is not None:
+            wind = wind.strip()
+        ls.append(DailyRecord(area_name, parse_date(date), _parse_temp(max_temp), _parse_temp(min_temp), weather, wind))
+    return ls
+
+
+def parse_month_page_selector(text: str, area_name: str) -> List[DailyRecord]:
+    """
+    原先基于 scrapy Selector 的实现, 保留作为对照
+    """
+    from scrapy import Selector
+
+    ls = []
+    selector = Selector(text=text)
+    for li in selector.css('body > div.main.clearfix > div.main_left.inleft > div.tian_three > ul > li'):
+        date = li.css('div:nth-child(1)::text').get().strip()
+        if date.find(' ') != -1:
+            date = date.split()[0]
+        date = datetime.datetime.strptime(date, DATE_FORMAT).date()
+        max_temp = li.css('div:nth-child(2)::text').get()
+        if max_temp is not None:
+            max_temp = max_temp.strip()[:-1]
+            try:
+                max_temp = int(max_temp)
+            except ValueError:
+                max_temp = None
+        min_temp = li.css('div:nth-child(3)::text').get()
+        if min_temp is not None:
+            min_temp = min_temp.strip()[:-1]
+            try:
+                min_temp = int(min_temp)
+            except ValueError:
+                min_temp = None
+        weather = li.css('div:nth-child(4)::text').get()
+        if weather is not None:
+            weather = weather.strip()
+        wind = li.css('div:nth-child(5)::text').get()
+        if wind is not None:
+            wind = wind.strip()
+
+        ls.append(
+            DailyRecord(area_name=area_name, wdate=date, weather=weather, max_temp=max_temp,
+                        min_temp=min_temp,
+                        wind=wind))
+    return ls
@@ -0,0 +1,245 @@
+"""
+抓取流程的计时/计数/直方图指标, 默认关闭, 关闭时每个埋点只有一次函数调用和一次判断
+
+metrics.enable('prom', 'metrics.prom')    # 或设置环境变量 WEATHER_METRICS=prom|json, WEATHER_METRICS_OUT=路径
+with metrics.timer('crawl_fetch_seconds', crawler='history'):
+    ...
+metrics.inc('crawl_retries_total', crawler='history')
+metrics.observe('crawl_response_bytes', len(body), crawler='history')
+
+启用后进程退出时按格式写到文件(没有指定时写 stderr), 也可以随时调用 prometheus() / summary().
+直方图的分桶按名字后缀选择: _seconds 按耗时, _bytes 按字节数, 其它按个数
+"""
+import atexit
+import bisect
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from functools import wraps
+from typing import Dict, Optional, Sequence, Tuple
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(9))
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def buckets_for(name: str) -> Sequence[float]:
+    if name.endswith('_seconds'):
+        return TIME_BUCKETS
+    if name.endswith('_bytes'):
+        return BYTES_BUCKETS
+    return COUNT_BUCKETS
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'min', 'max')
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # 最后一个是 +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None or value < self.min else self.min
+        self.max = value if self.max is None or value > self.max else self.max
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        按分桶估计, 返回所在桶的上界, 落在 +Inf 桶时返回最大值
+        """
+        if self.count == 0:
+            return None
+        rank, seen = q * self.count, 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count != 0:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+
+def _key(name: str, labels: dict) -> Key:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _labels_text(labels, extra: str = '') -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Registry:
+    def __init__(self):
+        self.counters: Dict[Key, float] = {}
+        self.histograms: Dict[Key, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets_for(name))
+            histogram.observe(value)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def prometheus(self) -> str:
+        lines, typed = [], set()
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} counter')
+                lines.append(f'{name}{_labels_text(labels)} {_number(value)}')
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} histogram')
+                cumulative = 0
+                for bound, count in zip(list(h.buckets) + ['+Inf'], h.counts):
+                    cumulative += count
+                    le = 'le="%s"' % (bound if isinstance(bound, str) else _number(bound))
+                    lines.append(f'{name}_bucket{_labels_text(labels, le)} {cumulative}')
+                lines.append(f'{name}_sum{_labels_text(labels)} {_number(h.sum)}')
+                lines.append(f'{name}_count{_labels_text(labels)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> dict:
+        with self._lock:
+            counters = {name + _labels_text(labels): value for (name, labels), value in sorted(self.counters.items())}
+            histograms = {name + _labels_text(labels): dict(
+                count=h.count, sum=round(h.sum, 6), mean=round(h.sum / h.count, 6), min=round(h.min, 6),
+                max=round(h.max, 6), p50=round(h.quantile(0.5), 6), p95=round(h.quantile(0.95), 6))
+                for (name, labels), h in sorted(self.histograms.items())}
+        return dict(counters=counters, histograms=histograms)
+
+
+REGISTRY = Registry()
+_enabled = False
+_output: Tuple[str, Optional[str]] = ('json', None)
+_registered = False
+
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        REGISTRY.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+_NOOP = contextlib.nullcontext()
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def inc(name: str, value: float = 1, **labels):
+    if _enabled:
+        REGISTRY.inc(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    if _enabled:
+        REGISTRY.observe(name, value, **labels)
+
+
+def timer(name: str, **labels):
+    if not _enabled:
+        return _NOOP
+    return _Timer(name, labels)
+
+
+def timed(name: str, **labels):
+    """
+    函数计时的装饰器, 是否记录在调用时判断
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Timer(name, labels):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def prometheus() -> str:
+    return REGISTRY.prometheus()
+
+
+def summary() -> dict:
+    return REGISTRY.summary()
+
+
+def dump(fmt: Optional[str] = None, out: Optional[str] = None):
+    fmt, out = fmt or _output[0], out or _output[1]
+    text = prometheus() if fmt == 'prom' else json.dumps(summary(), ensure_ascii=False, indent=2) + '\n'
+    if out is None:
+        sys.stderr.write(text)
+        return
+    with open(out, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def enable(fmt: str = 'json', out: Optional[str] = None):
+    """
+    开始记录, 进程退出时按 fmt(prom 或 json) 输出到 out
+    """
+    global _enabled, _output, _registered
+    if fmt not in ('prom', 'json'):
+        raise ValueError(f'unknown metrics format: {fmt}')
+    _enabled, _output = True, (fmt, out)
+    if not _registered:
+        _registered = True
+        atexit.register(lambda: _enabled and dump())
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+if os.environ.get('WEATHER_METRICS'):
+    enable(os.environ['WEATHER_METRICS'], os.environ.get('WEATHER_METRICS_OUT'))
@@ -1,11 +1,11 @@
 import configparser
-import copy
 import datetime
 import decimal
 import os
 from urllib.parse import quote_plus
 
-from sqlalchemy import Integer, VARCHAR, Date, DateTime, CHAR, Float, create_engine, DECIMAL
+from sqlalchemy import Integer, VARCHAR, Date, DateTime, CHAR, Float, create_engine, DECIMAL, UniqueConstraint, \
+    Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 __engine = None
@@ -23,6 +23,7 @@ class Base(DeclarativeBase):
 
 class Station(Base):
     __tablename__ = 'station'
+    __table_args__ = (UniqueConstraint('station_name', name='uk_station_name'),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False, autoincrement=True)
     station_name: Mapped[str] = mapped_column(VARCHAR(7), nullable=False)
     pname: Mapped[str] = mapped_column(VARCHAR(15), nullable=False, comment='省', default='')
@@ -67,13 +68,19 @@ class WeatherRecordHour(Base):
     `weather`     varchar(31) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NULL COMMENT '天气情况',
     `source`      char(1)                                                      not null COMMENT '0 -> wunderground.com, 1 -> 和风api',
     `create_time` datetime                                                     NOT NULL DEFAULT CURRENT_TIMESTAMP,
-    PRIMARY KEY (`id`) USING BTREE
+    PRIMARY KEY (`id`) USING BTREE,
+    UNIQUE KEY `uk_weather_hour_area_time_source` (`area`, `obs_time`, `source`),
+    KEY `idx_weather_hour_code_time` (`code`, `obs_time`),
+    KEY `idx_weather_hour_create_time` (`create_time`)
 ) ENGINE = InnoDB
   DEFAULT CHARSET = utf8mb4
   COLLATE = utf8mb4_general_ci
   ROW_FORMAT = DYNAMIC;
     """
     __tablename__ = 'weather_hour'
+    __table_args__ = (UniqueConstraint('area', 'obs_time', 'source', name='uk_weather_hour_area_time_source'),
+                      Index('idx_weather_hour_code_time', 'code', 'obs_time'),
+                      Index('idx_weather_hour_create_time', 'create_time'))
     id: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False, autoincrement=True)
     area: Mapped[str] = mapped_column(VARCHAR(31), nullable=False)
     code: Mapped[str] = mapped_column(CHAR(12), nullable=False)
@@ -97,14 +104,12 @@ class WeatherRecordHour(Base):
     __repr__ = __str__
 
     def to_csv_string(self):
-        d = copy.deepcopy(self.__dict__)
-        if '_sa_instance_state' in d:
-            d.pop('_sa_instance_state')
-        return ','.join(map(str, d.values()))
+        return ','.join(str(v) for k, v in self.__dict__.items() if k != '_sa_instance_state')
 
 
 class Area(Base):
     __tablename__ = 'area'
+    __table_args__ = (UniqueConstraint('code', name='uk_area_code'),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False, autoincrement=True)
     code: Mapped[str] = mapped_column(CHAR(12), nullable=False)
     name: Mapped[str] = mapped_column(VARCHAR(15), nullable=False)
@@ -120,6 +125,7 @@ class Area(Base):
 
 class WeatherRecord(Base):
     __tablename__ = 'weather'
+    __table_args__ = (UniqueConstraint('area_name', 'wdate', name='uk_weather_area_date'),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False, autoincrement=True)
     wdate: Mapped[datetime.date] = mapped_column(Date, nullable=False)
     area_name: Mapped[str] = mapped_column(VARCHAR(31), nullable=False)
@@ -135,6 +141,42 @@ class WeatherRecord(Base):
     __repr__ = __str__
 
 
+class WeatherDaily(Base):
+    """
+    由 weather_hour 按 (地区, 日期, 来源) 汇总的日数据, 由 rollup.py 增量维护
+    """
+    __tablename__ = 'weather_daily'
+    __table_args__ = (UniqueConstraint('area', 'wdate', 'source', name='uk_weather_daily_area_date_source'),
+                      Index('idx_weather_daily_code_date', 'code', 'wdate'))
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False, autoincrement=True)
+    area: Mapped[str] = mapped_column(VARCHAR(31), nullable=False)
+    code: Mapped[str] = mapped_column(CHAR(12), nullable=True)
+    wdate: Mapped[datetime.date] = mapped_column(Date, nullable=False)
+    source: Mapped[str] = mapped_column(CHAR(1), nullable=False)
+    max_temp: Mapped[int] = mapped_column(Integer, nullable=True)
+    min_temp: Mapped[int] = mapped_column(Integer, nullable=True)
+    precip: Mapped[float] = mapped_column(Float, nullable=True)
+    weather: Mapped[str] = mapped_column(VARCHAR(31), nullable=True, comment='出现次数最多的天气')
+    wind: Mapped[str] = mapped_column(VARCHAR(31), nullable=True, comment='出现次数最多的风向')
+    obs_count: Mapped[int] = mapped_column(Integer, nullable=False, comment='参与汇总的观测数')
+    update_time: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=False, default=datetime.datetime.now)
+
+    def __str__(self):
+        return f'{self.area}: {self.wdate.strftime("%Y-%m-%d")}({self.source})'
+
+    __repr__ = __str__
+
+
+class Watermark(Base):
+    """
+    增量任务的水位线, 如 rollup 已处理到的 weather_hour.create_time
+    """
+    __tablename__ = 'watermark'
+    name: Mapped[str] = mapped_column(VARCHAR(31), primary_key=True, nullable=False)
+    value: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=False)
+    update_time: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=False, default=datetime.datetime.now)
+
+
 def get_engine(echo=False):
     global __engine
     if __engine is None:
@@ -143,5 +185,4 @@ def get_engine(echo=False):
         __engine = create_engine("mysql+pymysql://%s:%s@%s:%s/%s" % (
             mysql_auth['username'], quote_plus(mysql_auth['password']), mysql_auth['host'], mysql_auth['port'],
             mysql_auth['database']), echo=echo)
-        Base.metadata.create_all(__engine)
     return __engine
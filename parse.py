@@ -1,16 +1,15 @@
-import datetime
 import decimal
-import glob
 import json
 import os
 import re
 from pathlib import Path
 
-import pandas as pd
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
-from models import Area, get_engine, WeatherRecordHour, Station, WeatherRecord
+from area_index import AreaIndex
+from models import Area, get_engine, Station, WeatherRecord
+from writer import BulkWriter
 
 
 def parse_area():
@@ -29,15 +28,14 @@ def parse_area():
 
     print(areas)
 
-    engine = get_engine(echo=False)
-
-    with Session(engine) as sess:
-        sess.add_all(areas)
-        sess.commit()
+    with BulkWriter(get_engine(echo=False), Area, ('code',)) as writer:
+        writer.add_all(areas)
 
 
 def ck_format():
     import csv
+
+    import pandas as pd
     dtype = {'code': str, 'temprature': 'Int64', 'feels_like': 'Int64', 'dewpoint': 'Int64',
              'humidity': 'Int64',
              'wind_dir': 'Int64', 'wind_speed': 'Int64', 'pressure': 'Float64',
@@ -72,66 +70,31 @@ def parse_weather_hour():
                             }
     """
 
-    def find_area(src):
-        target = None
-        for a in areas:
-            if src.find(a.name) != -1 or a.name.find(src) != -1:
-                if target is None:
-                    target = a
-                else:
-                    raise ValueError(src + " " + target.name + ' ' + a.name)
-        if target is None:
-            raise ValueError(city)
-        return target
+    import pandas as pd
+
+    import archive
+    from raw_store import RawStore
+    from wu_convert import convert_observations, iter_months
 
     engine = get_engine()
     sess = Session(engine)
-    areas = []
-    areas = list(sess.scalars(select(Area).where(Area.level == 2)))
-
-    if not os.path.exists('csv/weather_hour.csv'):
-        with open('csv/weather_hour.csv', 'w', encoding='utf-8') as f:
-            f.write(','.join((
-                'area', 'code', 'obs_time', 'temprature', 'feels_like', 'dewpoint', 'humidity', 'wind', 'wind_dir',
-                'wind_speed', 'pressure', 'precip', 'weather', 'source')) + '\n')
+    area_index = AreaIndex.from_session(sess)
 
-    handled_cities = pd.read_csv('csv/weather_hour.csv')['area'].drop_duplicates().values.tolist()
+    # 已归档完成的城市直接跳过, 每个城市处理完整后一次写入归档
+    handled_cities = archive.done_areas()
     print(handled_cities)
 
-    f = open('csv/weather_hour.csv', 'a', encoding='utf-8')
-
-    data_dir = os.path.join(os.path.dirname(__file__), 'data')
-    for city in os.listdir(data_dir):
+    store = RawStore()
+    for city in store.cities():
         if city in handled_cities:
             continue
-        for file in glob.glob(os.path.join(os.path.join(data_dir, city, '*.json'))):
-            items = []
-            js = json.loads(Path(file).read_text(encoding='utf-8'))
-            obss = js.get('observations')
-            if obss is None:
-                continue
-            for obs in obss:
-                params = dict()
-                params['area'] = city
-                params['code'] = find_area(city).code
-                params['obs_time'] = datetime.datetime.fromtimestamp(obs['valid_time_gmt'])
-                params['temperature'] = int(round((obs['temp'] - 32) / 1.8, 0)) if obs['temp'] is not None else None
-                params['feels_like'] = int(round((obs['feels_like'] - 32) / 1.8, 0)) if obs[
-                                                                                            'feels_like'] is not None else None
-                params['dewpoint'] = int(round((obs['dewPt'] - 32) / 1.8, 0)) if obs['dewPt'] is not None else None
-                params['humidity'] = obs['rh']
-                params['wind'] = obs['wdir_cardinal']
-                params['wind_dir'] = obs['wdir']
-                params['wind_speed'] = int(round(obs['wspd'] * 1.609344, 0)) if obs['wspd'] is not None else None
-                params['pressure'] = obs['pressure']
-                params['precip'] = 0 if obs.get('precip_total') is None else obs.get('precip_total')
-                params['weather'] = obs['wx_phrase']
-                params['source'] = '0'
-                r = WeatherRecordHour(**params)
-                items.append(r)
-            f.write('\n'.join(map(lambda r: r.to_csv_string(), items)) + '\n')
-            f.flush()
-            print(file)
+        dfs = []
+        for month, obss in iter_months(city, store.root):
+            dfs.append(convert_observations(obss, city, area_index.find(city).code))
+            print(city, month)
+        if len(dfs) != 0:
+            with archive.staging() as tmp:
+                archive.write(pd.concat(dfs, ignore_index=True), tmp)
 
     sess.close()
     # WeatherRecordHour(**params)
@@ -140,7 +103,7 @@ def parse_weather_hour():
 def parse_station_pos():
     path = os.path.join(os.path.dirname(__file__), 'data', 'json', 'station_pos.json')
     data = json.loads(Path(path).read_text(encoding='utf-8'))
-    sts = []
+    writer = BulkWriter(get_engine(True), Station, ('station_name',))
     for station, poss in data.items():
         pos = None
         for p in poss:
@@ -154,27 +117,24 @@ def parse_station_pos():
         if match is not None:
             remark = match.group()[1:-1]
             station_name = station_name.replace(match.group(), '')
-        sts.append(Station(adcode=pos['adcode'], pname=pos['pname'], city_name=pos['cityname'], adname=pos['adname'],
+        writer.add(Station(adcode=pos['adcode'], pname=pos['pname'], city_name=pos['cityname'], adname=pos['adname'],
                            station_name=station_name, longitude=decimal.Decimal(pos['location'].split(',')[0]),
                            latitude=decimal.Decimal(pos['location'].split(',')[1]), remark=remark,
                            address=pos['address']))
-        with Session(get_engine(True)) as sess:
-            sess.add_all(sts)
-            sess.commit()
+    writer.close()
 
 
 def map_adcode():
     session = Session(get_engine())
     area_names = list(session.scalars(select(WeatherRecord.area_name).distinct()))
-    areas = list(session.scalars(select(Area)))
+    area_index = AreaIndex.from_session(session, level=None)
     mp = {}
     for area_name in area_names:
-        for area in areas:
-            if area.name.find(area_name) != -1:
-                if mp.get(area_name) is None:
-                    mp[area_name] = area
-                else:
-                    print(area_name + ' ' + area.name + ' ' + str(mp[area_name]))
+        for area in area_index.containing(area_name):
+            if mp.get(area_name) is None:
+                mp[area_name] = area
+            else:
+                print(area_name + ' ' + area.name + ' ' + str(mp[area_name]))
 
     print(mp)
 
@@ -0,0 +1,65 @@
+import calendar
+import datetime
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from models import WeatherRecord
+
+
+class CrawlUnit(NamedTuple):
+    area: str
+    pinyin: str
+    month: datetime.date
+    dates: Set[datetime.date]
+
+
+def iter_months(start_date: datetime.date, end_date: datetime.date) -> Iterator[datetime.date]:
+    date = start_date
+    while date <= end_date:
+        yield date
+        date += relativedelta(months=1)
+
+
+def load_coverage(sess: Session, areas: Iterable[str], start_date: datetime.date,
+                  end_date: datetime.date) -> Dict[Tuple[str, int, int], int]:
+    """
+    一次流式扫描读出 areas 在日期范围内已有的 wdate, 按 (area, year, month) 存成位图, 第 n 位表示该月第 n+1 天已有数据
+    """
+    coverage = defaultdict(int)
+    first = datetime.date(start_date.year, start_date.month, 1)
+    last = datetime.date(end_date.year, end_date.month, calendar.monthrange(end_date.year, end_date.month)[1])
+    stmt = select(WeatherRecord.area_name, WeatherRecord.wdate).where(
+        WeatherRecord.area_name.in_(list(areas)), WeatherRecord.wdate >= first, WeatherRecord.wdate <= last)
+    for area, wdate in sess.execute(stmt.execution_options(yield_per=10000)):
+        coverage[(area, wdate.year, wdate.month)] |= 1 << (wdate.day - 1)
+    return coverage
+
+
+def missing_dates(bitmap: int, month: datetime.date, today: datetime.date) -> Set[datetime.date]:
+    day_count = calendar.monthrange(month.year, month.month)[1]
+    if month.year == today.year and month.month == today.month:
+        day_count = today.day
+    elif (month.year, month.month) > (today.year, today.month):
+        return set()
+    missing = ~bitmap & ((1 << day_count) - 1)
+    return set(datetime.date(month.year, month.month, i + 1) for i in range(day_count) if missing >> i & 1)
+
+
+def plan_gaps(sess: Session, areas: Dict[str, str], start_date: datetime.date, end_date: datetime.date,
+              today: Optional[datetime.date] = None) -> List[CrawlUnit]:
+    """
+    areas 为 {地区名: 拼音}, 返回所有缺数据的 (地区, 月份) 抓取单元, 顺序与 areas 一致, 整个规划只查询一次数据库
+    """
+    today = today or datetime.date.today()
+    coverage = load_coverage(sess, areas.keys(), start_date, end_date)
+    units = []
+    for area, pinyin in areas.items():
+        for month in iter_months(start_date, end_date):
+            dates = missing_dates(coverage.get((area, month.year, month.month), 0), month, today)
+            if len(dates) != 0:
+                units.append(CrawlUnit(area, pinyin, month, dates))
+    return units
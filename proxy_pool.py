@@ -0,0 +1,195 @@
+"""
+代理池, 按成功率和延迟给代理打分, 请求分散到健康的代理上, 连续失败的代理被剔除, 一段时间后重新检测
+
+pool = ProxyPool(['http://127.0.0.1:7890', 'http://127.0.0.1:7891'])
+proxy = pool.pick()
+... requests.get(url, proxies=proxy.proxies) ...
+pool.report(proxy, ok, latency)
+
+代理列表在 db.conf 的 [proxy] 节配置, urls 用逗号分隔
+"""
+import math
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+import requests
+from loguru import logger
+
+DEFAULT_PROXIES = ['http://127.0.0.1:7890']
+TEST_URL = 'https://www.wunderground.com/'
+
+
+class NoProxyAvailable(RuntimeError):
+    pass
+
+
+class Proxy:
+    def __init__(self, url: str):
+        if '://' not in url:
+            url = 'http://' + url
+        self.url = url
+        self.proxies = {'http': url, 'https': url}
+        self.success = 1.0
+        self.latency: Optional[float] = None
+        self.inflight = 0
+        self.failures = 0
+        self.requests = 0
+        self.evicted_until: Optional[float] = None
+        self.evictions = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.evicted_until is None
+
+    def score(self) -> float:
+        """
+        成功率 / 延迟, 并发中的请求越多分数越低. 还没有成功过的代理分数最高, 先试几次, 失败够次数会被剔除
+        """
+        if self.latency is None:
+            return math.inf
+        return self.success / (self.latency * (1 + self.inflight))
+
+    def __repr__(self):
+        latency = 'n/a' if self.latency is None else f'{self.latency:.2f}s'
+        return (f'Proxy({self.url}, success={self.success:.2f}, latency={latency}, requests={self.requests}, '
+                f'healthy={self.healthy})')
+
+
+def check_proxy(proxy: Proxy, url: str = TEST_URL, timeout: float = 10) -> bool:
+    response = requests.get(url, proxies=proxy.proxies, timeout=timeout)
+    return response.status_code < 500
+
+
+class ProxyPool:
+    """
+    pick 在健康的代理里随机取两个, 选分数高的(power of two choices), 既偏向快的代理又不会把请求全压在一个代理上.
+    成功率和延迟都是指数滑动平均, 连续失败 max_failures 次剔除, retest_after 秒后由 pick 顺带重新检测,
+    检测失败或恢复后很快又被剔除时等待时间翻倍
+    """
+
+    def __init__(self, urls: Iterable[str], alpha: float = 0.3, max_failures: int = 3, retest_after: float = 300,
+                 max_retest_after: float = 3600, max_inflight: int = 4,
+                 checker: Callable[[Proxy], bool] = check_proxy, clock: Callable[[], float] = time.monotonic,
+                 rng: Optional[random.Random] = None):
+        self.proxies: Dict[str, Proxy] = {}
+        for url in urls:
+            proxy = Proxy(url)
+            self.proxies[proxy.url] = proxy
+        if len(self.proxies) == 0:
+            raise ValueError('empty proxy list')
+        self.alpha = alpha
+        self.max_failures = max_failures
+        self.retest_after = retest_after
+        self.max_retest_after = max_retest_after
+        self.max_inflight = max_inflight
+        self.checker = checker
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, **kwargs) -> 'ProxyPool':
+        from models import load_db_auth
+
+        parser = load_db_auth()
+        urls = DEFAULT_PROXIES
+        if parser.has_option('proxy', 'urls'):
+            urls = [u.strip() for u in parser.get('proxy', 'urls').split(',') if u.strip()]
+        return cls(urls, **kwargs)
+
+    def healthy(self) -> List[Proxy]:
+        return [p for p in self.proxies.values() if p.healthy]
+
+    def pick(self, wait: bool = False) -> Proxy:
+        """
+        所有代理都被剔除时, wait 为 True 则等到最早的重新检测时间, 否则抛出 NoProxyAvailable
+        """
+        while True:
+            self.retest()
+            with self._lock:
+                candidates = [p for p in self.proxies.values() if p.healthy and p.inflight < self.max_inflight]
+                if len(candidates) == 0:
+                    candidates = self.healthy()
+                if len(candidates) != 0:
+                    if len(candidates) == 1:
+                        proxy = candidates[0]
+                    else:
+                        a, b = self.rng.sample(candidates, 2)
+                        proxy = a if a.score() >= b.score() else b
+                    proxy.inflight += 1
+                    return proxy
+                if not wait:
+                    raise NoProxyAvailable('all proxies are evicted: ' + ', '.join(self.proxies))
+                delay = min(p.evicted_until for p in self.proxies.values()) - self.clock()
+            logger.warning(f'all proxies are evicted, retest in {delay:.0f}s')
+            time.sleep(max(delay, 0.1))
+
+    def release(self, proxy: Proxy):
+        """
+        请求没有经过代理(如命中缓存)时只归还, 不计分
+        """
+        with self._lock:
+            proxy.inflight = max(0, proxy.inflight - 1)
+
+    def report(self, proxy: Proxy, ok: bool, latency: float):
+        with self._lock:
+            proxy.inflight = max(0, proxy.inflight - 1)
+            proxy.requests += 1
+            proxy.success += self.alpha * ((1.0 if ok else 0.0) - proxy.success)
+            if ok:
+                proxy.failures = 0
+                # 恢复后稳定了才清零剔除次数, 时好时坏的代理每次被剔除的时间越来越长
+                if proxy.success > 0.9:
+                    proxy.evictions = 0
+                proxy.latency = latency if proxy.latency is None else proxy.latency + self.alpha * (
+                        latency - proxy.latency)
+                return
+            proxy.failures += 1
+            if proxy.failures >= self.max_failures and proxy.healthy:
+                self._evict(proxy)
+
+    def evict(self, proxy: Proxy):
+        with self._lock:
+            self._evict(proxy)
+
+    def _evict(self, proxy: Proxy):
+        proxy.evictions += 1
+        wait = min(self.max_retest_after, self.retest_after * 2 ** (proxy.evictions - 1))
+        proxy.evicted_until = self.clock() + wait
+        logger.warning(f'evict proxy {proxy.url} for {wait:.0f}s, success {proxy.success:.2f}')
+
+    def retest(self, force: bool = False) -> List[Proxy]:
+        """
+        重新检测到期的代理, 返回恢复的代理. 检测请求在锁外执行
+        """
+        now = self.clock()
+        with self._lock:
+            due = [p for p in self.proxies.values()
+                   if p.evicted_until is not None and (force or p.evicted_until <= now)]
+            # 检测期间不重复检测
+            for p in due:
+                p.evicted_until = now + self.retest_after
+        restored = []
+        for proxy in due:
+            try:
+                ok = self.checker(proxy)
+            except Exception as e:
+                logger.debug(f'retest {proxy.url}: {e!r}')
+                ok = False
+            with self._lock:
+                if ok:
+                    proxy.evicted_until = None
+                    proxy.failures = 0
+                    proxy.success = 0.5
+                    restored.append(proxy)
+                    logger.info(f'proxy {proxy.url} restored')
+                else:
+                    self._evict(proxy)
+        return restored
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [dict(url=p.url, healthy=p.healthy, success=round(p.success, 3), latency=p.latency,
+                         requests=p.requests, inflight=p.inflight) for p in self.proxies.values()]
@@ -0,0 +1,166 @@
+"""
+逐小时观测的单位换算和质量控制, 整列 numpy 计算, 一次可处理上百万行
+
+cols, flags = qc.run(raw)                      # raw 为 wunderground observations 字段名 -> 一列值
+cols, flags = qc.run(raw, group=areas)         # 多个地区拼在一起时按 group 分开做突变检测
+
+换算后的列为 float64 数组, 缺失为 NaN. 检查项:
+    超出物理范围 (同时保证 weather_hour 的 tinyint 列不溢出) 的值置为 NaN 并标记
+    前后两个小时都突变且方向相反的值只标记不修改
+    露点高于温度只标记不修改
+flags 每行一个 uint16, 0 表示全部通过, 各位含义见 FLAGS
+"""
+import sys
+import time
+from typing import Dict, Mapping, Tuple
+
+import numpy as np
+
+# wunderground 请求 units=e, 温度华氏度, 风速 mph, 气压 inHg, 降水英寸
+RAW_FIELDS = {'temperature': 'temp', 'feels_like': 'feels_like', 'dewpoint': 'dewPt', 'humidity': 'rh',
+              'wind_dir': 'wdir', 'wind_speed': 'wspd', 'pressure': 'pressure', 'precip': 'precip_total'}
+MPH_TO_KMH = 1.609344
+
+# 换算后的单位, 温度类和湿度/风速是 tinyint, 上下限不超过 [-128, 127]
+RANGES = {
+    'temperature': (-60, 60),
+    'feels_like': (-80, 70),
+    'dewpoint': (-80, 40),
+    'humidity': (0, 100),
+    'wind_dir': (0, 360),
+    'wind_speed': (0, 127),
+    'pressure': (20, 33),
+    'precip': (0, 20),
+}
+# 与前后相邻观测的差都超过阈值时判为突变
+SPIKES = {'temperature': 10, 'dewpoint': 10, 'pressure': 0.3}
+# 相邻观测间隔超过该秒数时不做突变比较
+SPIKE_MAX_GAP = 3 * 3600
+# 华氏度取整后露点可能比温度高 1 度
+DEWPOINT_TOLERANCE = 1
+
+FLAGS: Dict[str, int] = {}
+for _name in RANGES:
+    FLAGS[_name + '_range'] = 1 << len(FLAGS)
+for _name in SPIKES:
+    FLAGS[_name + '_spike'] = 1 << len(FLAGS)
+FLAGS['dewpoint_above_temperature'] = 1 << len(FLAGS)
+
+
+def _floats(values) -> np.ndarray:
+    # None 转成 NaN, 总是复制, check 原地修改时不影响传入的数据
+    return np.array(values, dtype='float64')
+
+
+def f_to_c(x: np.ndarray) -> np.ndarray:
+    return np.rint((x - 32) / 1.8)
+
+
+def mph_to_kmh(x: np.ndarray) -> np.ndarray:
+    return np.rint(x * MPH_TO_KMH)
+
+
+def convert(raw: Mapping) -> Dict[str, np.ndarray]:
+    """
+    wunderground 字段 -> weather_hour 的数值列, 没有降水记录按 0 处理
+    """
+    cols = {name: _floats(raw[field]) for name, field in RAW_FIELDS.items()}
+    for name in ('temperature', 'feels_like', 'dewpoint'):
+        cols[name] = f_to_c(cols[name])
+    cols['wind_speed'] = mph_to_kmh(cols['wind_speed'])
+    cols['precip'] = np.nan_to_num(cols['precip'], nan=0.0)
+    return cols
+
+
+def _spikes(x: np.ndarray, threshold: float, same: np.ndarray) -> np.ndarray:
+    """
+    x 已按 (group, 时间) 排序, same[i] 表示第 i 和 i + 1 行可以比较, NaN 参与的比较都为 False
+    """
+    spike = np.zeros(x.shape[0], dtype=bool)
+    if x.shape[0] < 3:
+        return spike
+    d = np.diff(x)
+    with np.errstate(invalid='ignore'):
+        prev, nxt = d[:-1], d[1:]
+        spike[1:-1] = (same[:-1] & same[1:] & (np.abs(prev) > threshold) & (np.abs(nxt) > threshold)
+                       & (np.sign(prev) != np.sign(nxt)))
+    return spike
+
+
+def check(cols: Dict[str, np.ndarray], obs_time, group=None) -> np.ndarray:
+    """
+    对 convert 的结果做检查, 超出范围的值原地置为 NaN, 返回 flags.
+    obs_time 为 epoch 秒或 datetime64, 不要求有序
+    """
+    n = len(obs_time)
+    flags = np.zeros(n, dtype='uint16')
+    with np.errstate(invalid='ignore'):
+        for name, (low, high) in RANGES.items():
+            x = cols[name]
+            bad = (x < low) | (x > high)
+            flags[bad] |= FLAGS[name + '_range']
+            x[bad] = np.nan
+        above = cols['dewpoint'] > cols['temperature'] + DEWPOINT_TOLERANCE
+    flags[above] |= FLAGS['dewpoint_above_temperature']
+
+    t = np.asarray(obs_time)
+    t = t.astype('datetime64[s]').astype('int64') if np.issubdtype(t.dtype, np.datetime64) else t.astype('int64')
+    keys = (t,) if group is None else (t, np.asarray(group))
+    order = np.lexsort(keys)
+    t = t[order]
+    same = np.diff(t) <= SPIKE_MAX_GAP
+    if group is not None:
+        g = np.asarray(group)[order]
+        same &= g[1:] == g[:-1]
+    for name, threshold in SPIKES.items():
+        spike = _spikes(cols[name][order], threshold, same)
+        flags[order[spike]] |= FLAGS[name + '_spike']
+    return flags
+
+
+def run(raw: Mapping, group=None) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+    cols = convert(raw)
+    return cols, check(cols, raw['valid_time_gmt'], group)
+
+
+def describe(flags: np.ndarray) -> Dict[str, int]:
+    """
+    各标记的行数, 用于日志
+    """
+    return {name: int(np.count_nonzero(flags & bit)) for name, bit in FLAGS.items() if np.any(flags & bit)}
+
+
+def _synthetic(n: int, groups: int, seed: int = 0) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+    rng = np.random.default_rng(seed)
+    per = n // groups
+    n = per * groups
+    hours = np.tile(np.arange(per), groups)
+    temp = 60 + 20 * np.sin(hours * 2 * np.pi / 24) + rng.normal(0, 2, n)
+    raw = {
+        'valid_time_gmt': 1577836800 + hours * 3600,
+        'temp': temp,
+        'feels_like': temp - 2,
+        'dewPt': temp - 8 + rng.normal(0, 2, n),
+        'rh': rng.uniform(10, 100, n),
+        'wdir': rng.uniform(0, 360, n),
+        'wspd': rng.gamma(2, 4, n),
+        'pressure': 29.9 + 0.2 * np.sin(hours * 2 * np.pi / 240) + rng.normal(0, 0.02, n),
+        'precip_total': np.where(rng.random(n) < 0.9, np.nan, rng.gamma(1, 0.1, n)),
+    }
+    # 少量坏值: 缺失, 超出范围, 突变
+    for field in ('temp', 'dewPt', 'wspd'):
+        raw[field][rng.integers(0, n, n // 1000)] = np.nan
+    raw['temp'][rng.integers(0, n, n // 10000)] = 999
+    raw['temp'][rng.integers(1, n - 1, n // 10000)] += 40
+    return raw, np.repeat(np.arange(groups), per)
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    raw, group = _synthetic(rows, max(1, rows // 8760))
+    start = time.perf_counter()
+    _, qc_flags = run(raw, group)
+    elapsed = time.perf_counter() - start
+    print(f'{rows} rows in {elapsed:.3f}s, {rows / elapsed:,.0f} rows/s')
+    for flag, count in describe(qc_flags).items():
+        print(flag, count)
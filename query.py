@@ -0,0 +1,248 @@
+"""
+weather_hour / weather / weather_daily 的常用查询, 结果为 pandas DataFrame, 带进程内 LRU + TTL 缓存
+
+query.hourly(['长沙'], start, end)                                  # 逐小时观测
+query.aggregate(start, end, code_prefix='43', freq='month')          # 湖南各城市月均/最高/最低温
+
+范围条件都落在复合索引上: 按地区查走 (area, obs_time, source), 按行政区划前缀查走 (code, obs_time)
+"""
+import datetime
+import functools
+import inspect
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Iterable, List, Optional
+
+import pandas as pd
+from sqlalchemy import func, select
+from sqlalchemy.engine import Engine
+
+from models import WeatherDaily, WeatherRecord, WeatherRecordHour, get_engine
+
+HOURLY_COLUMNS = ['temperature', 'feels_like', 'dewpoint', 'humidity', 'wind', 'wind_dir', 'wind_speed', 'pressure',
+                  'precip', 'weather', 'source']
+INT_COLUMNS = ['temperature', 'feels_like', 'dewpoint', 'wind_dir', 'wind_speed', 'max_temp', 'min_temp']
+PERIOD_FORMATS = {'day': '%Y-%m-%d', 'month': '%Y-%m-01', 'year': '%Y-01-01'}
+
+
+class TTLCache:
+    """
+    LRU 缓存, 每个条目单独的过期时间. 结束时间在最近 recent 之内的查询窗口数据还会变化, 只缓存 recent_ttl 秒
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 24 * 3600, recent_ttl: float = 60,
+                 recent: datetime.timedelta = datetime.timedelta(days=2)):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.recent_ttl = recent_ttl
+        self.recent = recent
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def ttl_for(self, end) -> float:
+        if end is None:
+            return self.recent_ttl
+        if not isinstance(end, datetime.datetime):
+            end = datetime.datetime.combine(end, datetime.time.max)
+        return self.recent_ttl if end >= datetime.datetime.now() - self.recent else self.ttl
+
+    def get(self, key: Hashable):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: Hashable, value, ttl: float):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+cache = TTLCache()
+
+
+def _hashable(value) -> Hashable:
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(value))
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    if isinstance(value, Engine):
+        return str(value.url)
+    return value
+
+
+def cached(fn: Callable[..., pd.DataFrame]) -> Callable[..., pd.DataFrame]:
+    """
+    按全部参数缓存查询结果, 参数 use_cache=False 时跳过缓存, 返回副本避免调用方修改缓存内容
+    """
+    signature = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, use_cache: bool = True, **kwargs):
+        if not use_cache:
+            return fn(*args, **kwargs)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = (fn.__name__,) + tuple(_hashable(v) for v in bound.arguments.values())
+        df = cache.get(key)
+        if df is None:
+            df = fn(*args, **kwargs)
+            cache.put(key, df, cache.ttl_for(bound.arguments.get('end')))
+        return df.copy()
+
+    return wrapper
+
+
+def _read(engine: Optional[Engine], stmt, parse_dates: List[str]) -> pd.DataFrame:
+    with (engine or get_engine()).connect() as conn:
+        df = pd.read_sql(stmt, conn, parse_dates=parse_dates)
+    return df.astype({c: 'Int16' for c in INT_COLUMNS if c in df.columns})
+
+
+def _prefix(column, prefix: str) -> tuple:
+    # 用范围条件代替 like 'prefix%', sqlite 的 like 不走索引. 空前缀匹配全部, 不加条件
+    if prefix == '':
+        return ()
+    return column >= prefix, column < prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _columns(table, names: Optional[Iterable[str]], default: List[str]) -> list:
+    return [table.c[name] for name in (names or default)]
+
+
+@cached
+def hourly(areas: Iterable[str], start: datetime.datetime, end: datetime.datetime,
+           columns: Optional[List[str]] = None, source: Optional[str] = None,
+           engine: Optional[Engine] = None) -> pd.DataFrame:
+    """
+    地区逐小时观测, obs_time 在 [start, end), 按 area, obs_time 排序
+    """
+    h = WeatherRecordHour.__table__
+    stmt = select(h.c.area, h.c.obs_time, *_columns(h, columns, HOURLY_COLUMNS)).where(
+        h.c.area.in_(list(areas)), h.c.obs_time >= start, h.c.obs_time < end)
+    if source is not None:
+        stmt = stmt.where(h.c.source == source)
+    return _read(engine, stmt.order_by(h.c.area, h.c.obs_time), ['obs_time'])
+
+
+@cached
+def hourly_by_code(code_prefix: str, start: datetime.datetime, end: datetime.datetime,
+                   columns: Optional[List[str]] = None, source: Optional[str] = None,
+                   engine: Optional[Engine] = None) -> pd.DataFrame:
+    """
+    行政区划代码前缀下所有地区的逐小时观测, 如 '43' 为湖南, '4301' 为长沙
+    """
+    h = WeatherRecordHour.__table__
+    stmt = select(h.c.area, h.c.code, h.c.obs_time, *_columns(h, columns, HOURLY_COLUMNS)).where(
+        *_prefix(h.c.code, code_prefix), h.c.obs_time >= start, h.c.obs_time < end)
+    if source is not None:
+        stmt = stmt.where(h.c.source == source)
+    return _read(engine, stmt.order_by(h.c.code, h.c.obs_time), ['obs_time'])
+
+
+def series(area: str, start: datetime.datetime, end: datetime.datetime, column: str = 'temperature',
+           source: Optional[str] = None, engine: Optional[Engine] = None, use_cache: bool = True) -> pd.Series:
+    """
+    单个地区单列的时间序列, 以 obs_time 为索引
+    """
+    df = hourly([area], start, end, columns=[column], source=source, engine=engine, use_cache=use_cache)
+    return df.set_index('obs_time')[column]
+
+
+@cached
+def daily(areas: Iterable[str], start: datetime.date, end: datetime.date,
+          engine: Optional[Engine] = None) -> pd.DataFrame:
+    """
+    weather 表的日数据, wdate 在 [start, end]
+    """
+    w = WeatherRecord.__table__
+    stmt = select(w.c.area_name, w.c.wdate, w.c.max_temp, w.c.min_temp, w.c.weather, w.c.wind).where(
+        w.c.area_name.in_(list(areas)), w.c.wdate >= start, w.c.wdate <= end).order_by(w.c.area_name, w.c.wdate)
+    return _read(engine, stmt, ['wdate'])
+
+
+@cached
+def daily_rollup(start: datetime.date, end: datetime.date, areas: Optional[Iterable[str]] = None,
+                 code_prefix: Optional[str] = None, source: Optional[str] = None,
+                 engine: Optional[Engine] = None) -> pd.DataFrame:
+    """
+    weather_daily 的汇总结果, wdate 在 [start, end], areas 和 code_prefix 至少给一个
+    """
+    d = WeatherDaily.__table__
+    stmt = select(d).where(d.c.wdate >= start, d.c.wdate <= end)
+    stmt = _area_filter(stmt, d.c.area, d.c.code, areas, code_prefix)
+    if source is not None:
+        stmt = stmt.where(d.c.source == source)
+    return _read(engine, stmt.order_by(d.c.area, d.c.wdate, d.c.source), ['wdate', 'update_time'])
+
+
+def _area_filter(stmt, area_column, code_column, areas, code_prefix):
+    if areas is None and code_prefix is None:
+        raise ValueError('areas or code_prefix is required')
+    if areas is not None:
+        stmt = stmt.where(area_column.in_(list(areas)))
+    if code_prefix is not None:
+        stmt = stmt.where(*_prefix(code_column, code_prefix))
+    return stmt
+
+
+def period_expr(engine: Engine, column, freq: str):
+    """
+    把时间列截断到 day/month/year, 各数据库的日期函数不同
+    """
+    if freq not in PERIOD_FORMATS:
+        raise ValueError(f'unsupported freq: {freq}')
+    dialect = engine.dialect.name
+    if dialect == 'mysql':
+        return func.date_format(column, PERIOD_FORMATS[freq])
+    if dialect == 'sqlite':
+        return func.strftime(PERIOD_FORMATS[freq], column)
+    if dialect == 'postgresql':
+        return func.date_trunc(freq, column)
+    raise ValueError(f'unsupported dialect: {dialect}')
+
+
+@cached
+def aggregate(start: datetime.datetime, end: datetime.datetime, areas: Optional[Iterable[str]] = None,
+              code_prefix: Optional[str] = None, freq: str = 'month', column: str = 'temperature',
+              source: Optional[str] = None, engine: Optional[Engine] = None) -> pd.DataFrame:
+    """
+    按地区和周期聚合 weather_hour 的一列, 在数据库里 group by, 返回 area, period, mean, max, min, count
+    """
+    engine = engine or get_engine()
+    h = WeatherRecordHour.__table__
+    value = h.c[column]
+    period = period_expr(engine, h.c.obs_time, freq).label('period')
+    stmt = select(h.c.area, period, func.avg(value).label('mean'), func.max(value).label('max'),
+                  func.min(value).label('min'), func.count(value).label('count')).where(
+        h.c.obs_time >= start, h.c.obs_time < end)
+    stmt = _area_filter(stmt, h.c.area, h.c.code, areas, code_prefix)
+    if source is not None:
+        stmt = stmt.where(h.c.source == source)
+    stmt = stmt.group_by(h.c.area, period).order_by(h.c.area, period)
+    df = _read(engine, stmt, ['period'])
+    return df.astype({'mean': 'float64'})
+
+
+def clear_cache():
+    cache.clear()
@@ -1,86 +1,173 @@
+import asyncio
+import csv
 import datetime
 import decimal
 import os.path
-import time
 import sys
 import logging
+import time
 
-import pandas as pd
-import requests
-from sqlalchemy import select
-from sqlalchemy.orm import Session
-from sqlalchemy.sql.functions import func
 from loguru import logger
+from sqlalchemy import String, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.functions import func
 
+import metrics
+from async_crawl import AsyncFetcher
 from models import WeatherRecordHour, get_engine
+from records import HourlyRecord
+from writer import BulkWriter
 
 CUR_DIR = os.path.dirname(__file__)
+SOURCE = 'qweather'
 logger.remove()
 # logger.add(os.path.join(CUR_DIR, 'weather_history.log'), level=logging.INFO, mode='w')
 logger.add(sys.stderr, level=logging.INFO)
 
 
 class QWeather:
-    def __init__(self):
+    def __init__(self, concurrency: int = 8, rate: float = 10, engine: Engine = None):
         self.__key = '1ef7d2e60ca74fcf82c9f12736176704'
-        self.__engine = get_engine()
-        df = pd.read_csv(os.path.join(os.path.dirname(__file__), 'China-City-List-latest.csv'))
+        self.__engine = engine or get_engine()
         areas = ['长沙', '株洲', '湘潭', '衡阳', '邵阳', '岳阳', '常德', '张家界', '益阳', '郴州', '永州', '怀化',
                  '娄底', '湘西土家族苗族自治州', '广州', '韶关', '深圳', '珠海', '汕头', '佛山', '江门', '湛江', '茂名',
                  '肇庆', '惠州', '梅州', '汕尾', '河源', '阳江', '清远', '东莞', '中山', '潮州', '揭阳', '云浮', '海口',
                  '三亚', '三沙', '儋州']
-        self.cities = df[df['Location_Name_ZH'].isin(areas)]
-        assert self.cities.shape[0] == len(areas)
+        # 只用到几列, 用 csv 读取, 避免启动时导入 pandas
+        with open(os.path.join(CUR_DIR, 'China-City-List-latest.csv'), encoding='utf-8-sig', newline='') as f:
+            self.cities = [city for city in csv.DictReader(f) if city['Location_Name_ZH'] in areas]
+        assert len(self.cities) == len(areas)
+        self.url = 'https://devapi.qweather.com/v7/weather/now'
+        self.concurrency = concurrency
+        self.rate = rate
+        self.last_obs = None
 
     def find_city(self, city_name, single=True):
-        ret = self.cities[self.cities['Location_Name_ZH'] == city_name].copy()
+        ret = [city for city in self.cities if city['Location_Name_ZH'] == city_name]
 
         if single:
-            if ret.shape[0] != 1:
-                raise ValueError("find %s records, city_name %s" % (ret.shape[0], city_name))
-            return ret.iloc[0]
+            if len(ret) != 1:
+                raise ValueError("find %s records, city_name %s" % (len(ret), city_name))
+            return ret[0]
 
         return ret
 
     def real_time_weather(self):
-        url = 'https://devapi.qweather.com/v7/weather/now'
-        sess = Session(self.__engine)
+        """
+        所有城市并发请求一次, 结果一次写库
+        """
+        return asyncio.run(self._poll_once())
+
+    def run_forever(self, interval: float = 600):
+        """
+        常驻轮询, 每 interval 秒一轮, 连接池在各轮之间复用
+        """
+        asyncio.run(self._run_forever(interval))
+
+    async def _run_forever(self, interval: float):
+        async with self._fetcher() as fetcher:
+            while True:
+                start = time.monotonic()
+                try:
+                    await self._poll_once(fetcher)
+                except Exception as e:
+                    logger.exception(e)
+                await asyncio.sleep(max(0.0, interval - (time.monotonic() - start)))
+
+    def _fetcher(self) -> AsyncFetcher:
+        return AsyncFetcher(concurrency=self.concurrency, rate=self.rate, burst=self.concurrency)
+
+    def _load_last_obs(self):
+        """
+        每个城市最近一次入库的观测时间, 只在第一轮查一次库
+        """
+        areas = [city['Location_Name_ZH'] for city in self.cities]
+        stmt = select(WeatherRecordHour.area, func.max(WeatherRecordHour.obs_time)).where(
+            WeatherRecordHour.source == '1', WeatherRecordHour.area.in_(areas)).group_by(WeatherRecordHour.area)
+        with metrics.timer('crawl_plan_seconds', crawler=SOURCE), self.__engine.connect() as conn:
+            self.last_obs = dict(conn.execute(stmt).all())
+
+    async def _fetch_now(self, fetcher: AsyncFetcher, city) -> dict:
+        params = {
+            'key': self.__key,
+            'location': city['Location_ID'],
+            'lang': 'en'
+        }
+        with metrics.timer('crawl_fetch_seconds', crawler=SOURCE):
+            data = await fetcher.get(self.url, params=params, json=True)
+        if data['code'] != '200':
+            raise ValueError(data)
+        return data['now']
+
+    async def _poll_once(self, fetcher: AsyncFetcher = None) -> int:
+        if fetcher is None:
+            async with self._fetcher() as fetcher:
+                return await self._poll_once(fetcher)
+        if self.last_obs is None:
+            await asyncio.to_thread(self._load_last_obs)
+
+        cities = self.cities
+        results = await asyncio.gather(*(self._fetch_now(fetcher, city) for city in cities), return_exceptions=True)
         records = []
-        try:
-            for idx, city in self.cities.iterrows():
-                params = {
-                    'key': self.__key,
-                    'location': city['Location_ID'],
-                    'lang': 'en'
-                }
-                data = requests.get(url, params=params).json()
-                if data['code'] != '200':
-                    raise ValueError(data)
-
-                now = data['now']
-                logger.info(now)
-                obs_time = time.strptime(now['obsTime'], "%Y-%m-%dT%H:%M%z")
-                area = city['Location_Name_ZH']
-                record = WeatherRecordHour(area=area, obs_time=obs_time, temperature=int(now['temp']),
-                                           feels_like=int(now['feelsLike']), dewpoint=int(now['dew']),
-                                           humidity=int(now['humidity']), wind=now['windDir'],
-                                           wind_dir=int(now['wind360']),
-                                           wind_speed=int(now['windSpeed']), precip=decimal.Decimal(now['precip']),
-                                           weather=now['text'], source='1', create_time=datetime.datetime.now())
-                stmt = select(func.count(WeatherRecordHour.area)).where(WeatherRecordHour.area == area,
-                                                                        WeatherRecordHour.obs_time == obs_time)
-                if sess.scalar(stmt) == 0:
-                    records.append(record)
-        finally:
-            if len(records) != 0:
-                sess.add_all(records)
-                logger.info("insert %s records" % len(records))
-                sess.commit()
-            sess.close()
+        for city, now in zip(cities, results):
+            if isinstance(now, BaseException):
+                logger.error(f"{city['Location_Name_ZH']}: {now!r}")
+                metrics.inc('crawl_units_total', crawler=SOURCE, status='failed')
+                continue
+            metrics.inc('crawl_units_total', crawler=SOURCE, status='ok')
+            logger.info(now)
+            with metrics.timer('crawl_parse_seconds', crawler=SOURCE):
+                record = self.to_record(city, now)
+            last = self.last_obs.get(record.area)
+            if last is not None and record.obs_time <= last:
+                continue
+            records.append(record)
+
+        metrics.observe('crawl_rows', len(records), crawler=SOURCE)
+        if len(records) != 0:
+            await asyncio.to_thread(self._write, records)
+            for record in records:
+                self.last_obs[record.area] = record.obs_time
+        logger.info("insert %s records" % len(records))
+        return len(records)
+
+    def _write(self, records):
+        # 已存在的观测不覆盖
+        with metrics.timer('crawl_write_seconds', crawler=SOURCE), BulkWriter(
+                self.__engine, WeatherRecordHour, ('area', 'obs_time', 'source'), update_columns=(),
+                batch_size=len(records) + 1) as writer:
+            writer.add_all(records)
+
+    @staticmethod
+    def to_record(city, now) -> HourlyRecord:
+        # city 来自 csv.DictReader, Adcode 是 6 位字符串, 不能是 pandas 读出的 float(430100.0)
+        obs_time = datetime.datetime.strptime(now['obsTime'], "%Y-%m-%dT%H:%M%z").replace(tzinfo=None)
+        return HourlyRecord(area=city['Location_Name_ZH'], code=str(city['Adcode']).ljust(12, '0'), obs_time=obs_time,
+                            temperature=int(now['temp']), feels_like=int(now['feelsLike']), dewpoint=int(now['dew']),
+                            humidity=int(now['humidity']), wind=now['windDir'], wind_dir=int(now['wind360']),
+                            wind_speed=int(now['windSpeed']), precip=decimal.Decimal(now['precip']),
+                            weather=now['text'], source='1')
+
+
+def repair_codes(engine: Engine = None) -> int:
+    """
+    早先用 pandas 读城市列表时 Adcode 是 float, code 被写成 '430100.00000', 改回 12 位代码, 返回修改的行数
+    """
+    table = WeatherRecordHour.__table__
+    stmt = update(table).where(table.c.source == '1', table.c.code.like('%.%')).values(
+        code=func.substr(table.c.code, 1, 6, type_=String) + '000000')
+    with (engine or get_engine()).begin() as conn:
+        return conn.execute(stmt).rowcount
 
 
 if __name__ == '__main__':
+    if '--repair-codes' in sys.argv:
+        logger.info(f'repaired {repair_codes()} codes')
+        sys.exit()
     q_weather = QWeather()
-    q_weather.real_time_weather()
+    if '--loop' in sys.argv:
+        q_weather.run_forever()
+    else:
+        q_weather.real_time_weather()
     #
     # print(datetime.datetime.now().strftime("%Y-%m-%dT%H:%M+%z"))
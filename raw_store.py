@@ -0,0 +1,224 @@
+"""
+wunderground 原始响应的压缩存储, 代替 data/<city>/<year>-<month>.json
+
+每个城市两个文件:
+    raw/<city>.dat   每个月的响应压成紧凑 json 后单独压缩, 依次追加
+    raw/<city>.idx   每行 "年-月 偏移 长度 压缩方式", 同一个月后写的覆盖先写的
+
+有 zstandard 时用 zstd, 否则用 zlib, 压缩方式记在索引里, 两种可以混存.
+先写数据再写索引, 中途中断只会留下没有索引的数据, 该月下次重新抓取
+
+python raw_store.py import [data_dir]     把旧的月度 json 文件导入
+python raw_store.py stats
+"""
+import datetime
+import glob
+import json
+import os
+import re
+import sys
+import threading
+import zlib
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from loguru import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CUR_DIR = os.path.dirname(__file__)
+RAW_DIR = os.path.join(CUR_DIR, 'raw')
+LEGACY_DIR = os.path.join(CUR_DIR, 'data')
+
+ZSTD, ZLIB = 'zstd', 'zlib'
+DEFAULT_CODEC = ZSTD if zstandard is not None else ZLIB
+
+
+class Entry(NamedTuple):
+    offset: int
+    length: int
+    codec: str
+
+
+def _month_key(month: datetime.date) -> str:
+    return f'{month.year}-{month.month:02d}'
+
+
+def _parse_month(key: str) -> datetime.date:
+    year, month = key.split('-')
+    return datetime.date(int(year), int(month), 1)
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    return zlib.compress(data, 9)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to read zstd entries')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class RawStore:
+    """
+    store = RawStore()
+    if not store.has('长沙', datetime.date(2020, 1, 1)):
+        store.put('长沙', datetime.date(2020, 1, 1), response.json())
+    for month, js in store.iter_city('长沙'):
+        ...
+
+    索引按城市缓存在内存, 索引文件大小变化(其他进程写入)时重新加载, has 只需要一次 stat
+    """
+
+    def __init__(self, root: str = RAW_DIR, codec: str = DEFAULT_CODEC):
+        if codec == ZSTD and zstandard is None:
+            raise ValueError('zstandard is not installed')
+        self.root = root
+        self.codec = codec
+        self._indexes: Dict[str, Tuple[int, Dict[str, Entry]]] = {}
+        self._lock = threading.Lock()
+
+    def _data_path(self, city: str) -> str:
+        return os.path.join(self.root, city + '.dat')
+
+    def _index_path(self, city: str) -> str:
+        return os.path.join(self.root, city + '.idx')
+
+    def index(self, city: str) -> Dict[str, Entry]:
+        path = self._index_path(city)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return {}
+        cached = self._indexes.get(city)
+        if cached is not None and cached[0] == size:
+            return cached[1]
+        index = {}
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                # 写到一半的最后一行
+                if len(parts) != 4 or not line.endswith('\n'):
+                    continue
+                index[parts[0]] = Entry(int(parts[1]), int(parts[2]), parts[3])
+        self._indexes[city] = (size, index)
+        return index
+
+    def has(self, city: str, month: datetime.date) -> bool:
+        return _month_key(month) in self.index(city)
+
+    def months(self, city: str) -> List[datetime.date]:
+        return sorted(_parse_month(key) for key in self.index(city))
+
+    def cities(self) -> List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name[:-4] for name in os.listdir(self.root) if name.endswith('.idx'))
+
+    def put(self, city: str, month: datetime.date, obj) -> Entry:
+        data = compress(json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), self.codec)
+        os.makedirs(self.root, exist_ok=True)
+        with self._lock, open(self._data_path(city), 'ab') as f:
+            # 同一台机器上多个 worker 进程可能写同一个城市
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0, os.SEEK_END)
+                entry = Entry(f.tell(), len(data), self.codec)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                with open(self._index_path(city), 'a', encoding='utf-8') as idx:
+                    idx.write(f'{_month_key(month)} {entry.offset} {entry.length} {entry.codec}\n')
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        return entry
+
+    def get(self, city: str, month: datetime.date) -> Optional[dict]:
+        entry = self.index(city).get(_month_key(month))
+        if entry is None:
+            return None
+        with open(self._data_path(city), 'rb') as f:
+            f.seek(entry.offset)
+            return json.loads(decompress(f.read(entry.length), entry.codec))
+
+    def iter_city(self, city: str) -> Iterator[Tuple[datetime.date, dict]]:
+        """
+        按月份顺序逐月解压, 同一时间只有一个月的数据在内存里
+        """
+        index = self.index(city)
+        if len(index) == 0:
+            return
+        with open(self._data_path(city), 'rb') as f:
+            for key in sorted(index, key=_parse_month):
+                entry = index[key]
+                f.seek(entry.offset)
+                yield _parse_month(key), json.loads(decompress(f.read(entry.length), entry.codec))
+
+    def compact(self, city: str) -> int:
+        """
+        去掉被覆盖的旧数据, 返回节省的字节数. 需要在没有写入时执行
+        """
+        index = self.index(city)
+        data_path = self._data_path(city)
+        before = os.path.getsize(data_path)
+        lines = []
+        with open(data_path, 'rb') as src, open(data_path + '.tmp', 'wb') as dst:
+            for key in sorted(index, key=_parse_month):
+                entry = index[key]
+                src.seek(entry.offset)
+                lines.append(f'{key} {dst.tell()} {entry.length} {entry.codec}\n')
+                dst.write(src.read(entry.length))
+        with open(self._index_path(city) + '.tmp', 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(data_path + '.tmp', data_path)
+        os.replace(self._index_path(city) + '.tmp', self._index_path(city))
+        self._indexes.pop(city, None)
+        return before - os.path.getsize(data_path)
+
+    def stats(self) -> List[dict]:
+        return [dict(city=city, months=len(self.index(city)), bytes=os.path.getsize(self._data_path(city)))
+                for city in self.cities()]
+
+
+def import_legacy(store: RawStore, data_dir: str = LEGACY_DIR) -> Dict[str, int]:
+    """
+    导入 data/<city>/<year>-<month>.json, 已导入的月份跳过, 返回每个城市导入的月数, 原文件不删除
+    """
+    counts = {}
+    for city in sorted(os.listdir(data_dir)):
+        count = 0
+        for file in glob.glob(os.path.join(data_dir, city, '*.json')):
+            match = re.fullmatch(r'(\d{4})-(\d{1,2})\.json', os.path.basename(file))
+            if match is None:
+                continue
+            month = datetime.date(int(match.group(1)), int(match.group(2)), 1)
+            if store.has(city, month):
+                continue
+            with open(file, encoding='utf-8') as f:
+                store.put(city, month, json.load(f))
+            count += 1
+        if count != 0:
+            counts[city] = count
+            logger.info(f'imported {city}: {count} months')
+    return counts
+
+
+if __name__ == '__main__':
+    raw_store = RawStore()
+    if len(sys.argv) > 1 and sys.argv[1] == 'import':
+        import_legacy(raw_store, sys.argv[2] if len(sys.argv) > 2 else LEGACY_DIR)
+    for s in raw_store.stats():
+        print(s['city'], s['months'], s['bytes'])
@@ -0,0 +1,91 @@
+"""
+解析阶段使用的轻量记录类型, 代替 ORM 对象, 只在需要时转换成 ORM/数据库行/csv/arrow
+"""
+import datetime
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple, Type, Union
+
+from models import WeatherRecord, WeatherRecordHour
+
+
+class DailyRecord(NamedTuple):
+    """
+    weather 表的一行
+    """
+    area_name: str
+    wdate: datetime.date
+    max_temp: Optional[int] = None
+    min_temp: Optional[int] = None
+    weather: Optional[str] = None
+    wind: Optional[str] = None
+
+    def to_row(self) -> dict:
+        return self._asdict()
+
+    def to_orm(self) -> WeatherRecord:
+        return WeatherRecord(**self._asdict())
+
+    def to_csv(self) -> str:
+        return to_csv_line(self)
+
+
+class HourlyRecord(NamedTuple):
+    """
+    weather_hour 表的一行, source: 0 -> wunderground.com, 1 -> 和风api
+    """
+    area: str
+    code: Optional[str]
+    obs_time: datetime.datetime
+    temperature: Optional[int] = None
+    feels_like: Optional[int] = None
+    dewpoint: Optional[int] = None
+    humidity: Optional[int] = None
+    wind: Optional[str] = None
+    wind_dir: Optional[int] = None
+    wind_speed: Optional[int] = None
+    pressure: Optional[float] = None
+    precip: Optional[float] = None
+    weather: Optional[str] = None
+    source: str = '0'
+
+    def to_row(self) -> dict:
+        return self._asdict()
+
+    def to_orm(self) -> WeatherRecordHour:
+        return WeatherRecordHour(**self._asdict())
+
+    def to_csv(self) -> str:
+        return to_csv_line(self)
+
+
+Record = Union[DailyRecord, HourlyRecord]
+
+
+def to_csv_line(record: Sequence) -> str:
+    """
+    逗号分隔, None 写成空字段
+    """
+    return ','.join('' if v is None else str(v) for v in record)
+
+
+def _fields(records: List[Record], cls: Optional[Type[Record]]) -> Tuple[str, ...]:
+    if cls is None:
+        if len(records) == 0:
+            raise ValueError('cls is required for empty records')
+        cls = type(records[0])
+    return cls._fields
+
+
+def to_frame(records: Iterable[Record], cls: Optional[Type[Record]] = None):
+    import pandas as pd
+
+    records = list(records)
+    return pd.DataFrame.from_records(records, columns=_fields(records, cls))
+
+
+def to_arrow(records: Iterable[Record], cls: Optional[Type[Record]] = None):
+    import pyarrow as pa
+
+    records = list(records)
+    fields = _fields(records, cls)
+    columns = list(zip(*records)) if len(records) != 0 else [()] * len(fields)
+    return pa.table({name: list(col) for name, col in zip(fields, columns)})
@@ -0,0 +1,209 @@
+"""
+weather_hour -> weather_daily 的增量日汇总
+
+每次只处理 create_time 在 (水位线, 本次上界] 之间的新观测涉及的 (地区, 来源, 日期) 桶, 桶内用当天全部观测重新计算后 upsert,
+写完再推进水位线, 中途失败下次会重算这些桶
+
+python rollup.py            增量汇总
+python rollup.py --fill     用汇总结果补 weather 表缺失的日期
+python rollup.py --check    与 weather 表比对最高/最低温
+"""
+import datetime
+import sys
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple, TYPE_CHECKING
+
+from loguru import logger
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from models import Watermark, WeatherDaily, WeatherRecord, WeatherRecordHour, get_engine
+from records import DailyRecord
+from writer import BulkWriter
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+WATERMARK = 'rollup_weather_daily'
+# create_time 取自写入方的本地时间, 留一段延迟, 避免漏掉上界之前开始但还没提交的写入
+LAG = datetime.timedelta(minutes=5)
+# 一条查询里最多包含的连续日期区间数
+RANGE_CHUNK = 200
+# 观测数少于此值的日期视为不完整, 不用于补数据和比对
+MIN_OBS = 12
+
+ONE_DAY = datetime.timedelta(days=1)
+# wunderground 的 precip_total 是当天零点起的累计降水, 日降水取最大值; 和风的 precip 是逐时降水, 求和
+CUMULATIVE_PRECIP_SOURCES = {'0'}
+
+Bucket = Tuple[str, str, datetime.date]
+
+
+def load_watermark(sess: Session, name: str = WATERMARK) -> Optional[datetime.datetime]:
+    watermark = sess.get(Watermark, name)
+    return None if watermark is None else watermark.value
+
+
+def save_watermark(sess: Session, value: datetime.datetime, name: str = WATERMARK):
+    sess.merge(Watermark(name=name, value=value, update_time=datetime.datetime.now()))
+    sess.commit()
+
+
+def _as_date(value) -> datetime.date:
+    # sqlite 的 date() 返回字符串
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value)
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+def changed_buckets(sess: Session, low: Optional[datetime.datetime], high: datetime.datetime) -> Set[Bucket]:
+    """
+    create_time 在 (low, high] 之间的观测涉及的 (area, source, date)
+    """
+    h = WeatherRecordHour
+    stmt = select(h.area, h.source, func.date(h.obs_time)).where(h.create_time <= high).distinct()
+    if low is not None:
+        stmt = stmt.where(h.create_time > low)
+    return set((area, source, _as_date(d)) for area, source, d in sess.execute(stmt))
+
+
+def date_ranges(dates: Iterable[datetime.date]) -> List[Tuple[datetime.date, datetime.date]]:
+    """
+    日期合并成连续区间 [start, end)
+    """
+    ranges = []
+    for d in sorted(dates):
+        if len(ranges) != 0 and ranges[-1][1] == d:
+            ranges[-1][1] = d + ONE_DAY
+        else:
+            ranges.append([d, d + ONE_DAY])
+    return [(start, end) for start, end in ranges]
+
+
+def load_hours(sess: Session, area: str, source: str, dates: Set[datetime.date]) -> Dict[datetime.date, list]:
+    """
+    读出指定日期的全部观测, 连续的日期合并成 obs_time 区间, 可以走 (area, obs_time, source) 唯一索引
+    """
+    h = WeatherRecordHour
+    by_date = defaultdict(list)
+    ranges = date_ranges(dates)
+    for i in range(0, len(ranges), RANGE_CHUNK):
+        conds = [and_(h.obs_time >= datetime.datetime.combine(start, datetime.time.min),
+                      h.obs_time < datetime.datetime.combine(end, datetime.time.min))
+                 for start, end in ranges[i:i + RANGE_CHUNK]]
+        stmt = select(h.obs_time, h.code, h.temperature, h.precip, h.weather, h.wind).where(
+            h.area == area, h.source == source, or_(*conds)).order_by(h.obs_time)
+        for row in sess.execute(stmt.execution_options(yield_per=10000)):
+            by_date[row.obs_time.date()].append(row)
+    return by_date
+
+
+def _mode(values) -> Optional[str]:
+    # 次数相同时取最早出现的
+    counter = Counter(v for v in values if v)
+    return counter.most_common(1)[0][0] if len(counter) != 0 else None
+
+
+def rollup_day(area: str, source: str, wdate: datetime.date, rows: list) -> dict:
+    temps = [r.temperature for r in rows if r.temperature is not None]
+    precips = [r.precip for r in rows if r.precip is not None]
+    precip = None
+    if len(precips) != 0:
+        precip = round(max(precips) if source in CUMULATIVE_PRECIP_SOURCES else sum(precips), 2)
+    return dict(area=area, code=next((r.code for r in rows if r.code), None), wdate=wdate, source=source,
+                max_temp=max(temps, default=None), min_temp=min(temps, default=None), precip=precip,
+                weather=_mode(r.weather for r in rows), wind=_mode(r.wind for r in rows), obs_count=len(rows),
+                update_time=datetime.datetime.now())
+
+
+def rollup(engine: Optional[Engine] = None, now: Optional[datetime.datetime] = None) -> int:
+    """
+    增量汇总, 返回重算的桶数
+    """
+    engine = engine or get_engine()
+    high = (now or datetime.datetime.now()) - LAG
+    with Session(engine) as sess:
+        low = load_watermark(sess)
+        if low is not None and low >= high:
+            return 0
+        groups = defaultdict(set)
+        for area, source, wdate in changed_buckets(sess, low, high):
+            groups[(area, source)].add(wdate)
+
+        count = 0
+        with BulkWriter(engine, WeatherDaily, ('area', 'wdate', 'source')) as writer:
+            for (area, source), dates in groups.items():
+                by_date = load_hours(sess, area, source, dates)
+                for wdate in sorted(dates):
+                    if wdate in by_date:
+                        writer.add(rollup_day(area, source, wdate, by_date[wdate]))
+                        count += 1
+        save_watermark(sess, high)
+    logger.info(f'rollup ({low}, {high}]: {count} days of {len(groups)} areas')
+    return count
+
+
+def _date_filter(stmt, column, start: Optional[datetime.date], end: Optional[datetime.date]):
+    if start is not None:
+        stmt = stmt.where(column >= start)
+    if end is not None:
+        stmt = stmt.where(column <= end)
+    return stmt
+
+
+def fill_weather(engine: Optional[Engine] = None, start: Optional[datetime.date] = None,
+                 end: Optional[datetime.date] = None, min_obs: int = MIN_OBS) -> int:
+    """
+    weather 表缺失的 (地区, 日期) 用汇总结果补齐最高/最低温, 已有的行不覆盖. 同一天有多个来源时取观测数多的.
+    weather 表的天气/风向是 lishi.tianqi.com 的中文描述, 和风(lang=en)和 wunderground 的都是英文,
+    对应不上, 补的行天气/风向留空. 返回提交写入的行数, 并发补齐时已有的行会被跳过, 实际插入的可能更少
+    """
+    engine = engine or get_engine()
+    d, w = WeatherDaily, WeatherRecord
+    stmt = select(d).outerjoin(w, and_(w.area_name == d.area, w.wdate == d.wdate)).where(
+        w.id.is_(None), d.obs_count >= min_obs).order_by(d.area, d.wdate, d.obs_count.desc(), d.source.desc())
+    stmt = _date_filter(stmt, d.wdate, start, end)
+    last = None
+    with Session(engine) as sess, BulkWriter(engine, WeatherRecord, ('area_name', 'wdate'),
+                                             update_columns=()) as writer:
+        for daily in sess.scalars(stmt.execution_options(yield_per=10000)):
+            if (daily.area, daily.wdate) == last:
+                continue
+            last = (daily.area, daily.wdate)
+            writer.add(DailyRecord(daily.area, daily.wdate, daily.max_temp, daily.min_temp))
+    logger.info(f'submitted {writer.submitted} missing days to weather')
+    return writer.submitted
+
+
+def cross_check(engine: Optional[Engine] = None, start: Optional[datetime.date] = None,
+                end: Optional[datetime.date] = None, tolerance: int = 3, min_obs: int = MIN_OBS) -> 'pd.DataFrame':
+    """
+    返回 weather 与汇总结果最高/最低温相差超过 tolerance 度的日期, 逐小时观测通常会漏掉极值, 所以要留容差
+    """
+    import pandas as pd
+
+    engine = engine or get_engine()
+    d, w = WeatherDaily, WeatherRecord
+    stmt = select(w.area_name.label('area'), w.wdate, d.source, w.max_temp, d.max_temp.label('rollup_max_temp'),
+                  w.min_temp, d.min_temp.label('rollup_min_temp'), d.obs_count).join(
+        d, and_(w.area_name == d.area, w.wdate == d.wdate)).where(d.obs_count >= min_obs)
+    stmt = _date_filter(stmt, w.wdate, start, end)
+    with engine.connect() as conn:
+        df = pd.read_sql(stmt, conn)
+    df['max_diff'] = df['rollup_max_temp'] - df['max_temp']
+    df['min_diff'] = df['rollup_min_temp'] - df['min_temp']
+    mismatched = df[(df['max_diff'].abs() > tolerance) | (df['min_diff'].abs() > tolerance)].reset_index(drop=True)
+    logger.info(f'{df.shape[0]} days compared, {mismatched.shape[0]} mismatched')
+    return mismatched
+
+
+if __name__ == '__main__':
+    if '--fill' in sys.argv:
+        fill_weather()
+    elif '--check' in sys.argv:
+        print(cross_check().to_string())
+    else:
+        rollup()
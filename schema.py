@@ -0,0 +1,156 @@
+"""
+表结构迁移, 补齐 models 中声明但数据库里还没有的表/索引/唯一键, mysql 上可选把 weather_hour 按年分区
+
+python schema.py                     执行迁移
+python schema.py --dry-run           只打印要执行的 sql
+python schema.py --partition         同时把 weather_hour 改为 RANGE (YEAR(obs_time)) 分区
+
+已有重复数据的表在加唯一键前先去重, 每组保留 id 最大(最后写入)的一行
+"""
+import datetime
+import sys
+from typing import List, Optional, Sequence, Tuple
+
+from loguru import logger
+from sqlalchemy import Table, UniqueConstraint, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateTable
+
+from models import Base, WeatherRecordHour, get_engine
+
+# 分区从这一年开始, 更早的数据都落在第一个分区
+PARTITION_START = 2010
+
+
+def _quote(engine: Engine, name: str) -> str:
+    return engine.dialect.identifier_preparer.quote(name)
+
+
+def declared_indexes(table: Table) -> List[Tuple[str, Tuple[str, ...], bool]]:
+    """
+    表上声明的 (索引名, 列, 是否唯一), 唯一约束按同名唯一索引创建, sqlite 不能 alter table 加约束, 两者在 mysql 上等价
+    """
+    ret = [(index.name, tuple(c.name for c in index.columns), bool(index.unique)) for index in table.indexes]
+    for cons in table.constraints:
+        if isinstance(cons, UniqueConstraint) and cons.name is not None:
+            ret.append((cons.name, tuple(c.name for c in cons.columns), True))
+    return ret
+
+
+def create_index_sql(engine: Engine, table: Table, name: str, cols: Sequence[str], unique: bool) -> str:
+    return (f'CREATE {"UNIQUE " if unique else ""}INDEX {_quote(engine, name)} ON {_quote(engine, table.name)} '
+            f'({", ".join(_quote(engine, c) for c in cols)})')
+
+
+def existing_indexes(engine: Engine, table_name: str) -> Tuple[set, set]:
+    """
+    返回已有索引/唯一键的 (名字集合, 列组合集合)
+    """
+    inspector = inspect(engine)
+    names, columns = set(), set()
+    for item in inspector.get_indexes(table_name) + inspector.get_unique_constraints(table_name):
+        if item.get('name'):
+            names.add(item['name'])
+        columns.add((tuple(item['column_names']), bool(item.get('unique', True))))
+    pk = inspector.get_pk_constraint(table_name)
+    columns.add((tuple(pk['constrained_columns']), True))
+    return names, columns
+
+
+def duplicate_count(engine: Engine, table: Table, keys: Sequence[str]) -> int:
+    cols = ', '.join(_quote(engine, k) for k in keys)
+    sql = f'SELECT COUNT(*) FROM (SELECT 1 FROM {_quote(engine, table.name)} GROUP BY {cols} HAVING COUNT(*) > 1) t'
+    with engine.connect() as conn:
+        return conn.execute(text(sql)).scalar()
+
+
+def dedupe_sql(engine: Engine, table: Table, keys: Sequence[str]) -> str:
+    # mysql 不允许 delete 的子查询直接引用同一张表, 多包一层派生表
+    name = _quote(engine, table.name)
+    cols = ', '.join(_quote(engine, k) for k in keys)
+    return (f'DELETE FROM {name} WHERE id NOT IN '
+            f'(SELECT id FROM (SELECT MAX(id) AS id FROM {name} GROUP BY {cols}) keep_ids)')
+
+
+def plan_indexes(engine: Engine, table: Table) -> List[str]:
+    names, columns = existing_indexes(engine, table.name)
+    statements = []
+    for name, cols, unique in declared_indexes(table):
+        if name in names or (cols, unique) in columns:
+            continue
+        if unique:
+            dup = duplicate_count(engine, table, cols)
+            if dup != 0:
+                logger.warning(f'{table.name}: {dup} duplicated groups of {cols}')
+                statements.append(dedupe_sql(engine, table, cols))
+        statements.append(create_index_sql(engine, table, name, cols, unique))
+    return statements
+
+
+def is_partitioned(engine: Engine, table_name: str) -> bool:
+    sql = ('SELECT COUNT(*) FROM information_schema.partitions WHERE table_schema = DATABASE() '
+           'AND table_name = :name AND partition_name IS NOT NULL')
+    with engine.connect() as conn:
+        return conn.execute(text(sql), {'name': table_name}).scalar() != 0
+
+
+def partition_sql(table_name: str = WeatherRecordHour.__tablename__, start: int = PARTITION_START,
+                  end: Optional[int] = None) -> List[str]:
+    """
+    mysql 分区表的每个唯一键都必须包含分区列, 先把主键改成 (id, obs_time), 每年一个分区外加 pmax 兜底
+    """
+    end = end or datetime.date.today().year + 1
+    parts = [f'PARTITION p{year} VALUES LESS THAN ({year + 1})' for year in range(start, end + 1)]
+    parts.append('PARTITION pmax VALUES LESS THAN MAXVALUE')
+    return [f'ALTER TABLE `{table_name}` DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, `obs_time`)',
+            f'ALTER TABLE `{table_name}` PARTITION BY RANGE (YEAR(`obs_time`)) (\n    ' + ',\n    '.join(parts) + ')']
+
+
+def add_year_partition_sql(year: int, table_name: str = WeatherRecordHour.__tablename__) -> str:
+    """
+    从 pmax 拆出新的年份分区, 每年年底执行一次, pmax 为空时只改元数据
+    """
+    return (f'ALTER TABLE `{table_name}` REORGANIZE PARTITION pmax INTO '
+            f'(PARTITION p{year} VALUES LESS THAN ({year + 1}), PARTITION pmax VALUES LESS THAN MAXVALUE)')
+
+
+def plan(engine: Engine, partition: bool = False) -> List[str]:
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    statements = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            # 新建的表连同索引一起建
+            statements.append(str(CreateTable(table).compile(dialect=engine.dialect)).strip())
+            statements.extend(create_index_sql(engine, table, index.name, [c.name for c in index.columns],
+                                               bool(index.unique)) for index in table.indexes)
+            continue
+        statements.extend(plan_indexes(engine, table))
+    if partition:
+        if engine.dialect.name != 'mysql':
+            raise ValueError(f'partitioning is not supported on {engine.dialect.name}')
+        name = WeatherRecordHour.__tablename__
+        if name not in tables or not is_partitioned(engine, name):
+            statements.extend(partition_sql(name))
+    return statements
+
+
+def migrate(engine: Optional[Engine] = None, partition: bool = False, dry_run: bool = False) -> List[str]:
+    """
+    返回执行(或 dry_run 时将要执行)的 sql, mysql 的 ddl 会隐式提交, 中途失败后重新运行会跳过已完成的步骤
+    """
+    engine = engine or get_engine()
+    statements = plan(engine, partition)
+    for sql in statements:
+        logger.info(sql)
+        if dry_run:
+            continue
+        start = datetime.datetime.now()
+        with engine.begin() as conn:
+            conn.exec_driver_sql(sql)
+        logger.info(f'done in {(datetime.datetime.now() - start).total_seconds():.1f}s')
+    return statements
+
+
+if __name__ == '__main__':
+    migrate(partition='--partition' in sys.argv, dry_run='--dry-run' in sys.argv)
@@ -0,0 +1,170 @@
+"""
+本地桩服务和按线上结构生成的页面, 给 bench 脚本和测试模拟上游站点和代理, 不访问外网
+
+upstream = StubServer(routes={'/page': b'hello'}, latency=0.05, error_rate=0.1).start()
+proxy = StubProxy(delay=0.02).start()
+requests.get(upstream.url + '/page', proxies={'http': proxy.url})
+"""
+import calendar
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple, Union
+
+# lishi.tianqi.com 月份页面的取值
+WEATHERS = ['晴', '多云', '阴', '小雨', '中雨', '雷阵雨', '多云~晴', '小雨~阴']
+WINDS = ['东北风 2级', '南风 1级', '西北风 3级', '无持续风向 微风']
+WEEKDAYS = ['星期一', '星期二', '星期三', '星期四', '星期五', '星期六', '星期日']
+
+
+def month_page(year: int, month: int, seed: int = 0) -> str:
+    """
+    按线上结构生成 lishi.tianqi.com 的月份页面, 同一 seed 内容相同, 约 2% 的日期缺最高温
+    """
+    rnd = random.Random(seed)
+    rows = []
+    for day in range(1, calendar.monthrange(year, month)[1] + 1):
+        max_temp = rnd.randint(5, 35)
+        max_temp = '' if rnd.random() < 0.02 else f'{max_temp}℃'
+        min_temp = f'{rnd.randint(-5, 20)}℃'
+        weekday = WEEKDAYS[calendar.weekday(year, month, day)]
+        rows.append(
+            '<li>\n'
+            f'<div class="th200">{year}-{month:02d}-{day:02d} {weekday} </div>\n'
+            f'<div class="th140">{max_temp}</div>\n'
+            f'<div class="th140">{min_temp}</div>\n'
+            f'<div class="th140">{rnd.choice(WEATHERS)}</div>\n'
+            f'<div class="th140">{rnd.choice(WINDS)}</div>\n'
+            '</li>')
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>历史天气</title></head><body>'
+        '<div class="top"><ul><li><div>导航</div></li></ul></div>'
+        '<div class="main clearfix"><div class="main_left inleft"><div class="tian_one"></div>'
+        '<div class="tian_three"><ul class="thrui">\n' + '\n'.join(rows) + '\n</ul></div></div>'
+        '<div class="main_right inright"></div></div></body></html>')
+
+
+# 路径 -> 响应体, 或 带查询参数的路径 -> 响应体/(状态码, 响应体) 的函数
+Route = Union[bytes, Callable[[str], Union[bytes, Tuple[int, bytes]]]]
+
+
+class _Server:
+    def __init__(self, handler):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, body: bytes, content_type: str = 'text/html; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _UpstreamHandler(_Handler):
+    def do_GET(self):
+        stub: StubServer = self.server.stub
+        stub.count()
+        if stub.latency:
+            time.sleep(stub.latency * (0.5 + stub.rng.random()))
+        if stub.rng.random() < stub.error_rate:
+            self.reply(stub.error_status, b'error')
+            return
+        path = self.path.split('?', 1)[0]
+        route = stub.routes.get(path)
+        if route is None:
+            self.reply(404, b'not found')
+            return
+        status, body = 200, route(self.path) if callable(route) else route
+        if isinstance(body, tuple):
+            status, body = body
+        content_type = 'application/json' if body[:1] in (b'{', b'[') else 'text/html; charset=utf-8'
+        self.reply(status, body, content_type)
+
+
+class StubServer(_Server):
+    """
+    模拟上游站点: 每个请求延迟 latency * [0.5, 1.5) 秒, 按 error_rate 返回 error_status
+    """
+
+    def __init__(self, routes: Optional[Dict[str, Route]] = None, latency: float = 0, error_rate: float = 0,
+                 error_status: int = 503, seed: Optional[int] = None):
+        super().__init__(_UpstreamHandler)
+        self.routes = routes or {'/': b'ok'}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rng = random.Random(seed)
+
+
+class _ProxyHandler(_Handler):
+    def do_GET(self):
+        stub: StubProxy = self.server.stub
+        stub.count()
+        if stub.down:
+            # 模拟代理失效: 不响应直接断开
+            self.close_connection = True
+            self.connection.close()
+            return
+        if stub.delay:
+            time.sleep(stub.delay)
+        if stub.rng.random() < stub.fail_rate:
+            self.reply(502, b'bad gateway')
+            return
+        if not self.path.startswith('http://'):
+            self.reply(400, b'absolute uri required')
+            return
+        try:
+            with urllib.request.urlopen(self.path, timeout=10) as resp:
+                self.reply(resp.status, resp.read(), resp.headers.get('Content-Type', 'text/html'))
+        except urllib.error.HTTPError as e:
+            self.reply(e.code, e.read())
+        except OSError:
+            self.reply(502, b'bad gateway')
+
+
+class StubProxy(_Server):
+    """
+    只支持 http 的正向代理: 转发前延迟 delay 秒, 按 fail_rate 返回 502, down 为 True 时直接断开连接
+    """
+
+    def __init__(self, delay: float = 0, fail_rate: float = 0, down: bool = False, seed: Optional[int] = None):
+        super().__init__(_ProxyHandler)
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.down = down
+        self.rng = random.Random(seed)
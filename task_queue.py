@@ -0,0 +1,175 @@
+"""
+基于 redis 的分布式抓取任务队列, 任务单元为 (source, area, month)
+
+所有未完成的单元放在一个有序集合里, score 为可以被领取的时间. 领取时把 score 改成 now + visibility_timeout,
+worker 挂掉后租约到期, 单元自动可以被其它 worker 重新领取. 完成的单元进入 done 集合, 之后不会再入队.
+超过 max_attempts 的单元进入 failed 集合, 重新入队时清空尝试次数. 只有当前持有租约的 worker 可以完成或退回单元
+"""
+import datetime
+import random
+from typing import Callable, Iterable, NamedTuple, Optional
+
+from redis import Redis, WatchError
+from redis.client import Pipeline
+
+MONTH_FORMAT = '%Y%m'
+
+
+class TaskUnit(NamedTuple):
+    source: str
+    area: str
+    month: datetime.date
+
+    @property
+    def key(self) -> str:
+        return f'{self.source}|{self.area}|{self.month.strftime(MONTH_FORMAT)}'
+
+    @classmethod
+    def from_key(cls, key) -> 'TaskUnit':
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        source, area, month = key.split('|')
+        return cls(source, area, datetime.datetime.strptime(month, MONTH_FORMAT).date())
+
+
+class TaskQueue:
+    """
+    queue = TaskQueue(StrictRedis(...), 'weather_history')
+    queue.enqueue(units)
+    unit = queue.lease('worker-1')
+    ...
+    queue.complete(unit, 'worker-1')
+    """
+
+    def __init__(self, redis: Redis, name: str, visibility_timeout: float = 300, max_attempts: int = 5,
+                 retry_delay: float = 30):
+        self.redis = redis
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.schedule_key = f'queue:{name}:schedule'
+        self.attempts_key = f'queue:{name}:attempts'
+        self.owner_key = f'queue:{name}:owner'
+        self.done_key = f'queue:{name}:done'
+        self.failed_key = f'queue:{name}:failed'
+
+    def _now(self) -> float:
+        # 多个节点统一使用 redis 服务器时间
+        sec, usec = self.redis.time()
+        return sec + usec / 1e6
+
+    def enqueue(self, units: Iterable[TaskUnit]) -> int:
+        """
+        已完成或已在队列中的单元跳过, 返回新入队的数量. 之前失败的单元从 failed 移出, 尝试次数清零
+        """
+        units = list(units)
+        if len(units) == 0:
+            return 0
+        pipe = self.redis.pipeline(transaction=False)
+        for unit in units:
+            pipe.sismember(self.done_key, unit.key)
+            pipe.zscore(self.schedule_key, unit.key)
+        replies = pipe.execute()
+        keys = [unit.key for unit, done, score in zip(units, replies[::2], replies[1::2]) if not done and score is None]
+        if len(keys) == 0:
+            return 0
+        now = self._now()
+        pipe = self.redis.pipeline()
+        pipe.srem(self.failed_key, *keys)
+        pipe.hdel(self.attempts_key, *keys)
+        pipe.zadd(self.schedule_key, {key: now for key in keys}, nx=True)
+        return pipe.execute()[-1]
+
+    def lease(self, worker: str, timeout: Optional[float] = None) -> Optional[TaskUnit]:
+        """
+        领取一个到期的单元, 没有可领取的单元时返回 None
+        """
+        timeout = timeout or self.visibility_timeout
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.schedule_key)
+                    now = self._now()
+                    keys = pipe.zrangebyscore(self.schedule_key, '-inf', now, start=0, num=1)
+                    if len(keys) == 0:
+                        pipe.unwatch()
+                        return None
+                    key = keys[0]
+                    attempts = int(pipe.hget(self.attempts_key, key) or 0)
+                    pipe.multi()
+                    if attempts >= self.max_attempts:
+                        pipe.zrem(self.schedule_key, key)
+                        pipe.sadd(self.failed_key, key)
+                        pipe.hdel(self.attempts_key, key)
+                        pipe.hdel(self.owner_key, key)
+                        pipe.execute()
+                        continue
+                    pipe.zadd(self.schedule_key, {key: now + timeout}, xx=True)
+                    pipe.hincrby(self.attempts_key, key, 1)
+                    pipe.hset(self.owner_key, key, worker)
+                    pipe.execute()
+                    return TaskUnit.from_key(key)
+                except WatchError:
+                    continue
+
+    def extend(self, unit: TaskUnit, timeout: Optional[float] = None):
+        """
+        处理时间较长时续租
+        """
+        self.redis.zadd(self.schedule_key, {unit.key: self._now() + (timeout or self.visibility_timeout)}, xx=True)
+
+    def _release(self, unit: TaskUnit, worker: str, update: Callable[[Pipeline], None]) -> bool:
+        """
+        worker 仍持有租约时在事务里执行 update, 租约已过期并被其它 worker 领取时什么也不做, 返回 False
+        """
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.owner_key)
+                    owner = pipe.hget(self.owner_key, unit.key)
+                    if isinstance(owner, bytes):
+                        owner = owner.decode('utf-8')
+                    if owner != worker:
+                        pipe.unwatch()
+                        return False
+                    pipe.multi()
+                    update(pipe)
+                    pipe.hdel(self.owner_key, unit.key)
+                    pipe.execute()
+                    return True
+                except WatchError:
+                    continue
+
+    def complete(self, unit: TaskUnit, worker: str) -> bool:
+        def update(pipe):
+            pipe.zrem(self.schedule_key, unit.key)
+            pipe.sadd(self.done_key, unit.key)
+            pipe.hdel(self.attempts_key, unit.key)
+
+        return self._release(unit, worker, update)
+
+    def fail(self, unit: TaskUnit, worker: str) -> bool:
+        """
+        处理失败, 按已尝试次数指数退避后重新可领取, 超过次数的单元在下次领取时进入 failed
+        """
+        attempts = int(self.redis.hget(self.attempts_key, unit.key) or 1)
+        delay = self.retry_delay * 2 ** (attempts - 1) * (0.5 + random.random())
+
+        def update(pipe):
+            pipe.zadd(self.schedule_key, {unit.key: self._now() + delay}, xx=True)
+
+        return self._release(unit, worker, update)
+
+    def is_done(self, unit: TaskUnit) -> bool:
+        return bool(self.redis.sismember(self.done_key, unit.key))
+
+    def stats(self) -> dict:
+        now = self._now()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zcount(self.schedule_key, '-inf', now)
+        pipe.zcount(self.schedule_key, f'({now}', '+inf')
+        pipe.scard(self.done_key)
+        pipe.scard(self.failed_key)
+        ready, leased, done, failed = pipe.execute()
+        return {'ready': ready, 'leased_or_delayed': leased, 'done': done, 'failed': failed}
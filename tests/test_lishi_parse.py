@@ -0,0 +1,46 @@
+import datetime
+import os
+from pathlib import Path
+
+import pytest
+
+from lishi_parse import parse_month_page, parse_month_page_selector
+from records import DailyRecord
+from stubs import month_page
+
+CUR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def page(rows: str) -> str:
+    return ('<html><body><div class="main clearfix"><div class="main_left inleft"><div class="tian_three">'
+            '<ul class="thrui">' + rows + '</ul></div></div></div></body></html>')
+
+
+# 缺少天气/风向列, 以及天气列不是 div
+MISSING_COLUMNS = page(
+    '<li><div>2020-03-01 星期日 </div><div>12℃</div><div>3℃</div></li>'
+    '<li><div>2020-03-02 星期一 </div><div>15℃</div><div>6℃</div><div> 多云 </div></li>'
+    '<li><div>2020-03-03</div><div></div><div>℃</div><span>晴</span><div> 南风 1级</div></li>')
+
+
+@pytest.mark.parametrize('text', [month_page(2011, 1, 0), month_page(2016, 2, 1), month_page(2020, 2, 2),
+                                  month_page(2023, 7, 3), MISSING_COLUMNS],
+                         ids=['2011-01', '2016-02', '2020-02', '2023-07', 'missing-columns'])
+def test_same_as_selector(text):
+    expected = parse_month_page_selector(text, '长沙')
+    assert len(expected) != 0
+    assert parse_month_page(text, '长沙') == expected
+
+
+def test_missing_columns():
+    records = parse_month_page(MISSING_COLUMNS, '长沙')
+    assert records == [
+        DailyRecord('长沙', datetime.date(2020, 3, 1), 12, 3, None, None),
+        DailyRecord('长沙', datetime.date(2020, 3, 2), 15, 6, '多云', None),
+        DailyRecord('长沙', datetime.date(2020, 3, 3), None, None, None, '南风 1级'),
+    ]
+
+
+def test_error_page():
+    text = Path(CUR_DIR, 'error.html').read_text(encoding='utf-8')
+    assert parse_month_page(text, '长沙') == parse_month_page_selector(text, '长沙') == []
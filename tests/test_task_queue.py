@@ -0,0 +1,69 @@
+import datetime
+import time
+
+import fakeredis
+import pytest
+
+from task_queue import TaskQueue, TaskUnit
+
+UNITS = [TaskUnit('history', '长沙', datetime.date(2020, month, 1)) for month in (1, 2, 3)]
+
+
+@pytest.fixture
+def queue():
+    return TaskQueue(fakeredis.FakeStrictRedis(), 'test', visibility_timeout=0.2, max_attempts=2, retry_delay=0.05)
+
+
+def test_enqueue_dedupe(queue):
+    assert queue.enqueue(UNITS) == 3
+    assert queue.enqueue(UNITS + UNITS[:1]) == 0
+    assert queue.stats()['ready'] == 3
+
+
+def test_lease_visibility_timeout(queue):
+    queue.enqueue(UNITS[:1])
+    unit = queue.lease('a')
+    assert unit == UNITS[0]
+    assert queue.lease('b') is None
+    time.sleep(0.25)
+    # 租约过期后被其它 worker 领取, 原 worker 不能再完成或退回
+    assert queue.lease('b') == unit
+    assert not queue.complete(unit, 'a')
+    assert not queue.fail(unit, 'a')
+    assert queue.complete(unit, 'b')
+    assert queue.is_done(unit)
+
+
+def test_fail_backoff_then_failed(queue):
+    queue.enqueue(UNITS[:1])
+    unit = queue.lease('a')
+    assert queue.fail(unit, 'a')
+    # 退避期间不可领取
+    assert queue.lease('a') is None
+    time.sleep(0.1)
+    assert queue.lease('a') == unit
+    assert queue.fail(unit, 'a')
+    time.sleep(0.2)
+    assert queue.lease('a') is None
+    assert queue.stats() == {'ready': 0, 'leased_or_delayed': 0, 'done': 0, 'failed': 1}
+
+
+def test_complete_skips_done(queue):
+    queue.enqueue(UNITS[:1])
+    unit = queue.lease('a')
+    assert queue.complete(unit, 'a')
+    assert queue.enqueue(UNITS[:1]) == 0
+    assert queue.lease('a') is None
+    assert queue.stats()['done'] == 1
+
+
+def test_reenqueue_after_failure():
+    queue = TaskQueue(fakeredis.FakeStrictRedis(), 'test', max_attempts=1, retry_delay=0)
+    queue.enqueue(UNITS[:1])
+    unit = queue.lease('a')
+    queue.fail(unit, 'a')
+    assert queue.lease('a') is None
+    assert queue.stats()['failed'] == 1
+    assert queue.enqueue(UNITS[:1]) == 1
+    assert queue.stats()['failed'] == 0
+    assert queue.lease('a') == unit
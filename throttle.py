@@ -0,0 +1,201 @@
+"""
+按 host 自适应限速, 代替固定的 sleep
+
+- AIMD: 每次成功请求速率加 rate_step, 并发窗口加 1/limit; 被限流(403/429/5xx/连接错误)时速率和窗口减半,
+  响应明显变慢(超过最快响应的 slow_factor 倍)时窗口缩小但速率不变
+- 退避: 连续失败按 backoff_base * 2^(n-1) 指数退避, 乘以 [0.5, 1.5) 的随机抖动, 有 Retry-After 时取较大值
+- 熔断: 连续失败 failure_threshold 次后 host 暂停 cooldown 秒, 之后只放行一个探测请求, 成功则恢复,
+  失败则暂停时间翻倍
+- ignore_statuses: 按 host 配置不计入限速的状态码, 如 apiKey 失效的 401/403, 只归还并发, 不加速也不退避
+
+同步用法: throttle.wait(host) ... throttle.finish(host, status, latency)
+异步用法: await throttle.acquire(host) ... await throttle.release(host, status, latency),
+请求被取消时 await throttle.cancel(host), 只归还并发
+"""
+import asyncio
+import math
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Iterable, Optional
+
+from loguru import logger
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+def is_throttled(status: Optional[int]) -> bool:
+    """
+    status 为 None 表示连接失败/超时
+    """
+    return status is None or status in (403, 429) or status >= 500
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostState:
+    def __init__(self, rate: float, limit: float, cooldown: float):
+        self.rate = rate
+        self.limit = limit
+        self.cooldown = cooldown
+        self.inflight = 0
+        self.next_at = 0.0
+        self.failures = 0
+        self.state = CLOSED
+        self.open_until = 0.0
+        self.probing = False
+        self.min_latency: Optional[float] = None
+
+    def __repr__(self):
+        return (f'HostState(state={self.state}, rate={self.rate:.3f}, limit={self.limit:.2f}, '
+                f'inflight={self.inflight}, failures={self.failures})')
+
+
+class AdaptiveThrottle:
+    def __init__(self, rate: float = 0.5, min_rate: float = 0.02, max_rate: float = 5, rate_step: float = 0.05,
+                 max_concurrency: int = 8, backoff_base: float = 5, max_backoff: float = 300,
+                 failure_threshold: int = 3, cooldown: float = 300, max_cooldown: float = 3600,
+                 slow_factor: float = 3, host_rates: Optional[Dict[str, float]] = None,
+                 ignore_statuses: Optional[Dict[str, Iterable[int]]] = None,
+                 clock: Callable[[], float] = time.monotonic, rng: Callable[[], float] = random.random):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_step = rate_step
+        self.max_concurrency = max_concurrency
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.slow_factor = slow_factor
+        self.host_rates = host_rates or {}
+        self.ignore_statuses = {host: frozenset(codes) for host, codes in (ignore_statuses or {}).items()}
+        self.clock = clock
+        self.rng = rng
+        self.hosts: Dict[str, HostState] = {}
+        self._conditions: Dict[str, asyncio.Condition] = {}
+
+    def host(self, host: str) -> HostState:
+        state = self.hosts.get(host)
+        if state is None:
+            state = HostState(self.host_rates.get(host, self.rate), 1, self.cooldown)
+            self.hosts[host] = state
+        return state
+
+    def delay(self, host: str) -> float:
+        """
+        距离可以发出下一个请求还要等待的秒数, 并发已满或熔断探测进行中时为 inf
+        """
+        s = self.host(host)
+        now = self.clock()
+        if s.state == OPEN:
+            if now < s.open_until:
+                return s.open_until - now
+            s.state = HALF_OPEN
+            logger.info(f'{host} half open, probing')
+        if s.state == HALF_OPEN and s.probing:
+            return math.inf
+        if s.inflight >= max(1, int(s.limit)):
+            return math.inf
+        return max(0.0, s.next_at - now)
+
+    def start(self, host: str):
+        s = self.host(host)
+        s.inflight += 1
+        if s.state == HALF_OPEN:
+            s.probing = True
+        s.next_at = self.clock() + (0.5 + self.rng()) / s.rate
+
+    def finish(self, host: str, status: Optional[int], latency: float, retry_after: Optional[str] = None):
+        s = self.host(host)
+        s.inflight = max(0, s.inflight - 1)
+        s.probing = False
+        if status in self.ignore_statuses.get(host, ()):
+            return
+        if is_throttled(status):
+            self._on_throttled(host, s, status, retry_after)
+            return
+        if s.state == HALF_OPEN:
+            logger.info(f'{host} recovered')
+            s.state = CLOSED
+            s.cooldown = self.cooldown
+        s.failures = 0
+        if s.min_latency is None or latency < s.min_latency:
+            s.min_latency = latency
+        if latency > s.min_latency * self.slow_factor and latency > 1:
+            s.limit = max(1.0, s.limit * 0.9)
+            return
+        s.rate = min(self.max_rate, s.rate + self.rate_step)
+        s.limit = min(float(self.max_concurrency), s.limit + 1 / s.limit)
+
+    def _on_throttled(self, host: str, s: HostState, status: Optional[int], retry_after: Optional[str]):
+        now = self.clock()
+        s.failures += 1
+        s.rate = max(self.min_rate, s.rate / 2)
+        s.limit = max(1.0, s.limit / 2)
+        backoff = min(self.max_backoff, self.backoff_base * 2 ** (s.failures - 1)) * (0.5 + self.rng())
+        retry_after = parse_retry_after(retry_after)
+        if retry_after is not None:
+            backoff = max(backoff, retry_after)
+        s.next_at = max(s.next_at, now + backoff)
+        if s.state == HALF_OPEN or s.failures >= self.failure_threshold:
+            s.state = OPEN
+            s.open_until = max(now + s.cooldown, s.next_at)
+            logger.warning(f'{host} parked for {s.open_until - now:.0f}s after {s.failures} failures (status {status})')
+            s.cooldown = min(self.max_cooldown, s.cooldown * 2)
+        else:
+            logger.warning(f'{host} status {status}, backoff {backoff:.1f}s, rate {s.rate:.3f}/s')
+
+    def wait(self, host: str):
+        """
+        同步等待直到可以发出请求
+        """
+        while True:
+            d = self.delay(host)
+            if d <= 0:
+                self.start(host)
+                return
+            time.sleep(min(d, 1.0) if math.isinf(d) else d)
+
+    async def acquire(self, host: str):
+        cond = self._conditions.setdefault(host, asyncio.Condition())
+        async with cond:
+            while True:
+                d = self.delay(host)
+                if d <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(cond.wait(), None if math.isinf(d) else d)
+                except asyncio.TimeoutError:
+                    pass
+            self.start(host)
+
+    async def release(self, host: str, status: Optional[int], latency: float, retry_after: Optional[str] = None):
+        self.finish(host, status, latency, retry_after)
+        await self._notify(host)
+
+    async def cancel(self, host: str):
+        """
+        请求被取消, 与 host 的状况无关, 不调整速率也不计入失败
+        """
+        s = self.host(host)
+        s.inflight = max(0, s.inflight - 1)
+        s.probing = False
+        await self._notify(host)
+
+    async def _notify(self, host: str):
+        cond = self._conditions.get(host)
+        if cond is not None:
+            async with cond:
+                cond.notify_all()
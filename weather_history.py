@@ -1,51 +1,93 @@
-import calendar
+import asyncio
 import datetime
 import logging
 import os
-import random
+import re
+import socket
 import sys
 import time
+from collections import defaultdict
 from pathlib import Path
-from typing import List, Tuple, Iterable
+from typing import List, Tuple, Iterable, Dict, TYPE_CHECKING
 from urllib.parse import urljoin, quote_plus
 
 import requests
 from dateutil.relativedelta import relativedelta
 from loguru import logger
 from redis import StrictRedis
-from scrapy import Selector
-from sqlalchemy import create_engine, select
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
+import metrics
+from http_cache import DAY, CachedSession, HttpCache
+from lishi_parse import parse_month_page
 from models import WeatherRecord, load_db_auth
+from planner import CrawlUnit, plan_gaps
+from records import DailyRecord
+from task_queue import TaskQueue, TaskUnit
+from throttle import AdaptiveThrottle, is_throttled
+from writer import BulkWriter
+
+if TYPE_CHECKING:
+    from async_crawl import AsyncFetcher
 
 CUR_DIR = os.path.dirname(__file__)
+LOG_PATH = os.path.join(CUR_DIR, 'weather_history.log')
 
 logger.remove()
-logger.add(os.path.join(CUR_DIR, 'weather_history.log'), level=logging.INFO, mode='w')
 logger.add(sys.stderr, level=logging.INFO)
 
 MONTH_FORMAT = '%Y%m'
 DATE_FORMAT = '%Y-%m-%d'
+SOURCE = 'history'
+# 被限流或网络错误时单个页面的最大尝试次数, 间隔由 throttle 的退避决定
+MAX_ATTEMPTS = 5
+
+
+def _month_page_ttl(url):
+    # 本月和上月的页面还会更新, 更早的月份基本不变
+    month = re.search(r'/(\d{6})\.html$', url).group(1)
+    recent = (datetime.date.today().replace(day=1) - relativedelta(months=1)).strftime(MONTH_FORMAT)
+    return 3600 if month >= recent else 30 * DAY
+
+
+CACHE_RULES = [
+    (r'^https://lishi\.tianqi\.com/$', DAY),
+    (r'^https://lishi\.tianqi\.com/[\w-]+/\d{6}\.html$', _month_page_ttl),
+]
 
 
 class WeatherHistory:
-    def __init__(self):
+    def __init__(self, engine: Engine = None, cache: StrictRedis = None, session: CachedSession = None,
+                 error_dir: str = CUR_DIR):
+        """
+        engine 和 cache 默认按 db.conf 创建, session 默认使用项目目录下的 http_cache.sqlite,
+        请求出错时响应写入 error_dir/error.html. bench 脚本传入 sqlite 引擎和临时目录
+        """
         self.base_url = 'https://lishi.tianqi.com/'
-        self.session = requests.Session()
+        if session is None:
+            # 原来固定间隔 3~6s, 改为从 0.25 个/s 开始自适应
+            session = CachedSession(HttpCache(rules=CACHE_RULES),
+                                    throttle=AdaptiveThrottle(rate=0.25, max_rate=1, max_concurrency=1))
+        self.session = session
+        self.throttle = session.throttle
+        self.error_dir = error_dir
         self.logger = logger
         self.session.headers.update(
             {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
                            'Chrome/112.0.0.0 Safari/537.36'})
-        mysql_auth = load_db_auth()['mysql']
-
-        self.engine = create_engine("mysql+pymysql://%s:%s@%s:%s/%s" % (
-            mysql_auth['username'], quote_plus(mysql_auth['password']), mysql_auth['host'], mysql_auth['port'],
-            mysql_auth['database']), echo=False)
+        if engine is None:
+            mysql_auth = load_db_auth()['mysql']
+            engine = create_engine("mysql+pymysql://%s:%s@%s:%s/%s" % (
+                mysql_auth['username'], quote_plus(mysql_auth['password']), mysql_auth['host'], mysql_auth['port'],
+                mysql_auth['database']), echo=False)
+        self.engine = engine
 
         self.db_session = Session(self.engine)
+        self.writer = BulkWriter(self.engine, WeatherRecord, ('area_name', 'wdate'), batch_size=500)
 
-        self.cache = StrictRedis(**load_db_auth()['redis'])
+        self.cache = cache if cache is not None else StrictRedis(**load_db_auth()['redis'])
         self.areas = {'长沙', '株洲', '湘潭', '衡阳', '邵阳', '岳阳', '常德', '张家界', '益阳', '郴州', '永州', '怀化',
                       '娄底', '湘西土家族苗族自治州', '广州', '韶关', '深圳', '珠海', '汕头', '佛山', '江门', '湛江',
                       '茂名',
@@ -53,110 +95,84 @@ class WeatherHistory:
                       '海口',
                       '三亚', '三沙', '儋州', '新会', '顺德'}
 
-    def parse(self, response, area_name) -> List[WeatherRecord]:
-        ls = []
-        selector = Selector(text=response.text)
-        for li in selector.css('body > div.main.clearfix > div.main_left.inleft > div.tian_three > ul > li'):
-            date = li.css('div:nth-child(1)::text').get().strip()
-            if date.find(' ') != -1:
-                date = date.split()[0]
-            date = datetime.datetime.strptime(date, DATE_FORMAT)
-            max_temp = li.css('div:nth-child(2)::text').get()
-            if max_temp is not None:
-                max_temp = max_temp.strip()[:-1]
-                try:
-                    max_temp = int(max_temp)
-                except ValueError:
-                    max_temp = None
-            min_temp = li.css('div:nth-child(3)::text').get()
-            if min_temp is not None:
-                min_temp = min_temp.strip()[:-1]
-                try:
-                    min_temp = int(min_temp)
-                except ValueError:
-                    min_temp = None
-            weather = li.css('div:nth-child(4)::text').get()
-            if weather is not None:
-                weather = weather.strip()
-            wind = li.css('div:nth-child(5)::text').get()
-            if wind is not None:
-                wind = wind.strip()
-
-            self.logger.debug(f'{area_name} {date} {max_temp} {min_temp} {wind}')
-
-            ls.append(
-                WeatherRecord(area_name=area_name, wdate=date, weather=weather, max_temp=max_temp,
-                              min_temp=min_temp,
-                              wind=wind))
-        return ls
-
-    def insert(self, data: Iterable[WeatherRecord]):
-        self.db_session.add_all(data)
-        self.db_session.commit()
+    def parse(self, response, area_name) -> List[DailyRecord]:
+        return self.parse_text(response.text, area_name)
+
+    def parse_text(self, text, area_name) -> List[DailyRecord]:
+        with metrics.timer('crawl_parse_seconds', crawler=SOURCE):
+            return parse_month_page(text, area_name)
+
+    def insert(self, data: List[DailyRecord]):
+        with metrics.timer('crawl_write_seconds', crawler=SOURCE):
+            self.writer.add_all(data)
+        metrics.observe('crawl_rows', len(data), crawler=SOURCE)
+
+    def _plan(self, targets: Dict[str, str], start_date, end_date) -> List[CrawlUnit]:
+        with metrics.timer('crawl_plan_seconds', crawler=SOURCE):
+            return plan_gaps(self.db_session, targets, start_date, end_date)
 
     def close(self):
+        self.writer.close()
         self.db_session.close()
+        self.session.cache.close()
 
     @staticmethod
     def _build_cache_key(area, date):
         return f'{area}-{date.strftime(MONTH_FORMAT)}'
 
-    def crwal_single_area(self, area: str, pinyin: str, start_date: datetime.date, end_date: datetime.date):
-
-        def should_crawl():
-            # if self.cache.get(self._build_cache_key(area, date)) is not None:
-            #     return set()
-
-            day_count = calendar.monthrange(date.year, date.month)[1]
-            last = datetime.date(date.year, date.month, day_count)
-            first = datetime.date(date.year, date.month, 1)
-            stmt = select(WeatherRecord.wdate).where(WeatherRecord.area_name == area, WeatherRecord.wdate >= first,
-                                                     WeatherRecord.wdate <= last)
-            scalars = set(self.db_session.scalars(stmt))
-
-            if len(scalars) == day_count:
-                return set()
-
-            if len(scalars) > day_count:
-                raise ValueError(f'重复数据: {area} {date}')
-
-            s2 = set((datetime.date(date.year, date.month, i) for i in range(1, day_count + 1)))
-
-            s2 = s2.difference(scalars)
+    def _month_url(self, pinyin: str, date: datetime.date) -> str:
+        return urljoin(self.base_url, f'{pinyin}/{date.strftime(MONTH_FORMAT)}.html')
 
-            today = datetime.date.today()
-            s2 = set(filter(lambda d: d <= today, s2))
-
-            return s2
+    @staticmethod
+    def _filter_dates(ws: List[DailyRecord], target_dates) -> List[DailyRecord]:
+        return list(filter(lambda a: a.wdate in target_dates, ws))
 
-        response = None
-        try:
-            date = start_date
-            while date <= end_date:
-                target_dates = should_crawl()
-                if len(target_dates) != 0:
-                    logger.info(
-                        f'should crawl %s %s' % (area, ' '.join(map(lambda d: d.strftime(DATE_FORMAT), target_dates))))
-                    url = urljoin(self.base_url, f'{pinyin}/{date.strftime(MONTH_FORMAT)}.html')
-                    print(url)
+    def crwal_single_area(self, area: str, pinyin: str, start_date: datetime.date, end_date: datetime.date):
+        self._crawl_units(self._plan({area: pinyin}, start_date, end_date))
+
+    def _crawl_units(self, units: Iterable[CrawlUnit]) -> List[CrawlUnit]:
+        """
+        返回失败的单元, 单个月份失败不影响其它月份
+        """
+        failed = []
+        for unit in units:
+            area, pinyin, date, target_dates = unit
+            logger.info(
+                f'should crawl %s %s' % (area, ' '.join(map(lambda d: d.strftime(DATE_FORMAT), target_dates))))
+            url = self._month_url(pinyin, date)
+            self.logger.debug(url)
+            try:
+                ws = self._filter_dates(self.parse(self._fetch(url), area), target_dates)
+            except Exception as e:
+                self.logger.error(f'{url}: {e!r}')
+                metrics.inc('crawl_units_total', crawler=SOURCE, status='failed')
+                failed.append(unit)
+                continue
+            self.insert(ws)
+            metrics.inc('crawl_units_total', crawler=SOURCE, status='ok')
+            self.logger.info('insert %d records, miss %d records' % (len(ws), len(target_dates) - len(ws)))
+            # self.cache.set(self._build_cache_key(area, date), 1)
+        return failed
+
+    def _fetch(self, url: str) -> requests.Response:
+        """
+        被限流(403/429/5xx)或网络错误时重试, 等待时间由 throttle 决定, 其它错误直接抛出
+        """
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            response = None
+            try:
+                with metrics.timer('crawl_fetch_seconds', crawler=SOURCE):
                     response = self.session.get(url)
-                    response.raise_for_status()
-                    ws = self.parse(response, area)
-                    ws = list(
-                        filter(lambda a: datetime.date(a.wdate.year, a.wdate.month, a.wdate.day) in target_dates, ws))
-                    self.insert(ws)
-                    self.logger.info('insert %d records, miss %d records' % (len(ws), len(target_dates) - len(ws)))
-                    time.sleep(3 + random.random() * 3)
-                else:
-                    date += relativedelta(months=1)
-                # self.cache.set(self._build_cache_key(area, date), 1)
-                date += relativedelta(months=1)
-
-        except Exception as e:
-            if response is not None:
-                Path(CUR_DIR, 'error.html').write_text(response.text, encoding='utf-8')
-            self.logger.error(e)
-            raise e
+                response.raise_for_status()
+                metrics.observe('crawl_response_bytes', len(response.content), crawler=SOURCE)
+                return response
+            except requests.RequestException as e:
+                if response is not None:
+                    Path(self.error_dir, 'error.html').write_text(response.text, encoding='utf-8')
+                if attempt == MAX_ATTEMPTS or (response is not None and not is_throttled(response.status_code)):
+                    raise
+                metrics.inc('crawl_retries_total', crawler=SOURCE)
+                self.logger.warning(f'{url} attempt {attempt}: {e!r}')
 
     def run_inc(self):
         date = datetime.date.today() - relativedelta(months=1)
@@ -176,20 +192,77 @@ class WeatherHistory:
 
         # idx, dt = self._check_break_point(area_names)
         # self.crwal_single_area(area_names[idx], area_pinyins[idx], dt, end_date)
-        for i in range(len(area_names)):
-            if area_names[i] not in self.areas:
+        targets = self._target_areas(area_names, area_pinyins, full)
+        units = defaultdict(list)
+        for unit in self._plan(targets, start_date, end_date):
+            units[unit.area].append(unit)
+        failed_areas = set()
+        try:
+            for area in targets:
+                if len(self._crawl_units(units[area])) != 0:
+                    failed_areas.add(area)
+                elif full:
+                    self.writer.flush()
+                    self.cache.set('weather:' + area, 1)
+        finally:
+            self.close()
+        if len(failed_areas) != 0:
+            raise RuntimeError('failed areas: ' + ' '.join(sorted(failed_areas)))
+
+    def enqueue(self, queue: TaskQueue, start_date: datetime.date, end_date: datetime.date) -> int:
+        """
+        规划缺数据的 (地区, 月份) 并放入分布式任务队列
+        """
+        area_names, area_pinyins = self._crawl_city_list()
+        targets = self._target_areas(area_names, area_pinyins)
+        units = self._plan(targets, start_date, end_date)
+        return queue.enqueue(TaskUnit(SOURCE, unit.area, unit.month) for unit in units)
+
+    def run_worker(self, queue: TaskQueue, worker: str = None, poll_interval: float = 5):
+        """
+        从队列领取单元直到队列清空, 可以在多个节点上同时运行
+        """
+        worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+        area_names, area_pinyins = self._crawl_city_list()
+        pinyins = dict(zip(area_names, area_pinyins))
+        try:
+            while True:
+                unit = queue.lease(worker)
+                if unit is None:
+                    if queue.stats()['leased_or_delayed'] == 0:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+                try:
+                    # 领取后重新检查, 其它 worker 或增量任务可能已经补齐
+                    failed = self._crawl_units(self._plan({unit.area: pinyins[unit.area]}, unit.month, unit.month))
+                    self.writer.flush()
+                    if len(failed) != 0:
+                        queue.fail(unit, worker)
+                    else:
+                        queue.complete(unit, worker)
+                except Exception:
+                    self.logger.exception(f'{unit}')
+                    queue.fail(unit, worker)
+        finally:
+            self.close()
+
+    def _target_areas(self, area_names, area_pinyins, full=False) -> Dict[str, str]:
+        targets = {}
+        for area, pinyin in zip(area_names, area_pinyins):
+            if area not in self.areas:
                 continue
-            if full and self.cache.get('weather:' + area_names[i]) is not None:
+            if full and self.cache.get('weather:' + area) is not None:
                 continue
-            self.crwal_single_area(area_names[i], area_pinyins[i], start_date, end_date)
-            if full:
-                self.cache.set('weather:' + area_names[i], 1)
-        self.close()
+            targets[area] = pinyin
+        return targets
 
     def _crawl_city_list(self) -> Tuple[List[str], List[str]]:
         area_names, area_pinyins = [], []
         response = self.session.get(self.base_url)
         response.raise_for_status()
+        from scrapy import Selector
+
         selector = Selector(text=response.text)
         for a in selector.css('div.tablebox table tr td li a'):
             area_name = a.css('::text').get().strip()
@@ -199,6 +272,94 @@ class WeatherHistory:
         return area_names, area_pinyins
 
 
+class AsyncWeatherHistory(WeatherHistory):
+    """
+    异步抓取, 所有地区的月份页面并发请求, 按 host 自适应限速代替固定的 sleep
+    """
+
+    def __init__(self, concurrency: int = 8, rate: float = 0.5, burst: float = 2, engine: Engine = None,
+                 cache: StrictRedis = None, session: CachedSession = None, error_dir: str = CUR_DIR):
+        super().__init__(engine, cache, session, error_dir)
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+
+    def _run(self, start_date, end_date, full=False):
+        try:
+            asyncio.run(self._run_async(start_date, end_date, full))
+        finally:
+            self.close()
+
+    async def _run_async(self, start_date, end_date, full=False):
+        area_names, area_pinyins = self._crawl_city_list()
+        targets = self._target_areas(area_names, area_pinyins, full)
+        units = self._plan(targets, start_date, end_date)
+        self.logger.info('planned %d months' % len(units))
+
+        from async_crawl import AsyncFetcher
+
+        write_lock = asyncio.Lock()
+        throttle = AdaptiveThrottle(rate=self.rate, max_concurrency=self.concurrency)
+        async with AsyncFetcher(concurrency=self.concurrency, rate=self.rate, burst=self.burst,
+                                headers=dict(self.session.headers), cache=self.session.cache,
+                                throttle=throttle) as fetcher:
+            results = await asyncio.gather(
+                *(self._crawl_month(fetcher, write_lock, *unit) for unit in units), return_exceptions=True)
+
+        failed_areas = set()
+        for unit, result in zip(units, results):
+            if isinstance(result, BaseException):
+                failed_areas.add(unit.area)
+                self.logger.error(f'{unit.area} {unit.month.strftime(MONTH_FORMAT)}: {result!r}')
+                metrics.inc('crawl_units_total', crawler=SOURCE, status='failed')
+            else:
+                metrics.inc('crawl_units_total', crawler=SOURCE, status='ok')
+        self.writer.flush()
+        if full:
+            for area in targets.keys() - failed_areas:
+                self.cache.set('weather:' + area, 1)
+        if len(failed_areas) != 0:
+            raise RuntimeError('failed areas: ' + ' '.join(sorted(failed_areas)))
+
+    async def _crawl_month(self, fetcher: 'AsyncFetcher', write_lock: asyncio.Lock, area: str, pinyin: str,
+                           date: datetime.date, target_dates):
+        url = self._month_url(pinyin, date)
+        text = await self._fetch_async(fetcher, url)
+        ws = self._filter_dates(self.parse_text(text, area), target_dates)
+        # 写库共用一个 session, 串行执行, 不阻塞事件循环
+        async with write_lock:
+            await asyncio.to_thread(self.insert, ws)
+        self.logger.info('%s insert %d records, miss %d records' % (url, len(ws), len(target_dates) - len(ws)))
+
+    async def _fetch_async(self, fetcher: 'AsyncFetcher', url: str) -> str:
+        import aiohttp
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                with metrics.timer('crawl_fetch_seconds', crawler=SOURCE):
+                    text = await fetcher.get(url)
+                metrics.observe('crawl_response_bytes', len(text), crawler=SOURCE)
+                return text
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == MAX_ATTEMPTS or not is_throttled(getattr(e, 'status', None)):
+                    raise
+                metrics.inc('crawl_retries_total', crawler=SOURCE)
+                self.logger.warning(f'{url} attempt {attempt}: {e!r}')
+
+
+def add_log_file(path: str = LOG_PATH):
+    """
+    命令行运行时另外写一份日志文件, 每次运行覆盖, 导入模块时不创建
+    """
+    logger.add(path, level=logging.INFO, mode='w')
+
+
 if __name__ == '__main__':
-    spider = WeatherHistory()
-    spider.run_inc()
+    add_log_file()
+    spider = AsyncWeatherHistory() if '--async' in sys.argv else WeatherHistory()
+    if '--enqueue' in sys.argv:
+        spider.enqueue(TaskQueue(spider.cache, SOURCE), datetime.date(2011, 1, 1), datetime.date.today())
+    elif '--worker' in sys.argv:
+        spider.run_worker(TaskQueue(spider.cache, SOURCE))
+    else:
+        spider.run_inc()
@@ -0,0 +1,108 @@
+import time
+from typing import Dict, Iterable, Optional, Sequence, Union
+
+from sqlalchemy import Table
+from sqlalchemy.engine import Engine
+
+import metrics
+from models import Base
+
+
+def row_of(table: Table, obj) -> dict:
+    """
+    ORM 对象/NamedTuple 记录或 dict 转成包含所有非自增列的行, 未赋值的列按 Column.default 补齐, 保证同一批次的行 key 一致
+    """
+    get = obj.get if isinstance(obj, dict) else lambda k: getattr(obj, k, None)
+    row = {}
+    for col in table.columns:
+        if col.autoincrement is True or (col.primary_key and col.autoincrement == 'auto'):
+            continue
+        value = get(col.key)
+        if value is None and col.default is not None:
+            value = col.default.arg(None) if col.default.is_callable else col.default.arg
+        row[col.key] = value
+    return row
+
+
+def upsert_statement(engine: Engine, table: Table, keys: Sequence[str], update_columns: Sequence[str]):
+    """
+    mysql 用 insert ... on duplicate key update, sqlite/postgresql 用 on conflict (keys) do update
+    """
+    dialect = engine.dialect.name
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        if len(update_columns) == 0:
+            # 不用 insert ignore, 避免吞掉截断等其它错误
+            return stmt.on_duplicate_key_update({keys[0]: table.c[keys[0]]})
+        return stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in update_columns})
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        raise ValueError(f'unsupported dialect: {dialect}')
+    stmt = insert(table)
+    if len(update_columns) == 0:
+        return stmt.on_conflict_do_nothing(index_elements=keys)
+    return stmt.on_conflict_do_update(index_elements=keys, set_={c: stmt.excluded[c] for c in update_columns})
+
+
+class BulkWriter:
+    """
+    批量幂等写入, 按唯一键 keys upsert, 缓冲行数达到 batch_size 或距上次写入超过 flush_interval 秒时写库
+
+    with BulkWriter(engine, WeatherRecord, ('area_name', 'wdate')) as writer:
+        writer.add_all(records)
+    """
+
+    def __init__(self, engine: Engine, table: Union[Table, type], keys: Sequence[str],
+                 update_columns: Optional[Sequence[str]] = None, batch_size: int = 1000,
+                 flush_interval: float = 30):
+        if isinstance(table, type) and issubclass(table, Base):
+            table = table.__table__
+        self.engine = engine
+        self.table = table
+        self.keys = tuple(keys)
+        if update_columns is None:
+            update_columns = [c.key for c in table.columns if not c.primary_key and c.key not in self.keys]
+        self.update_columns = tuple(update_columns)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stmt = upsert_statement(engine, table, self.keys, self.update_columns)
+        # 去重后提交写库的行数, 不是实际插入/更新的行数, 各数据库 upsert 的 rowcount 含义不一致, 不用它统计
+        self.submitted = 0
+        self._buffer: Dict[tuple, dict] = {}
+        self._last_flush = time.monotonic()
+
+    def add(self, obj):
+        row = row_of(self.table, obj)
+        # 同一批次内相同唯一键只保留最后一行
+        self._buffer[tuple(row[k] for k in self.keys)] = row
+        if len(self._buffer) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def add_all(self, objs: Iterable):
+        for obj in objs:
+            self.add(obj)
+
+    def flush(self) -> int:
+        rows = list(self._buffer.values())
+        self._last_flush = time.monotonic()
+        if len(rows) == 0:
+            return 0
+        with metrics.timer('writer_flush_seconds', table=self.table.name), self.engine.begin() as conn:
+            conn.execute(self.stmt, rows)
+        metrics.observe('writer_batch_rows', len(rows), table=self.table.name)
+        self._buffer.clear()
+        self.submitted += len(rows)
+        return len(rows)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,153 @@
+"""
+wunderground 原始响应 -> weather_hour 行的流式并行转换
+
+python wu_convert.py [csv|parquet|archive] [workers]
+
+每个城市一个进程, 从 raw_store 逐月读取 observations, 用 qc.py 按列做单位换算和质量检查, 直接写 csv/weather_hour/<city>.csv 或 .parquet,
+archive 格式写入按 area/year 分区的归档 (见 archive.py), 归档不保存 qc 列
+"""
+import datetime
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+
+import pandas as pd
+from loguru import logger
+
+import qc
+from raw_store import RAW_DIR, RawStore
+
+CUR_DIR = os.path.dirname(__file__)
+OUT_DIR = os.path.join(CUR_DIR, 'csv', 'weather_hour')
+
+# 除最后的 qc 外与 csv/weather_hour.csv 表头一致, qc 为 qc.FLAGS 的位组合
+COLUMNS = ['area', 'code', 'obs_time', 'temprature', 'feels_like', 'dewpoint', 'humidity', 'wind', 'wind_dir',
+           'wind_speed', 'pressure', 'precip', 'weather', 'source', 'qc']
+OBS_FIELDS = ['valid_time_gmt', 'temp', 'feels_like', 'dewPt', 'rh', 'wdir_cardinal', 'wdir', 'wspd', 'pressure',
+              'precip_total', 'wx_phrase']
+DTYPES = {'temprature': 'Int64', 'feels_like': 'Int64', 'dewpoint': 'Int64', 'humidity': 'Int64',
+          'wind_dir': 'Int64', 'wind_speed': 'Int64', 'pressure': 'Float64', 'precip': 'Float64', 'qc': 'uint16'}
+# 与 datetime.datetime.fromtimestamp 一致, 按本机时区换算
+LOCAL_TZ = datetime.datetime.now().astimezone().tzinfo
+
+
+def iter_months(city: str, raw_dir: str = RAW_DIR) -> Iterator[Tuple[datetime.date, List[dict]]]:
+    """
+    逐月读取一个城市的 observations, 跳过没有观测的月份
+    """
+    for month, js in RawStore(raw_dir).iter_city(city):
+        obss = js.get('observations')
+        if obss:
+            yield month, obss
+
+
+def convert_observations(obss: List[dict], area: str, code: str) -> pd.DataFrame:
+    raw = pd.DataFrame.from_records(obss, columns=OBS_FIELDS)
+    cols, flags = qc.run(raw)
+    if flags.any():
+        logger.debug(f'{area} qc: {qc.describe(flags)}')
+    obs_time = pd.to_datetime(raw['valid_time_gmt'], unit='s', utc=True).dt.tz_convert(LOCAL_TZ)
+    df = pd.DataFrame({
+        'area': area,
+        'code': code,
+        'obs_time': obs_time.dt.tz_localize(None),
+        'temprature': cols['temperature'],
+        'feels_like': cols['feels_like'],
+        'dewpoint': cols['dewpoint'],
+        'humidity': cols['humidity'],
+        'wind': raw['wdir_cardinal'],
+        'wind_dir': cols['wind_dir'],
+        'wind_speed': cols['wind_speed'],
+        'pressure': cols['pressure'],
+        'precip': cols['precip'],
+        'weather': raw['wx_phrase'],
+        'source': '0',
+        'qc': flags,
+    }, columns=COLUMNS)
+    return df.astype(DTYPES)
+
+
+def _output_path(out_dir: str, city: str, fmt: str) -> str:
+    return os.path.join(out_dir, f'{city}.{fmt}')
+
+
+def convert_city(city: str, code: str, raw_dir: str = RAW_DIR, out_dir: str = OUT_DIR, fmt: str = 'csv') -> int:
+    """
+    转换一个城市的所有月份, 每个月作为一个块追加写出, 返回行数
+    """
+    if fmt == 'archive':
+        return _convert_city_archive(city, code, raw_dir, out_dir)
+    target = _output_path(out_dir, city, fmt)
+    tmp = target + '.tmp'
+    rows, writer = 0, None
+    if fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    try:
+        for _, obss in iter_months(city, raw_dir):
+            df = convert_observations(obss, city, code)
+            if fmt == 'parquet':
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp, table.schema)
+                writer.write_table(table)
+            else:
+                df.to_csv(tmp, mode='w' if rows == 0 else 'a', header=rows == 0, index=False)
+            rows += df.shape[0]
+    finally:
+        if writer is not None:
+            writer.close()
+    if rows != 0:
+        os.replace(tmp, target)
+    return rows
+
+
+def _convert_city_archive(city: str, code: str, raw_dir: str, out_dir: str) -> int:
+    import archive
+
+    dfs = [convert_observations(obss, city, code) for _, obss in iter_months(city, raw_dir)]
+    if len(dfs) == 0:
+        return 0
+    # 整个城市一次写入, 成功后才移入归档并标记完成
+    df = pd.concat(dfs, ignore_index=True)
+    with archive.staging(out_dir) as tmp:
+        archive.write(df, tmp)
+    return df.shape[0]
+
+
+def _done(out_dir: str, city: str, fmt: str) -> bool:
+    if fmt == 'archive':
+        import archive
+        return archive.is_done(city, root=out_dir)
+    return os.path.exists(_output_path(out_dir, city, fmt))
+
+
+def convert_all(codes: Dict[str, str], raw_dir: str = RAW_DIR, out_dir: str = OUT_DIR, fmt: str = 'csv',
+                workers: int = None) -> Dict[str, int]:
+    """
+    codes 为 {城市目录名: 行政区划代码}, 已有输出文件的城市跳过
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    cities = [c for c in codes if not _done(out_dir, c, fmt)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        counts = executor.map(convert_city, cities, [codes[c] for c in cities], [raw_dir] * len(cities),
+                              [out_dir] * len(cities), [fmt] * len(cities))
+        return dict(zip(cities, counts))
+
+
+def load_codes(raw_dir: str = RAW_DIR) -> Dict[str, str]:
+    from area_index import AreaIndex
+
+    area_index = AreaIndex.from_json()
+    return {city: area_index.find(city).code for city in RawStore(raw_dir).cities()}
+
+
+if __name__ == '__main__':
+    fmt = sys.argv[1] if len(sys.argv) > 1 else 'csv'
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    out_dir = OUT_DIR
+    if fmt == 'archive':
+        from archive import ARCHIVE_DIR as out_dir
+    for city, count in convert_all(load_codes(), out_dir=out_dir, fmt=fmt, workers=workers).items():
+        print(city, count)
@@ -1,35 +1,96 @@
 import calendar
 import datetime
-import json
 import logging
 import os.path
-import random
 import re
+import socket
+import sqlite3
 import sys
 import time
-from pathlib import Path
+from typing import List, Optional
 
 import requests
 from loguru import logger
 from redis import StrictRedis
 
+import metrics
+from http_cache import DAY, CachedSession, HttpCache
+from proxy_pool import ProxyPool
+from raw_store import RawStore
+from task_queue import TaskQueue, TaskUnit
+from throttle import AdaptiveThrottle, is_throttled
+
 logger.remove()
 logger.add(sys.stderr, level=logging.DEBUG)
 
 START_YEAR = 2012
 END_YEAR = 2023
 
-DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+CUR_DIR = os.path.dirname(__file__)
+SOURCE = 'wunderground'
+
+# 城市页面只用来取 station id 和 apiKey, 解析结果存在 LocationCache, 过期前不再下载页面
+STATION_TTL = 30 * DAY
+# api.weather.com 的 apiKey 失效时的状态码
+AUTH_ERRORS = (401, 403)
+
+
+class LocationCache:
+    """
+    城市拼音 -> station id 的本地持久化缓存, 超过 ttl 重新解析. apiKey 所有城市共用一个, 不设过期,
+    只在 api 返回 401/403 时刷新
+    """
+
+    def __init__(self, path: str = os.path.join(CUR_DIR, 'wu_cache.sqlite'), ttl: float = STATION_TTL):
+        self.ttl = ttl
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS location (name TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                          'update_time REAL NOT NULL)')
+
+    def _get(self, name: str, ttl: Optional[float]) -> Optional[str]:
+        row = self.conn.execute('SELECT value, update_time FROM location WHERE name = ?', (name,)).fetchone()
+        if row is None or (ttl is not None and time.time() - row[1] > ttl):
+            return None
+        return row[0]
+
+    def _set(self, name: str, value: str):
+        self.conn.execute('INSERT OR REPLACE INTO location (name, value, update_time) VALUES (?, ?, ?)',
+                          (name, value, time.time()))
+        self.conn.commit()
+
+    def get_station(self, pinyin: str) -> Optional[str]:
+        return self._get('station:' + pinyin, self.ttl)
+
+    def set_station(self, pinyin: str, station_id: str):
+        self._set('station:' + pinyin, station_id)
+
+    def get_api_key(self) -> Optional[str]:
+        return self._get('api_key', None)
+
+    def set_api_key(self, api_key: str):
+        self._set('api_key', api_key)
+
+    def close(self):
+        self.conn.close()
 
 
 class WunderGroundWeather:
-    def __init__(self):
-        self.session = requests.session()
-        self.proxies = {'http': '127.0.0.1:7890', 'https': '127.0.0.1:7890'}
+    def __init__(self, proxy_pool: ProxyPool = None, locations: LocationCache = None, store: RawStore = None,
+                 session: CachedSession = None):
+        if session is None:
+            # 城市页面和 api 分属两个 host, 各自调整速率
+            session = CachedSession(HttpCache(), throttle=AdaptiveThrottle(
+                rate=1, max_rate=5, max_concurrency=1, host_rates={'www.wunderground.com': 0.2},
+                ignore_statuses={'api.weather.com': AUTH_ERRORS}))
+        self.session = session
+        self.throttle = session.throttle
+        self.locations = locations or LocationCache()
+        self.store = store or RawStore()
+        # 代理在 db.conf 的 [proxy] 节配置, 默认只有本地的 127.0.0.1:7890
+        self.proxy_pool = proxy_pool or ProxyPool.from_config()
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
                           'Chrome/112.0.0.0 Safari/537.36'}
-        self.session.proxies.update(self.proxies)
         self.session.headers.update(self.headers)
         self.base_url = 'https://www.wunderground.com/history/daily/cn/%s'
         self.historical_url = 'https://api.weather.com/v1/location/%s/observations/historical.json'
@@ -78,46 +139,190 @@ class WunderGroundWeather:
 
     def run(self):
         for city, pinyin in self.location_map.items():
-            location_id, api_key = self._extract_loc_and_key(pinyin)
+            try:
+                location_id = self._location(pinyin)
+            except Exception as e:
+                logger.error(f'{city}: {e!r}')
+                continue
             logger.debug(f'{city} ==> {location_id}')
-            params = {
-                'apiKey': api_key,
-                'units': 'e',
-                'startDate': '',
-                'endDate': ''
-            }
-            city_dir = os.path.join(DATA_DIR, city)
-            if not os.path.exists(city_dir):
-                os.mkdir(city_dir)
 
             for year in range(START_YEAR, END_YEAR + 1):
                 for month in range(1, 13):
-                    filename = os.path.join(city_dir, f'{year}-{month}.json')
-
-                    if os.path.exists(filename):
-                        logger.info(f'skip {filename}')
+                    if self.store.has(city, datetime.date(year, month, 1)):
+                        logger.info(f'skip {city} {year}-{month}')
                         continue
                     if datetime.date(year, month, 1) >= datetime.date.today():
                         break
-                    params['startDate'] = datetime.date(year, month, 1).strftime('%Y%m%d')
-                    params['endDate'] = datetime.date(year, month, calendar.monthrange(year, month)[1]).strftime(
-                        '%Y%m%d')
-                    logger.info(f'crawl {city} {year} {month}')
-                    res_json = requests.get(self.historical_url % location_id, params=params, headers=self.headers,
-                                            proxies=self.proxies).json()
-                    Path(filename).write_text(json.dumps(res_json, indent=4, ensure_ascii=False), encoding='utf-8')
+                    try:
+                        self._crawl_month(city, location_id, year, month)
+                        metrics.inc('crawl_units_total', crawler=SOURCE, status='ok')
+                    except Exception as e:
+                        # 没有写入存储, 下次运行会重新抓取
+                        logger.error(f'{city} {year}-{month}: {e!r}')
+                        metrics.inc('crawl_units_total', crawler=SOURCE, status='failed')
 
-                    logger.info(f'writed {filename}')
-                    time.sleep(random.random())
+    def _crawl_month(self, city, location_id, year, month):
+        params = {
+            'units': 'e',
+            'startDate': datetime.date(year, month, 1).strftime('%Y%m%d'),
+            'endDate': datetime.date(year, month, calendar.monthrange(year, month)[1]).strftime('%Y%m%d')
+        }
+        logger.info(f'crawl {city} {year} {month}')
+        response = self._get_api(self.historical_url % location_id, params)
+        response.raise_for_status()
+        metrics.observe('crawl_response_bytes', len(response.content), crawler=SOURCE)
+        with metrics.timer('crawl_parse_seconds', crawler=SOURCE):
+            data = response.json()
+        metrics.observe('crawl_rows', len(data.get('observations') or []), crawler=SOURCE)
+        with metrics.timer('crawl_write_seconds', crawler=SOURCE):
+            entry = self.store.put(city, datetime.date(year, month, 1), data)
+
+        logger.info(f'writed {city} {year}-{month}, {entry.length} bytes')
+
+    def refetch_days(self, city: str, start: datetime.date, end: datetime.date) -> List[dict]:
+        """
+        重新抓取同一个月内 [start, end] 的观测并合并进存储, 返回这段时间的全部观测.
+        缺口可能只在 weather_hour 中, 原始存储里已有的观测也要返回, 由调用方按需写入
+        """
+        location_id = self._location(self.location_map[city])
+        params = {'units': 'e', 'startDate': start.strftime('%Y%m%d'), 'endDate': end.strftime('%Y%m%d')}
+        logger.info(f'refetch {city} {start} ~ {end}')
+        response = self._get_api(self.historical_url % location_id, params)
+        response.raise_for_status()
+        obss = response.json().get('observations') or []
+        self.merge_observations(city, start.replace(day=1), obss)
+        metrics.observe('crawl_rows', len(obss), crawler=SOURCE)
+        return obss
+
+    def merge_observations(self, city: str, month: datetime.date, obss: List[dict]) -> int:
+        """
+        存储里该月没有的观测合并进去, 返回新增的条数
+        """
+        data = self.store.get(city, month) or {'observations': []}
+        old = data.get('observations') or []
+        known = set(obs['valid_time_gmt'] for obs in old)
+        new = [obs for obs in obss if obs['valid_time_gmt'] not in known]
+        if len(new) != 0:
+            data['observations'] = sorted(old + new, key=lambda obs: obs['valid_time_gmt'])
+            with metrics.timer('crawl_write_seconds', crawler=SOURCE):
+                self.store.put(city, month, data)
+        return len(new)
+
+    def enqueue(self, queue: TaskQueue) -> int:
+        """
+        把存储里还没有的 (城市, 月份) 放入分布式任务队列
+        """
+        today = datetime.date.today()
+        units = []
+        for city in self.location_map:
+            for year in range(START_YEAR, END_YEAR + 1):
+                for month in range(1, 13):
+                    if datetime.date(year, month, 1) >= today:
+                        break
+                    if not self.store.has(city, datetime.date(year, month, 1)):
+                        units.append(TaskUnit(SOURCE, city, datetime.date(year, month, 1)))
+        return queue.enqueue(units)
+
+    def run_worker(self, queue: TaskQueue, worker: str = None, poll_interval: float = 5):
+        """
+        从队列领取单元直到队列清空, 可以在多个节点上同时运行
+        """
+        worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+        while True:
+            unit = queue.lease(worker)
+            if unit is None:
+                if queue.stats()['leased_or_delayed'] == 0:
+                    break
+                time.sleep(poll_interval)
+                continue
+            try:
+                location_id = self._location(self.location_map[unit.area])
+                if not self.store.has(unit.area, unit.month):
+                    self._crawl_month(unit.area, location_id, unit.month.year, unit.month.month)
+                queue.complete(unit, worker)
+                metrics.inc('crawl_units_total', crawler=SOURCE, status='ok')
+            except Exception as e:
+                logger.error(f'{unit}: {e!r}')
+                queue.fail(unit, worker)
+                metrics.inc('crawl_units_total', crawler=SOURCE, status='failed')
 
     def _extract_loc_and_key(self, pinyin):
-        response = requests.get(self.base_url % pinyin, headers=self.headers,
-                                proxies=self.proxies)
+        response = self._get(self.base_url % pinyin)
+        response.raise_for_status()
         station_id = re.search(r'class="station-id">\((.+?)\)', response.text).group(1)
         api_key = re.search(r'apiKey=([a-z0-9]+)', response.text).group(1)
+        self.locations.set_station(pinyin, station_id)
+        self.locations.set_api_key(api_key)
+        logger.info(f'resolved {pinyin}: station {station_id}, apiKey {api_key[:6]}...')
 
         return f'{station_id}:9:CN', api_key
 
+    def _location(self, pinyin) -> str:
+        station_id = self.locations.get_station(pinyin)
+        if station_id is None:
+            with metrics.timer('crawl_plan_seconds', crawler=SOURCE):
+                return self._extract_loc_and_key(pinyin)[0]
+        return f'{station_id}:9:CN'
+
+    def _api_key(self, refresh: bool = False) -> str:
+        """
+        共用的 apiKey, 没有或者需要刷新时从任意一个城市页面解析
+        """
+        api_key = None if refresh else self.locations.get_api_key()
+        if api_key is None:
+            api_key = self._extract_loc_and_key(next(iter(self.location_map.values())))[1]
+        return api_key
+
+    def _get_api(self, url, params: dict) -> requests.Response:
+        """
+        带 apiKey 请求 api, apiKey 失效时刷新后重试一次
+        """
+        api_key = self._api_key()
+        response = self._get(url, ok_statuses=AUTH_ERRORS, params={**params, 'apiKey': api_key})
+        if response.status_code in AUTH_ERRORS:
+            logger.warning(f'apiKey {api_key[:6]}... rejected with {response.status_code}, refresh')
+            metrics.inc('crawl_retries_total', crawler=SOURCE, reason='auth')
+            response = self._get(url, ok_statuses=AUTH_ERRORS, params={**params, 'apiKey': self._api_key(refresh=True)})
+        return response
+
+    def _get(self, url, ok_statuses=(), **kwargs) -> requests.Response:
+        """
+        每次请求从代理池取一个代理, 代理连接失败时换一个代理重试, 被目标站点限流也计入该代理的失败.
+        ok_statuses 中的状态码(如 apiKey 失效)与代理无关, 按成功计
+        """
+        for attempt in range(1, len(self.proxy_pool.proxies) + 1):
+            proxy = self.proxy_pool.pick(wait=True)
+            start = time.monotonic()
+            try:
+                with metrics.timer('crawl_fetch_seconds', crawler=SOURCE):
+                    response = self.session.get(url, proxies=proxy.proxies, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.proxy_pool.report(proxy, False, time.monotonic() - start)
+                if attempt == len(self.proxy_pool.proxies):
+                    raise
+                logger.warning(f'{proxy.url}: {e!r}')
+                metrics.inc('crawl_retries_total', crawler=SOURCE, reason='proxy')
+                continue
+            except requests.RequestException:
+                # 读取/解码响应出错等, 不换代理重试, 但每次 pick 都要 report 或 release, 否则 inflight 泄漏
+                self.proxy_pool.report(proxy, False, time.monotonic() - start)
+                raise
+            except BaseException:
+                self.proxy_pool.release(proxy)
+                raise
+            if response.from_cache:
+                self.proxy_pool.release(proxy)
+            else:
+                ok = response.status_code in ok_statuses or not is_throttled(response.status_code)
+                self.proxy_pool.report(proxy, ok, response.elapsed.total_seconds())
+            return response
+
 
 if __name__ == '__main__':
-    WunderGroundWeather().run()
+    spider = WunderGroundWeather()
+    if '--enqueue' in sys.argv:
+        spider.enqueue(TaskQueue(spider.cache, SOURCE))
+    elif '--worker' in sys.argv:
+        spider.run_worker(TaskQueue(spider.cache, SOURCE))
+    else:
+        spider.run()